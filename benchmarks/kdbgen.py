@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""Generate synthetic KDB files for benchmarking.
+
+Usage::
+
+    python benchmarks/kdbgen.py large.kdb --entries 50000 --groups 200
+    python benchmarks/kdbgen.py large.kdbx --format kdbx4 --entries 50000
+
+KDBX 3.1 files use AES-KDF with ``--rounds`` rounds, the same key
+derivation as KDB files, and KDBX 4 files use Argon2d.
+
+The password of the generated database is "password" unless the
+``--password`` option is given.  The contents are derived from
+``--seed`` so the same arguments always produce equivalent databases
+(the cryptographic seeds are still random).
+
+"""
+import io
+import os
+import sys
+import gzip
+import hmac
+import base64
+import struct
+import random
+import hashlib
+import argparse
+import datetime
+from xml.sax.saxutils import escape
+
+from Crypto.Cipher import AES, Salsa20, ChaCha20
+
+from keepassx import kdbx
+from keepassx.db import Group, Entry, transform_key
+from keepassx.writer import DatabaseWriter
+
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+def generate(num_entries=1000, num_groups=10, field_size=16,
+             notes_size=64, attachment_size=0, rounds=50000,
+             password=b'password', seed=0):
+    """Return the contents of a generated KDB file as bytes."""
+    rand = random.Random(seed)
+    writer = DatabaseWriter(password=password, key_encryption_rounds=rounds)
+    groups = []
+    for i in range(num_groups):
+        group = Group()
+        group.groupid = i + 1
+        group.group_name = u'group-%d' % i
+        group.imageid = 1
+        group.level = 0
+        group.flags = 0
+        writer.add_group(group)
+        groups.append(group)
+    start = datetime.datetime(2010, 1, 1)
+    attachment = None
+    if attachment_size:
+        attachment = bytes(bytearray(rand.getrandbits(8)
+                                     for _ in range(attachment_size)))
+    for i in range(num_entries):
+        entry = Entry()
+        entry.uuid = u'%032x' % rand.getrandbits(128)
+        entry.group = groups[i % num_groups]
+        entry.title = u'entry-%d-%s' % (i, _text(rand, field_size))
+        entry.username = _text(rand, field_size)
+        entry.password = _text(rand, field_size)
+        entry.url = u'https://%s.example.com/' % _text(rand, field_size)
+        entry.notes = _text(rand, notes_size)
+        entry.creation_time = start + datetime.timedelta(
+            seconds=rand.randint(0, 10 ** 8))
+        entry.last_mod_time = entry.creation_time
+        entry.last_acc_time = entry.creation_time
+        if attachment is not None:
+            entry.binary_desc = u'attachment-%d.bin' % i
+            entry.binary_data = attachment
+        writer.add_entry(entry)
+    return writer.serialize()
+
+
+def generate_kdbx(num_entries=1000, num_groups=10, field_size=16,
+                  notes_size=64, rounds=50000, version=3,
+                  argon2_memory=16 * 1024 * 1024, argon2_iterations=2,
+                  argon2_parallelism=2, password=b'password', seed=0):
+    """Return the contents of a generated KDBX file as bytes.
+
+    Entries are generated the same way as ``generate`` so the two
+    formats can be compared.  Passwords are stored as protected
+    values.
+
+    """
+    rand = random.Random(seed)
+    protected_stream_key = os.urandom(32)
+    if version == 3:
+        stream = Salsa20.new(key=hashlib.sha256(protected_stream_key).digest(),
+                             nonce=kdbx.SALSA20_NONCE)
+    else:
+        digest = hashlib.sha512(protected_stream_key).digest()
+        stream = ChaCha20.new(key=digest[:32], nonce=digest[32:44])
+    start = datetime.datetime(2010, 1, 1)
+    xml = [u'<?xml version="1.0" encoding="utf-8" standalone="yes"?>'
+           u'<KeePassFile><Meta><Generator>kdbgen</Generator></Meta>'
+           u'<Root><Group><UUID>%s</UUID><Name>Root</Name>' %
+           _kdbx_uuid(rand)]
+    groups = [[] for _ in range(num_groups)]
+    for i in range(num_entries):
+        groups[i % num_groups].append(i)
+    for i, group_entries in enumerate(groups):
+        xml.append(u'<Group><UUID>%s</UUID><Name>group-%d</Name>' % (
+            _kdbx_uuid(rand), i))
+        for j in group_entries:
+            created = start + datetime.timedelta(
+                seconds=rand.randint(0, 10 ** 8))
+            password_value = _text(rand, field_size).encode('utf-8')
+            fields = [
+                (u'Title', u'entry-%d-%s' % (j, _text(rand, field_size))),
+                (u'UserName', _text(rand, field_size)),
+                (u'URL', u'https://%s.example.com/' %
+                 _text(rand, field_size)),
+                (u'Notes', _text(rand, notes_size)),
+            ]
+            time_value = _kdbx_time(created, version)
+            xml.append(
+                u'<Entry><UUID>%s</UUID><Times>'
+                u'<LastModificationTime>%s</LastModificationTime>'
+                u'<CreationTime>%s</CreationTime>'
+                u'<LastAccessTime>%s</LastAccessTime>'
+                u'<Expires>False</Expires></Times>' % (
+                    _kdbx_uuid(rand), time_value, time_value, time_value))
+            for key, value in fields:
+                xml.append(u'<String><Key>%s</Key><Value>%s</Value>'
+                           u'</String>' % (key, escape(value)))
+            xml.append(u'<String><Key>Password</Key>'
+                       u'<Value Protected="True">%s</Value></String>'
+                       u'</Entry>' % base64.b64encode(
+                           stream.encrypt(password_value)).decode('ascii'))
+        xml.append(u'</Group>')
+    xml.append(u'</Group></Root></KeePassFile>')
+    xml = u''.join(xml).encode('utf-8')
+    master_seed = os.urandom(32)
+    iv = os.urandom(16)
+    key = hashlib.sha256(hashlib.sha256(password).digest()).digest()
+    if version == 3:
+        transform_seed = os.urandom(32)
+        stream_start_bytes = os.urandom(32)
+        transformed_key = transform_key(key, transform_seed, rounds)
+        header = struct.pack('<IIHH', kdbx.SIGNATURE1, kdbx.SIGNATURE2, 1, 3)
+        for field_id, data in [
+                (kdbx.KdbxHeader.CIPHER_ID, kdbx.AES_CIPHER),
+                (kdbx.KdbxHeader.COMPRESSION_FLAGS, struct.pack('<I', 1)),
+                (kdbx.KdbxHeader.MASTER_SEED, master_seed),
+                (kdbx.KdbxHeader.TRANSFORM_SEED, transform_seed),
+                (kdbx.KdbxHeader.TRANSFORM_ROUNDS,
+                 struct.pack('<Q', rounds)),
+                (kdbx.KdbxHeader.ENCRYPTION_IV, iv),
+                (kdbx.KdbxHeader.PROTECTED_STREAM_KEY,
+                 protected_stream_key),
+                (kdbx.KdbxHeader.STREAM_START_BYTES, stream_start_bytes),
+                (kdbx.KdbxHeader.INNER_RANDOM_STREAM_ID,
+                 struct.pack('<I', kdbx.SALSA20_STREAM)),
+                (kdbx.KdbxHeader.END, b'\r\n\r\n')]:
+            header += struct.pack('<BH', field_id, len(data)) + data
+        payload = gzip_compress(xml)
+        blocks = io.BytesIO()
+        for index, offset in enumerate(range(0, len(payload), 1024 * 1024)):
+            block = payload[offset:offset + 1024 * 1024]
+            blocks.write(struct.pack('<I32sI', index,
+                                     hashlib.sha256(block).digest(),
+                                     len(block)) + block)
+        blocks.write(struct.pack('<I32sI', index + 1, b'\0' * 32, 0))
+        final_key = hashlib.sha256(master_seed + transformed_key).digest()
+        return header + _aes_encrypt(final_key, iv,
+                                     stream_start_bytes + blocks.getvalue())
+    kdf_parameters = {
+        '$UUID': kdbx.ARGON2D_KDF, 'S': os.urandom(32),
+        'I': argon2_iterations, 'M': argon2_memory,
+        'P': argon2_parallelism, 'V': 0x13}
+    transformed_key = kdbx.transform_kdbx_key(key, kdf_parameters)
+    header = struct.pack('<IIHH', kdbx.SIGNATURE1, kdbx.SIGNATURE2, 0, 4)
+    for field_id, data in [
+            (kdbx.KdbxHeader.CIPHER_ID, kdbx.AES_CIPHER),
+            (kdbx.KdbxHeader.COMPRESSION_FLAGS, struct.pack('<I', 1)),
+            (kdbx.KdbxHeader.MASTER_SEED, master_seed),
+            (kdbx.KdbxHeader.ENCRYPTION_IV, iv),
+            (kdbx.KdbxHeader.KDF_PARAMETERS,
+             _variant_dictionary(kdf_parameters)),
+            (kdbx.KdbxHeader.END, b'\r\n\r\n')]:
+        header += struct.pack('<BI', field_id, len(data)) + data
+    hmac_key = hashlib.sha512(master_seed + transformed_key +
+                              b'\x01').digest()
+    inner_header = b''.join([
+        struct.pack('<BI', 1, 4), struct.pack('<I', kdbx.CHACHA20_STREAM),
+        struct.pack('<BI', 2, len(protected_stream_key)),
+        protected_stream_key, struct.pack('<BI', 0, 0)])
+    final_key = hashlib.sha256(master_seed + transformed_key).digest()
+    ciphertext = _aes_encrypt(final_key, iv,
+                              gzip_compress(inner_header + xml))
+    out = io.BytesIO()
+    out.write(header)
+    out.write(hashlib.sha256(header).digest())
+    out.write(_kdbx4_hmac(hmac_key, 0xFFFFFFFFFFFFFFFF, header))
+    offsets = list(range(0, len(ciphertext), 1024 * 1024)) + [None]
+    for index, offset in enumerate(offsets):
+        block = b'' if offset is None else \
+            ciphertext[offset:offset + 1024 * 1024]
+        out.write(_kdbx4_hmac(hmac_key, index,
+                              struct.pack('<Qi', index, len(block)) + block))
+        out.write(struct.pack('<i', len(block)) + block)
+    return out.getvalue()
+
+
+def gzip_compress(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _aes_encrypt(key, iv, data):
+    padding = 16 - len(data) % 16
+    return AES.new(key, AES.MODE_CBC, iv).encrypt(
+        data + struct.pack('B', padding) * padding)
+
+
+def _kdbx4_hmac(hmac_key, index, data):
+    return hmac.new(hashlib.sha512(struct.pack('<Q', index) +
+                                   hmac_key).digest(),
+                    data, hashlib.sha256).digest()
+
+
+def _variant_dictionary(values):
+    data = b'\x00\x01'
+    for key, value in sorted(values.items()):
+        if isinstance(value, bytes):
+            value_type = 0x42
+        elif key in ('I', 'M'):
+            value_type, value = 0x05, struct.pack('<Q', value)
+        else:
+            value_type, value = 0x04, struct.pack('<I', value)
+        key = key.encode('utf-8')
+        data += (struct.pack('<Bi', value_type, len(key)) + key +
+                 struct.pack('<i', len(value)) + value)
+    return data + b'\x00'
+
+
+def _kdbx_uuid(rand):
+    return base64.b64encode(struct.pack(
+        '<QQ', rand.getrandbits(64), rand.getrandbits(64))).decode('ascii')
+
+
+def _kdbx_time(value, version):
+    if version == 3:
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    seconds = int((value - datetime.datetime(1, 1, 1)).total_seconds())
+    return base64.b64encode(struct.pack('<q', seconds)).decode('ascii')
+
+
+def _text(rand, size):
+    return u''.join(rand.choice(ALPHABET) for _ in range(size))
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('filename', help='The KDB file to create.')
+    parser.add_argument('--format', default='kdb',
+                        choices=['kdb', 'kdbx3', 'kdbx4'])
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--field-size', type=int, default=16,
+                        help='Size of the title, username, password and '
+                             'url fields.')
+    parser.add_argument('--notes-size', type=int, default=64)
+    parser.add_argument('--attachment-size', type=int, default=0,
+                        help='Size in bytes of the attachment added to '
+                             'every entry.  Defaults to no attachments.')
+    parser.add_argument('--rounds', type=int, default=50000,
+                        help='Number of key encryption rounds.')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def main(args=None):
+    args = create_parser().parse_args(args)
+    if args.format == 'kdb':
+        contents = generate(num_entries=args.entries, num_groups=args.groups,
+                            field_size=args.field_size,
+                            notes_size=args.notes_size,
+                            attachment_size=args.attachment_size,
+                            rounds=args.rounds,
+                            password=args.password.encode('cp1252'),
+                            seed=args.seed)
+    else:
+        contents = generate_kdbx(
+            num_entries=args.entries, num_groups=args.groups,
+            field_size=args.field_size, notes_size=args.notes_size,
+            rounds=args.rounds, version=int(args.format[-1]),
+            password=args.password.encode('utf-8'), seed=args.seed)
+    with open(args.filename, 'wb') as f:
+        f.write(contents)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Measure how much memory forked workers copy from the master.
+
+Usage::
+
+    python benchmarks/prefork.py --entries 50000 --workers 4
+
+The database is loaded in the master, either as a ``Database`` with
+every entry decoded or as a ``FrozenDatabase``, and then each worker
+looks up every entry by uuid.  The private (copied) memory of each
+worker is read from ``/proc``, so this only runs on Linux.
+
+"""
+import os
+import sys
+import argparse
+
+import kdbgen
+from keepassx import prefork
+from keepassx.db import Database
+from keepassx.prefork import FrozenDatabase
+
+
+def private_dirty_kb():
+    total = 0
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                total += int(line.split()[1])
+    return total
+
+
+def run_worker(db, uuids, write_fd):
+    before = private_dirty_kb()
+    for uuid in uuids:
+        db.find_by_uuid(uuid)
+    os.write(write_fd, str(private_dirty_kb() - before).encode('ascii'))
+
+
+def measure(db, uuids, num_workers):
+    """Return the KB of memory each worker copied."""
+    prefork.before_fork()
+    results = []
+    for _ in range(num_workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                prefork.after_fork()
+                run_worker(db, uuids, write_fd)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd, 'rb') as f:
+            results.append(int(f.read()))
+    prefork.after_fork()
+    return results
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    return parser
+
+
+def main(args=None):
+    args = create_parser().parse_args(args)
+    contents = kdbgen.generate(num_entries=args.entries,
+                               num_groups=args.groups, rounds=1000)
+    db = Database(contents, b'password')
+    uuids = [entry.uuid for entry in db.entries]
+    frozen = FrozenDatabase.freeze(Database(contents, b'password'))
+    for name, target in [('Database', db), ('FrozenDatabase', frozen)]:
+        copied = measure(target, uuids, args.workers)
+        sys.stdout.write('%-16s %10d KB copied per worker\n' % (
+            name, sum(copied) // len(copied)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""Run the keepassx benchmarks.
+
+Usage::
+
+    python benchmarks/run.py --entries 1000,10000 --output before.json
+    python benchmarks/run.py --entries 1000,10000 --compare before.json
+
+Each benchmark is run against a synthetic database generated by
+``kdbgen`` for every requested entry count.  Results are written as
+JSON so runs from different revisions can be compared with
+``--compare``.
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import binascii
+import platform
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import kdbgen
+import keepassx
+from keepassx import audit
+from keepassx import completion
+from keepassx.db import Database, Header, calculate_key, decrypt_cbc
+from keepassx.db import parse_entries_parallel
+from keepassx.kdbx import KdbxDatabase
+from keepassx.shell import IncrementalSearch
+
+
+RESULTS_FORMAT_VERSION = 1
+_clock = timeit.default_timer
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """Register a benchmark.
+
+    The decorated function is given a ``Context`` and returns the
+    zero argument callable to be timed.
+
+    """
+    def _register(func):
+        BENCHMARKS[name] = func
+        return func
+    return _register
+
+
+class Context(object):
+    """A generated database along with everything needed to load it."""
+
+    def __init__(self, filename, contents, password, params,
+                 hash_list_size=0, argon2_memory=16 * 1024 * 1024,
+                 argon2_parallelism=2):
+        self.filename = filename
+        self.hash_list_size = hash_list_size
+        self.argon2_memory = argon2_memory
+        self.argon2_parallelism = argon2_parallelism
+        self.contents = contents
+        self.password = password
+        self.params = params
+        self.header = Header(contents)
+        self.key = calculate_key(
+            password, None, self.header.master_seed,
+            self.header.master_seed2, self.header.key_encryption_rounds)
+        self.db = Database(contents, password)
+        self.payload = self.db._decrypt_payload(
+            contents[Header.HEADER_SIZE:], self.key,
+            self.header.encryption_type, self.header.encryption_iv)
+        # The last entry is the worst case for a linear search.
+        self.last_entry = self.db.entries[-1]
+
+
+@benchmark('header_parse')
+def bench_header_parse(ctx):
+    return lambda: Header(ctx.contents)
+
+
+@benchmark('calculate_key')
+def bench_calculate_key(ctx):
+    header = ctx.header
+    return lambda: ctx.db._calculate_key(
+        ctx.password, None, header.master_seed, header.master_seed2,
+        header.key_encryption_rounds)
+
+
+@benchmark('decrypt_payload')
+def bench_decrypt_payload(ctx):
+    ciphertext = ctx.contents[Header.HEADER_SIZE:]
+    return lambda: ctx.db._decrypt_payload(
+        ciphertext, ctx.key, ctx.header.encryption_type,
+        ctx.header.encryption_iv)
+
+
+@benchmark('decrypt_cbc_parallel')
+def bench_decrypt_cbc_parallel(ctx):
+    ciphertext = ctx.contents[Header.HEADER_SIZE:]
+    return lambda: decrypt_cbc(ctx.key, ctx.header.encryption_iv,
+                               ciphertext)
+
+
+@benchmark('parse_payload')
+def bench_parse_payload(ctx):
+    return lambda: ctx.db._parse_payload(ctx.payload)
+
+
+@benchmark('parse_entries_parallel')
+def bench_parse_entries_parallel(ctx):
+    # The entries of parse_payload, decoded using a process per core
+    # regardless of Database.PARALLEL_PARSE_THRESHOLD.
+    start = ctx.db._parse_groups_payload(ctx.payload)[1]
+    return lambda: parse_entries_parallel(
+        ctx.payload, start, ctx.header.num_entries)
+
+
+@benchmark('find_by_uuid')
+def bench_find_by_uuid(ctx):
+    return lambda: ctx.db.find_by_uuid(ctx.last_entry.uuid)
+
+
+@benchmark('find_by_title')
+def bench_find_by_title(ctx):
+    return lambda: ctx.db.find_by_title(ctx.last_entry.title)
+
+
+@benchmark('find_by_url')
+def bench_find_by_url(ctx):
+    # Build the domain index first, only the lookup is timed.
+    ctx.db.find_by_url(ctx.last_entry.url)
+    return lambda: ctx.db.find_by_url(ctx.last_entry.url)
+
+
+@benchmark('modified_since')
+def bench_modified_since(ctx):
+    # The most recent tenth of the entries.  Only the query is timed,
+    # the index is built first.
+    times = sorted(entry.last_mod_time for entry in ctx.db.entries)
+    since = times[len(times) * 9 // 10]
+    ctx.db.modified_since(since)
+    return lambda: ctx.db.modified_since(since)
+
+
+@benchmark('load_and_find_by_title')
+def bench_load_and_find_by_title(ctx):
+    # Decrypts the payload but only decodes the matching entry.
+    return lambda: Database(ctx.contents, final_key=ctx.key).find_by_title(
+        ctx.last_entry.title)
+
+
+@benchmark('load_all_entries')
+def bench_load_all_entries(ctx):
+    return lambda: Database(ctx.contents, final_key=ctx.key).entries
+
+
+@benchmark('fuzzy_search_by_title')
+def bench_fuzzy_search_by_title(ctx):
+    # A query that falls through to the subsequence matching.
+    term = ctx.last_entry.title[:-2].upper() + 'zz'
+    return lambda: ctx.db.fuzzy_search_by_title(term)
+
+
+@benchmark('search_as_typed')
+def bench_search_as_typed(ctx):
+    # One search per keystroke of a title, each from scratch.
+    term = ctx.last_entry.title
+    return lambda: [ctx.db.fuzzy_search_by_title(term[:i])
+                    for i in range(1, len(term) + 1)]
+
+
+@benchmark('shell_search_as_typed')
+def bench_shell_search_as_typed(ctx):
+    # The same keystrokes in kp shell, where each search narrows the
+    # candidates of the one before.
+    term = ctx.last_entry.title
+    entries = ctx.db.entries
+
+    def _type():
+        search = IncrementalSearch(entries)
+        return [search.search(term[:i]) for i in range(1, len(term) + 1)]
+    return _type
+
+
+@benchmark('complete_from_cache')
+def bench_complete_from_cache(ctx):
+    # What "kp complete" does on each tab press, without the
+    # interpreter startup: read the cache and match a prefix.
+    cache_home = os.path.dirname(ctx.filename)
+    with _environ('XDG_CACHE_HOME', cache_home):
+        completion.write_cache(
+            ctx.filename, ctx.header,
+            completion.candidates(completion.entry_names(ctx.db)))
+    prefix = ctx.last_entry.title[:3]
+
+    def _complete():
+        with _environ('XDG_CACHE_HOME', cache_home):
+            return completion.complete(
+                completion.read_cache(ctx.filename)[1], prefix)
+    return _complete
+
+
+@benchmark('audit_breached')
+def bench_audit_breached(ctx):
+    # Every other entry's password is in the list.
+    entries = ctx.db.entries
+    hashes = set(audit.password_hash(e.password) for e in entries[::2])
+    while len(hashes) < ctx.hash_list_size:
+        hashes.add(binascii.hexlify(os.urandom(20)).upper())
+    filename = ctx.filename + '.hashes'
+    with open(filename, 'wb') as f:
+        for h in sorted(hashes):
+            f.write(h + b':1\r\n')
+    hash_list = audit.HashList(filename)
+    hash_list.build_prefix_index()
+    return lambda: audit.find_breached(entries, hash_list)
+
+
+@benchmark('unlock_kdb')
+def bench_unlock_kdb(ctx):
+    # The KDB baseline for the unlock_kdbx benchmarks: derive the key,
+    # decrypt and read every entry.
+    return lambda: Database(ctx.contents, ctx.password).entries
+
+
+@benchmark('unlock_kdbx3')
+def bench_unlock_kdbx3(ctx):
+    # The same entries in a KDBX 3.1 file, with the same number of
+    # AES-KDF rounds.
+    contents = kdbgen.generate_kdbx(
+        num_entries=ctx.params['entries'], num_groups=ctx.params['groups'],
+        field_size=ctx.params['field_size'], rounds=ctx.params['rounds'],
+        version=3, password=ctx.password)
+    return lambda: KdbxDatabase(contents, ctx.password)
+
+
+@benchmark('unlock_kdbx4')
+def bench_unlock_kdbx4(ctx):
+    # The same entries in a KDBX 4 file using Argon2d.
+    contents = kdbgen.generate_kdbx(
+        num_entries=ctx.params['entries'], num_groups=ctx.params['groups'],
+        field_size=ctx.params['field_size'], version=4,
+        argon2_memory=ctx.argon2_memory,
+        argon2_parallelism=ctx.argon2_parallelism, password=ctx.password)
+    return lambda: KdbxDatabase(contents, ctx.password)
+
+
+@benchmark('cli_list')
+def bench_cli_list(ctx):
+    return lambda: _run_kp(ctx, ['list', '-f', 'jsonl'])
+
+
+@benchmark('cli_get')
+def bench_cli_get(ctx):
+    return lambda: _run_kp(ctx, ['get', '-n', ctx.last_entry.uuid])
+
+
+@contextmanager
+def _environ(name, value):
+    # Set an environment variable without leaking it into the
+    # benchmarks that run afterwards.
+    original = os.environ.get(name)
+    os.environ[name] = value
+    try:
+        yield
+    finally:
+        if original is None:
+            del os.environ[name]
+        else:
+            os.environ[name] = original
+
+
+def _run_kp(ctx, command):
+    env = os.environ.copy()
+    env['KP_INSECURE_PASSWORD'] = ctx.password.decode('cp1252')
+    args = [sys.executable, '-c',
+            'import sys; from keepassx.main import main; sys.exit(main())',
+            '-d', ctx.filename] + command
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.check_call(args, env=env, stdout=devnull, stderr=devnull)
+
+
+def run_benchmark(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = _clock()
+        func()
+        times.append(_clock() - start)
+    times.sort()
+    return {
+        'repeat': repeat,
+        'times': times,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+    }
+
+
+def run(args, stream=sys.stdout):
+    tempdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for num_entries in args.entries:
+            params = OrderedDict([
+                ('entries', num_entries),
+                ('groups', args.groups),
+                ('field_size', args.field_size),
+                ('attachment_size', args.attachment_size),
+                ('rounds', args.rounds),
+            ])
+            filename = os.path.join(tempdir, 'bench-%s.kdb' % num_entries)
+            contents = kdbgen.generate(
+                num_entries=num_entries, num_groups=args.groups,
+                field_size=args.field_size,
+                attachment_size=args.attachment_size, rounds=args.rounds)
+            with open(filename, 'wb') as f:
+                f.write(contents)
+            ctx = Context(filename, contents, b'password', params,
+                          args.hash_list_size, args.argon2_memory * 1024,
+                          args.argon2_parallelism)
+            for name, setup in BENCHMARKS.items():
+                if args.only and name not in args.only:
+                    continue
+                result = OrderedDict([('name', name), ('params', params)])
+                result.update(run_benchmark(setup(ctx), args.repeat))
+                results.append(result)
+                stream.write('%-24s %8d entries %12.3f ms\n' % (
+                    name, num_entries, result['median'] * 1000))
+    finally:
+        shutil.rmtree(tempdir)
+    return {
+        'version': RESULTS_FORMAT_VERSION,
+        'metadata': {
+            'keepassx_version': keepassx.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+        },
+        'results': results,
+    }
+
+
+def compare(old, new, stream=sys.stdout):
+    """Write the ratio of new to old median times for each benchmark."""
+    def _key(result):
+        return (result['name'], json.dumps(result['params'], sort_keys=True))
+    old_results = dict((_key(r), r) for r in old['results'])
+    stream.write('\n%-24s %8s %12s %12s %8s\n' % (
+        'Benchmark', 'Entries', 'Old (ms)', 'New (ms)', 'Ratio'))
+    for result in new['results']:
+        previous = old_results.get(_key(result))
+        if previous is None:
+            continue
+        stream.write('%-24s %8d %12.3f %12.3f %7.2fx\n' % (
+            result['name'], result['params']['entries'],
+            previous['median'] * 1000, result['median'] * 1000,
+            result['median'] / previous['median']))
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=_int_list, default=[1000, 10000],
+                        help='Comma separated list of entry counts.')
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--field-size', type=int, default=16)
+    parser.add_argument('--attachment-size', type=int, default=0)
+    parser.add_argument('--rounds', type=int, default=50000)
+    parser.add_argument('--hash-list-size', type=int, default=1000000,
+                        help='Number of hashes in the breached password '
+                             'list used by audit_breached.')
+    parser.add_argument('--argon2-memory', type=int, default=16 * 1024,
+                        help='Argon2 memory in KiB for unlock_kdbx4.')
+    parser.add_argument('--argon2-parallelism', type=int, default=2,
+                        help='Argon2 lanes for unlock_kdbx4.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+',
+                        help='Only run the named benchmarks.')
+    parser.add_argument('-o', '--output',
+                        help='Write the results as JSON to this file.')
+    parser.add_argument('--compare',
+                        help='A results file from a previous run to '
+                             'compare against.')
+    return parser
+
+
+def main(args=None):
+    args = create_parser().parse_args(args)
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
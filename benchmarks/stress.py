@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Measure SharedDatabase lookup throughput across threads.
+
+Usage::
+
+    python benchmarks/stress.py --entries 10000 --threads 1,2,4,8,16,32
+    python benchmarks/stress.py --update-interval 0.01
+
+Each thread looks up random entries by uuid and title for
+``--duration`` seconds.  With ``--update-interval``, another thread
+edits an entry that often, so every edit publishes a new snapshot
+while the lookups are running.
+
+"""
+import sys
+import time
+import random
+import argparse
+import threading
+
+import kdbgen
+from keepassx.db import Database
+from keepassx.threadsafe import SharedDatabase
+
+
+def run_lookups(shared, keys, duration, seed):
+    rand = random.Random(seed)
+    deadline = time.time() + duration
+    lookups = 0
+    while time.time() < deadline:
+        # Check the clock every 100 lookups to keep its cost down.
+        for _ in range(50):
+            uuid, title = rand.choice(keys)
+            shared.find_by_uuid(uuid)
+            shared.find_by_title(title)
+        lookups += 100
+    return lookups
+
+
+def run_updates(shared, interval, stop):
+    updates = 0
+
+    def touch(entries):
+        entries[0].notes = u'update %d' % updates
+
+    while not stop.is_set():
+        shared.update(touch)
+        updates += 1
+        stop.wait(interval)
+    return updates
+
+
+def measure(shared, keys, num_threads, duration, update_interval=None):
+    """Return the lookups per second and the number of updates."""
+    counts = [0] * num_threads
+    updates = [0]
+
+    def _lookup_thread(i):
+        counts[i] = run_lookups(shared, keys, duration, seed=i)
+
+    def _update_thread():
+        updates[0] = run_updates(shared, update_interval, stop)
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=_lookup_thread, args=(i,))
+               for i in range(num_threads)]
+    if update_interval is not None:
+        threads.append(threading.Thread(target=_update_thread))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads[:num_threads]:
+        thread.join()
+    elapsed = time.time() - start
+    stop.set()
+    for thread in threads[num_threads:]:
+        thread.join()
+    return sum(counts) / elapsed, updates[0]
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--threads', type=_int_list,
+                        default=[1, 2, 4, 8, 16, 32],
+                        help='Comma separated list of thread counts.')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='Seconds to run each thread count for.')
+    parser.add_argument('--update-interval', type=float,
+                        help='Seconds between edits made while the '
+                             'lookups run.  By default nothing is edited.')
+    return parser
+
+
+def main(args=None):
+    args = create_parser().parse_args(args)
+    contents = kdbgen.generate(num_entries=args.entries,
+                               num_groups=args.groups, rounds=1000)
+    shared = SharedDatabase(Database(contents, b'password'))
+    keys = [(entry.uuid, entry.title) for entry in shared.entries]
+    sys.stdout.write('%8s %16s %10s\n' % ('Threads', 'Lookups/sec',
+                                          'Updates'))
+    for num_threads in args.threads:
+        throughput, updates = measure(shared, keys, num_threads,
+                                      args.duration, args.update_interval)
+        sys.stdout.write('%8d %16.0f %10d\n' % (num_threads, throughput,
+                                                updates))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
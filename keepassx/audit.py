@@ -0,0 +1,213 @@
+"""Check entry passwords against a list of breached password hashes.
+
+The hash list is expected to be in the format distributed by Have I
+Been Pwned: one uppercase hex SHA-1 hash per line, sorted, optionally
+followed by a ``:`` and the number of times it has been seen::
+
+    000000005AD76BD555C1D6D771DE417A4B87E4B4:4
+    00000000A8DAE4228F821FB418F59826079BF368:2
+
+These lists are many gigabytes, so rather than reading one into memory
+it's memory mapped and binary searched, which only touches the pages
+along each search path.  Nothing is sent over the network::
+
+    with HashList('pwned-passwords-sha1-ordered-by-hash.txt') as hashes:
+        for entry, count in find_breached(db.entries, hashes):
+            print(entry.title, count)
+
+A prefix index (see ``HashList.build_prefix_index``) records where each
+16 bit hash prefix starts, so a search starts from a range of a few
+pages instead of the whole file.
+
+"""
+import os
+import mmap
+import struct
+import hashlib
+
+from keepassx import instrument
+
+
+HASH_SIZE = 40
+PREFIX_INDEX_SUFFIX = '.prefix'
+PREFIX_BITS = 16
+_PREFIX_MAGIC = b'KPPREFX\x01'
+# The size and mtime of the hash list the prefix index was built from.
+_PREFIX_HEADER = struct.Struct('<8sQQ')
+_PREFIX_OFFSETS = struct.Struct('<%dQ' % ((1 << PREFIX_BITS) + 1))
+
+
+def password_hash(password):
+    """Return the uppercase hex SHA-1 of a password, as found in the list."""
+    if not isinstance(password, bytes):
+        password = password.encode('utf-8')
+    return hashlib.sha1(password).hexdigest().upper().encode('ascii')
+
+
+def find_breached(entries, hash_list):
+    """Find the entries whose password is in ``hash_list``.
+
+    Every password is hashed up front and the distinct hashes are looked
+    up as a single sorted batch (see ``HashList.lookup_many``).  Entries
+    without a password are skipped.
+
+    Returns a list of ``(entry, count)`` tuples in the order of
+    ``entries``, where ``count`` is the number of times the password
+    has been seen in breaches (or 1 if the list has no counts).
+
+    """
+    with instrument.timed('hash_passwords'):
+        hashes = [(entry, password_hash(entry.password))
+                  for entry in entries if entry.password]
+    with instrument.timed('breach_lookup'):
+        counts = hash_list.lookup_many(set(h for _, h in hashes))
+    instrument.count('passwords_checked', len(hashes))
+    return [(entry, counts[h]) for entry, h in hashes if h in counts]
+
+
+class HashList(object):
+    """A memory mapped, sorted list of SHA-1 hashes."""
+
+    def __init__(self, filename, prefix_index=None):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be memory mapped.
+            self._mmap = b''
+        self._prefix_index = prefix_index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if not isinstance(self._mmap, bytes):
+            self._mmap.close()
+        self._file.close()
+
+    def __contains__(self, sha1_hex):
+        return self.count(sha1_hex) > 0
+
+    def count(self, sha1_hex):
+        """Return how many times a hash has been seen, 0 if it isn't listed."""
+        return self.lookup_many([sha1_hex]).get(_normalize(sha1_hex), 0)
+
+    def lookup_many(self, hashes):
+        """Look up several hashes at once.
+
+        The hashes are searched for in sorted order, each search
+        starting where the previous one ended, so the searches share
+        the pages near the top of the search tree and never go back
+        over the start of the file.
+
+        Returns a dict mapping each listed hash to its count.
+
+        """
+        found = {}
+        lo = 0
+        for sha1_hex in sorted(_normalize(h) for h in hashes):
+            start, end = lo, self._size
+            if self._prefix_index is not None:
+                prefix = int(sha1_hex[:PREFIX_BITS // 4], 16)
+                start = max(start, self._prefix_index[prefix])
+                end = self._prefix_index[prefix + 1]
+            lo, line = self._search(sha1_hex, start, end)
+            if line is not None:
+                found[sha1_hex] = _line_count(line)
+        instrument.count('hashes_looked_up', len(found))
+        return found
+
+    def build_prefix_index(self):
+        """Find where each hash prefix starts in the list.
+
+        This takes one binary search per prefix, which is far less than
+        reading a multi gigabyte list, and the result can be saved with
+        ``save_prefix_index`` for next time.
+
+        """
+        offsets = []
+        lo = 0
+        for prefix in range(1 << PREFIX_BITS):
+            target = ('%0*X' % (PREFIX_BITS // 4, prefix)).encode('ascii')
+            lo = self._search(target, lo, self._size)[0]
+            offsets.append(lo)
+        offsets.append(self._size)
+        self._prefix_index = offsets
+        return offsets
+
+    def load_prefix_index(self, filename=None):
+        """Load a saved prefix index.
+
+        Returns False if there's no prefix index or it was built from
+        a different version of the list.
+
+        """
+        if filename is None:
+            filename = self.filename + PREFIX_INDEX_SUFFIX
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return False
+        if len(data) != _PREFIX_HEADER.size + _PREFIX_OFFSETS.size or \
+                data[:_PREFIX_HEADER.size] != self._prefix_header():
+            return False
+        self._prefix_index = _PREFIX_OFFSETS.unpack_from(
+            data, _PREFIX_HEADER.size)
+        return True
+
+    def save_prefix_index(self, filename=None):
+        if filename is None:
+            filename = self.filename + PREFIX_INDEX_SUFFIX
+        offsets = self._prefix_index
+        if offsets is None:
+            offsets = self.build_prefix_index()
+        with open(filename, 'wb') as f:
+            f.write(self._prefix_header() + _PREFIX_OFFSETS.pack(*offsets))
+
+    def _prefix_header(self):
+        stat = os.stat(self.filename)
+        return _PREFIX_HEADER.pack(_PREFIX_MAGIC, stat.st_size,
+                                   int(stat.st_mtime))
+
+    def _search(self, target, lo, hi):
+        # Binary search the lines between the byte offsets lo and hi
+        # (both at the start of a line) for the first line that
+        # doesn't sort before target.  Returns the offset of that line
+        # along with the line if it's an exact match.
+        data = self._mmap
+        while lo < hi:
+            mid = (lo + hi) // 2
+            newline = data.rfind(b'\n', lo, mid)
+            start = lo if newline == -1 else newline + 1
+            end = data.find(b'\n', start, hi)
+            if end == -1:
+                end = hi
+            key = data[start:start + HASH_SIZE]
+            if key < target:
+                lo = min(end + 1, hi)
+            elif key == target:
+                return start, data[start:end]
+            else:
+                hi = start
+        return lo, None
+
+
+def _normalize(sha1_hex):
+    if not isinstance(sha1_hex, bytes):
+        sha1_hex = sha1_hex.encode('ascii')
+    return sha1_hex.upper()
+
+
+def _line_count(line):
+    _, _, count = line.partition(b':')
+    count = count.strip()
+    if not count:
+        return 1
+    return int(count)
@@ -1,9 +1,65 @@
-import subprocess
+"""Copying text to the clipboard.
+
+Every copy is made by a helper process that's shared by all the ``kp``
+commands a user runs.  The first copy starts it, and it listens on a
+unix socket in the runtime directory (see ``keepassx.session``) until
+it has been idle for a while.  When a clipboard library is available
+the helper uses it directly, Tk on X11 and AppKit on macOS, so a copy
+doesn't start any new process.  Otherwise it runs xclip or pbcopy.
+
+On X11 the copied text is served by whoever owns the selection, so when
+the helper owns it, it keeps running until something else is copied.
+
+Platforms without unix sockets (Windows) copy directly, and start a
+helper that only lives until the clipboard is restored when
+``clear_after`` is used.
+
+"""
+import os
+import sys
+import json
+import time
+import errno
+import select
+import socket
 import platform
+import subprocess
+
+import six
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from keepassx.utils import private_directory, remove_file, runtime_path
+
+
+SOCKET_FILENAME = 'clipboard.sock'
+LOCK_FILENAME = 'clipboard.lock'
+# Seconds the helper waits for a request before exiting, unless it
+# still owns the clipboard contents or has a restore pending.
+IDLE_TIMEOUT = 10 * 60
+# Seconds to wait for a newly started helper to start listening.
+START_TIMEOUT = 5.0
+# Seconds to wait for the helper to answer a request.
+REPLY_TIMEOUT = 10.0
+
 
+def copy(text, clear_after=None):
+    """Copy text to the clipboard.
 
-def copy(text):
-    get_clipboard().copy(text)
+    If ``clear_after`` is given, the previous contents of the clipboard
+    are restored after that many seconds.  This is done by the helper
+    process so the caller doesn't have to wait around.
+
+    """
+    if hasattr(socket, 'AF_UNIX'):
+        get_helper().copy(text, clear_after=clear_after)
+    elif clear_after:
+        _start_restore_process(text, clear_after)
+    else:
+        get_clipboard().copy(text)
 
 
 def get_clipboard():
@@ -15,8 +71,39 @@ def get_clipboard():
     return platform_clipboard
 
 
+def get_native_clipboard():
+    """Return the clipboard the helper process copies with.
+
+    This is a clipboard library used in process when one is available,
+    and ``get_clipboard()`` otherwise.
+
+    """
+    system = platform.system()
+    try:
+        if system == 'Darwin':
+            return AppKitClipboard()
+        if system == 'Linux' and os.environ.get('DISPLAY'):
+            return TkClipboard()
+    except (ImportError, RuntimeError):
+        pass
+    return get_clipboard()
+
+
+def get_helper():
+    """Return the ClipboardHelper shared by this process."""
+    global _HELPER
+    if _HELPER is None:
+        _HELPER = ClipboardHelper()
+    return _HELPER
+
+
 class ClipBoard(object):
     COPY_PROCESS = []
+    PASTE_PROCESS = []
+    # Whether the copied text is lost when this process exits.
+    OWNS_SELECTION = False
+    # How often, in seconds, process_events() needs to be called.
+    EVENT_INTERVAL = None
 
     def copy(self, text):
         process = subprocess.Popen(self.COPY_PROCESS, stdin=subprocess.PIPE)
@@ -25,23 +112,390 @@ class ClipBoard(object):
             raise Exception("Couldn't copy text to clipboard.")
 
     def paste(self):
-        raise NotImplementedError("paste")
+        if not self.PASTE_PROCESS:
+            raise NotImplementedError("paste")
+        process = subprocess.Popen(self.PASTE_PROCESS,
+                                   stdout=subprocess.PIPE)
+        stdout = process.communicate()[0]
+        if process.returncode != 0:
+            raise Exception("Couldn't paste text from clipboard.")
+        return stdout.decode('utf-8')
+
+    def process_events(self):
+        pass
 
 
 class OSXClipBoard(ClipBoard):
     COPY_PROCESS = ['pbcopy']
+    PASTE_PROCESS = ['pbpaste']
 
 
 class LinuxClipboard(ClipBoard):
     COPY_PROCESS = ['xclip', '-selection', 'clipboard']
+    PASTE_PROCESS = ['xclip', '-selection', 'clipboard', '-o']
 
 
 class WindowsClipboard(ClipBoard):
     COPY_PROCESS = ['clip']
 
 
+class TkClipboard(ClipBoard):
+    """The X11 clipboard, through Tk.
+
+    The copied text is served to other applications by Tk's event loop,
+    so process_events() has to keep being called while it's on the
+    clipboard.
+
+    """
+    OWNS_SELECTION = True
+    EVENT_INTERVAL = 0.05
+
+    def __init__(self):
+        from six.moves import tkinter
+        self._error = tkinter.TclError
+        try:
+            self._root = tkinter.Tk()
+        except tkinter.TclError as e:
+            raise RuntimeError("Can't open the display: %s" % e)
+        self._root.withdraw()
+
+    def copy(self, text):
+        self._root.clipboard_clear()
+        self._root.clipboard_append(text)
+        self._root.update()
+
+    def paste(self):
+        try:
+            return self._root.clipboard_get()
+        except self._error:
+            # The clipboard is empty or doesn't hold text.
+            return u''
+
+    def process_events(self):
+        self._root.update()
+
+
+class AppKitClipboard(ClipBoard):
+    """The macOS pasteboard, through PyObjC."""
+    def __init__(self):
+        import AppKit
+        self._pasteboard = AppKit.NSPasteboard.generalPasteboard()
+        self._type = AppKit.NSPasteboardTypeString
+
+    def copy(self, text):
+        self._pasteboard.clearContents()
+        if not self._pasteboard.setString_forType_(text, self._type):
+            raise Exception("Couldn't copy text to clipboard.")
+
+    def paste(self):
+        return self._pasteboard.stringForType_(self._type) or u''
+
+
+class ClipboardHelper(object):
+    """Copy text through the shared helper process.
+
+    The helper is started the first time something is copied, and
+    reused by every copy after that, from this process or any other
+    ``kp`` command.  Copies return as soon as the helper has made them.
+
+    """
+    def __init__(self, directory=None):
+        self._directory = directory
+
+    def copy(self, text, clear_after=None):
+        reply = self._request({'command': 'copy', 'text': text,
+                               'clear_after': clear_after})
+        if not reply.get('ok'):
+            raise Exception("Couldn't copy text to clipboard: %s" %
+                            reply.get('error'))
+
+    def _request(self, message):
+        directory = self._directory or helper_dir()
+        path = os.path.join(directory, SOCKET_FILENAME)
+        data = json.dumps(message).encode('utf-8') + b'\n'
+        # A helper that has just decided to exit can drop a request,
+        # so the first failure starts a new helper and tries again.
+        for attempt in range(2):
+            try:
+                sock = _connect(path)
+            except socket.error:
+                _start_helper(directory)
+                sock = _wait_for_helper(path)
+            try:
+                sock.settimeout(REPLY_TIMEOUT)
+                sock.sendall(data)
+                line = _read_line(sock)
+            except socket.error:
+                line = b''
+            finally:
+                sock.close()
+            if line:
+                return json.loads(line.decode('utf-8'))
+        raise Exception("Couldn't copy text to clipboard.")
+
+
+class ClipboardServer(object):
+    """The helper side of ClipboardHelper.
+
+    When text is copied with ``clear_after``, whatever was on the
+    clipboard before is restored after that many seconds, unless
+    something else has been copied to the clipboard in the meantime.
+    Copies made while a restore is pending push it back, and the
+    contents from before the first copy are the ones that get restored.
+
+    Everything happens on one thread, as Tk has to be used from the
+    thread that created it.
+
+    """
+    def __init__(self, clipboard, clock=time.time):
+        self._clipboard = clipboard
+        self._clock = clock
+        self._restore_at = None
+        self._previous = None
+        self._current = None
+        # The last text this process put on the clipboard.
+        self._copied = None
+
+    @property
+    def pending(self):
+        return self._restore_at is not None
+
+    def handle(self, message):
+        if message.get('command') != 'copy':
+            raise ValueError("Unknown command: %s" % message.get('command'))
+        if self._restore_at is None:
+            self._previous = self._paste()
+        self._copy(message['text'])
+        self._current = message['text']
+        if message.get('clear_after'):
+            self._restore_at = self._clock() + message['clear_after']
+        else:
+            self._restore_at = None
+
+    def run_pending(self):
+        """Restore the clipboard if it's time to.
+
+        Returns the number of seconds until the pending restore, or
+        None if there isn't one.
+
+        """
+        if self._restore_at is None:
+            return None
+        remaining = self._restore_at - self._clock()
+        if remaining > 0:
+            return remaining
+        self._restore_at = None
+        contents = self._paste()
+        # If someone else has copied something since, leave it be.
+        if contents is None or contents == self._current:
+            self._copy(self._previous or u'')
+        self._previous = None
+        self._current = None
+        return None
+
+    def owns_clipboard(self):
+        """Whether the clipboard holds text only this process serves."""
+        return bool(self._clipboard.OWNS_SELECTION and self._copied and
+                    self._paste() == self._copied)
+
+    def serve(self, listener, idle_timeout=IDLE_TIMEOUT):
+        """Answer requests on a listening socket.
+
+        Returns once nothing has been requested for ``idle_timeout``
+        seconds, there's no restore pending and the clipboard isn't
+        being served by this process.
+
+        """
+        last_request = self._clock()
+        interval = self._clipboard.EVENT_INTERVAL
+        while True:
+            waits = [last_request + idle_timeout - self._clock(),
+                     self.run_pending(), interval]
+            timeout = max(0, min(w for w in waits if w is not None))
+            try:
+                readable = select.select([listener], [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            if readable:
+                self._answer(listener)
+                last_request = self._clock()
+            self._clipboard.process_events()
+            self.run_pending()
+            if (self._clock() - last_request >= idle_timeout and
+                    not self.pending):
+                if not self.owns_clipboard():
+                    return
+                last_request = self._clock()
+
+    def serve_stream(self, stream):
+        """Handle the JSON requests in stream, one per line.
+
+        Returns after the pending restore, if any.
+
+        """
+        for line in iter(stream.readline, b''):
+            self.handle(json.loads(line.decode('utf-8')))
+        while self.pending:
+            time.sleep(self.run_pending() or 0)
+
+    def _answer(self, listener):
+        try:
+            conn = listener.accept()[0]
+        except socket.error:
+            return
+        try:
+            conn.settimeout(REPLY_TIMEOUT)
+            line = _read_line(conn)
+            try:
+                self.handle(json.loads(line.decode('utf-8')))
+                reply = {'ok': True}
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def _copy(self, text):
+        self._clipboard.copy(text)
+        self._copied = text
+
+    def _paste(self):
+        try:
+            return self._clipboard.paste()
+        except Exception:
+            return None
+
+
+def helper_dir():
+    return private_directory(runtime_path())
+
+
+def run_helper(directory, clipboard=None, idle_timeout=IDLE_TIMEOUT):
+    """Serve copies on the socket in directory.
+
+    Returns straight away if another helper is already serving them.
+
+    """
+    path = os.path.join(directory, SOCKET_FILENAME)
+    with open(os.path.join(directory, LOCK_FILENAME), 'a') as lock:
+        if not _lock_helper(lock, path):
+            return
+        remove_file(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            listener.listen(16)
+            if clipboard is None:
+                clipboard = get_native_clipboard()
+            ClipboardServer(clipboard).serve(listener, idle_timeout)
+        finally:
+            # Removed while the lock is held, so it's never removed
+            # from under the next helper.
+            remove_file(path)
+            listener.close()
+
+
+def _lock_helper(lock, path):
+    # The lock is held by a helper for as long as it runs.  One that's
+    # exiting still holds it for a moment, so keep trying until either
+    # the lock is ours or another helper is answering on the socket.
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            pass
+        try:
+            _connect(path).close()
+            return False
+        except socket.error:
+            pass
+        if time.time() > deadline:
+            return False
+        time.sleep(0.02)
+
+
+def _new_session_args():
+    # The helper is started in its own session so it outlives the
+    # terminal kp runs in.  start_new_session is python 3 only.
+    if not six.PY2:
+        return {'start_new_session': True}
+    elif hasattr(os, 'setsid'):
+        return {'preexec_fn': os.setsid}
+    return {}
+
+
+def _start_helper(directory):
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-m', 'keepassx.clipboard', directory],
+            stdin=devnull, stdout=devnull, stderr=devnull,
+            close_fds=True, **_new_session_args())
+
+
+def _start_restore_process(text, clear_after):
+    with open(os.devnull, 'wb') as devnull:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'keepassx.clipboard', '-'],
+            stdin=subprocess.PIPE, stdout=devnull, stderr=devnull,
+            close_fds=True, **_new_session_args())
+    message = {'command': 'copy', 'text': text, 'clear_after': clear_after}
+    try:
+        process.stdin.write(json.dumps(message).encode('utf-8') + b'\n')
+        process.stdin.close()
+    except (IOError, OSError):
+        raise Exception("Couldn't copy text to clipboard.")
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def _wait_for_helper(path):
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        try:
+            return _connect(path)
+        except socket.error:
+            if time.time() > deadline:
+                raise Exception("Couldn't start the clipboard helper.")
+            time.sleep(0.02)
+
+
+def _read_line(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks)
+
+
 _PLATFORMS = {
     'Linux': LinuxClipboard,
     'Darwin': OSXClipBoard,
     'Windows': WindowsClipboard,
 }
+_HELPER = None
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == '-':
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        ClipboardServer(get_clipboard()).serve_stream(stdin)
+    else:
+        run_helper(sys.argv[1])
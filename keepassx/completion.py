@@ -0,0 +1,308 @@
+"""Shell completion of entry titles and uuids.
+
+Completing ``kp get <TAB>`` can't prompt for a password, so
+``kp complete`` answers from one of two places:
+
+* An unlocked session (see ``keepassx.session``), which is used to
+  open the database and read the titles and uuids of its entries.
+  They're kept with the session, sealed with its key, so the database
+  is only decrypted again once it changes, and they're removed along
+  with the session.
+* The completion cache, if it's enabled with ``--completion-cache``
+  or ``completion_cache: true`` in ``~/.kpconfig``.  Every ``kp``
+  command that opens the database refreshes the cache whenever the
+  database's contents hash has changed, and ``kp complete`` reads it
+  without the password.
+
+The cache holds only titles and uuids.  It's stored in
+``$XDG_CACHE_HOME/keepassx`` (``~/.cache/keepassx`` by default), which
+is only accessible by the current user, and it's encrypted and
+authenticated (see ``keepassx.utils.seal``) with a random secret
+stored in the same directory.  That keeps the titles private if the
+cache file is copied somewhere on its own, but anyone who can act as
+the current user can read them, which is why the cache is opt in.
+
+``kp completion bash`` and ``kp completion zsh`` print the scripts
+that hook ``kp complete`` into the shell::
+
+    eval "$(kp completion bash)"
+
+"""
+import os
+import hashlib
+
+from keepassx import session
+from keepassx.utils import read_file, write_private_file, seal, unseal
+from keepassx.utils import private_directory
+
+
+MAGIC = b'KPCOMP\x00\x01'
+CACHE_SUFFIX = '.completion'
+SECRET_FILENAME = 'secret'
+# The magic and the contents hash of the database, in the clear.
+_HEADER_SIZE = len(MAGIC) + 32
+
+BASH_SCRIPT = '''\
+_kp_complete() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" command="" i
+    local -a db_args
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            -d|--db-file|-k|--key-file)
+                db_args+=("${COMP_WORDS[i]}" "${COMP_WORDS[i+1]}")
+                ((i++)) ;;
+            --completion-cache) db_args+=("${COMP_WORDS[i]}") ;;
+            -*) ;;
+            *) [[ -z "$command" ]] && command="${COMP_WORDS[i]}" ;;
+        esac
+    done
+    if [[ -z "$command" ]]; then
+        COMPREPLY=($(compgen -W "%(commands)s" -- "$cur"))
+    elif [[ "$command" == get || "$command" == attachment ]]; then
+        local IFS=$'\\n'
+        compopt -o filenames 2>/dev/null
+        COMPREPLY=($(kp "${db_args[@]}" complete -- "$cur" 2>/dev/null))
+    else
+        COMPREPLY=($(compgen -f -- "$cur"))
+    fi
+}
+complete -F _kp_complete kp
+'''
+
+ZSH_SCRIPT = '''\
+_kp() {
+    local -a db_args candidates
+    local i command=""
+    for ((i = 2; i < CURRENT; i++)); do
+        case "${words[i]}" in
+            -d|--db-file|-k|--key-file)
+                db_args+=("${words[i]}" "${words[i+1]}")
+                ((i++)) ;;
+            --completion-cache) db_args+=("${words[i]}") ;;
+            -*) ;;
+            *) [[ -z "$command" ]] && command="${words[i]}" ;;
+        esac
+    done
+    if [[ -z "$command" ]]; then
+        compadd -- %(commands)s
+    elif [[ "$command" == (get|attachment) ]]; then
+        candidates=("${(@f)$(kp "${db_args[@]}" complete -- \\
+            "${words[CURRENT]}" 2>/dev/null)}")
+        compadd -- "${candidates[@]}"
+    else
+        _files
+    fi
+}
+compdef _kp kp
+'''
+
+SCRIPTS = {'bash': BASH_SCRIPT, 'zsh': ZSH_SCRIPT}
+
+
+def completion_script(shell, commands):
+    """Return the completion script for ``shell``."""
+    return SCRIPTS[shell] % {'commands': ' '.join(commands)}
+
+
+def cache_dir(create=True):
+    """Return the directory completion caches are stored in.
+
+    :raise: ValueError if the directory is accessible by other users.
+
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return private_directory(os.path.join(base, 'keepassx'), create)
+
+
+def cache_filename(directory, db_filename):
+    name = hashlib.sha256(
+        os.path.abspath(db_filename).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(directory, name + CACHE_SUFFIX)
+
+
+def entry_names(db):
+    """Return the (uuid, title) of every entry in ``db``.
+
+    If the entries haven't been decoded yet, only the uuid and title
+    fields are read from the payload.
+
+    """
+    return [(uuid, title or u'')
+            for uuid, title in db.scan_fields(['uuid', 'title'])]
+
+
+def candidates(names):
+    """Return the completion candidates for (uuid, title) pairs.
+
+    These are the titles, without duplicates or empty titles, sorted
+    ignoring case, and the sorted uuids.
+
+    """
+    titles = sorted(set(title.replace(u'\n', u' ')
+                        for _, title in names if title),
+                    key=lambda title: (title.lower(), title))
+    uuids = sorted(uuid for uuid, _ in names)
+    return titles, uuids
+
+
+def write_cache(db_filename, header, names):
+    """Store the completion candidates of a database."""
+    directory = cache_dir()
+    secret = _read_secret(directory, create=True)
+    write_private_file(cache_filename(directory, db_filename),
+                       _seal_names(secret, db_filename, header, names))
+
+
+def cached_contents_hash(db_filename):
+    """Return the contents hash the cache was written for, or None."""
+    try:
+        directory = cache_dir(create=False)
+    except (ValueError, OSError):
+        return None
+    if directory is None:
+        return None
+    try:
+        with open(cache_filename(directory, db_filename), 'rb') as f:
+            data = f.read(_HEADER_SIZE)
+    except (IOError, OSError):
+        return None
+    if len(data) != _HEADER_SIZE or not data.startswith(MAGIC):
+        return None
+    return data[len(MAGIC):]
+
+
+def read_cache(db_filename):
+    """Return the contents hash and the candidates stored for a database.
+
+    Returns None if there's no cache, or if it can't be
+    authenticated.  The caller decides whether a cache written for
+    another contents hash is still useful.
+
+    """
+    try:
+        directory = cache_dir(create=False)
+    except (ValueError, OSError):
+        return None
+    if directory is None:
+        return None
+    data = read_file(cache_filename(directory, db_filename))
+    secret = _read_secret(directory, create=False)
+    if data is None or secret is None:
+        return None
+    return _unseal_names(secret, db_filename, data)
+
+
+def write_session_cache(db_filename, header, transformed_key, names):
+    """Store the candidates read through an unlocked session.
+
+    They're sealed with the session's transformed key and removed
+    along with the session (see ``keepassx.session``), so unlike the
+    completion cache they don't need to be enabled.  Nothing is
+    stored if there's no session directory.
+
+    """
+    filename = session.session_cache_filename(db_filename)
+    if filename is not None:
+        write_private_file(filename, _seal_names(
+            transformed_key, db_filename, header, names))
+
+
+def read_session_cache(db_filename, header, transformed_key):
+    """Return the candidates stored by ``write_session_cache``.
+
+    Returns None if there are none for this version of the database.
+
+    """
+    filename = session.session_cache_filename(db_filename)
+    data = read_file(filename) if filename is not None else None
+    if data is None:
+        return None
+    cached = _unseal_names(transformed_key, db_filename, data)
+    if cached is None or cached[0] != header.contents_hash:
+        return None
+    return cached[1]
+
+
+def refresh_cache(db_filename, header, db, names=None):
+    """Rewrite the cache if it wasn't written for this version of the
+    database.  Returns True if it was rewritten.
+
+    ``names`` are the candidates of ``db``, if the caller already has
+    them.
+
+    """
+    if cached_contents_hash(db_filename) == header.contents_hash:
+        return False
+    if names is None:
+        names = candidates(entry_names(db))
+    write_cache(db_filename, header, names)
+    return True
+
+
+def complete(names, prefix):
+    """Return the titles, then the uuids, that start with ``prefix``.
+
+    ``names`` are the candidates returned by ``candidates``.  Titles
+    are matched ignoring case.
+
+    """
+    titles, uuids = names
+    prefix = prefix.lower()
+    return _starting_with(titles, prefix) + _starting_with(uuids, prefix)
+
+
+def _starting_with(items, prefix):
+    # The items are sorted by their lower cased value, so the ones
+    # that start with the prefix are next to each other.
+    start = _bisect(items, lambda item: item.lower() < prefix)
+    end = _bisect(items,
+                  lambda item: item.lower()[:len(prefix)] <= prefix)
+    return items[start:end]
+
+
+def _bisect(items, is_before):
+    # The index of the first item ``is_before`` is false for.
+    low, high = 0, len(items)
+    while low < high:
+        middle = (low + high) // 2
+        if is_before(items[middle]):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _read_secret(directory, create):
+    filename = os.path.join(directory, SECRET_FILENAME)
+    secret = read_file(filename)
+    if secret is None and create:
+        secret = os.urandom(32)
+        write_private_file(filename, secret)
+    return secret
+
+
+def _seal_names(key, db_filename, header, names):
+    titles, uuids = names
+    # The titles, an empty line, then the uuids.  They're stored
+    # sorted so completing doesn't have to sort them again.
+    plaintext = u'\n'.join(titles + [u''] + uuids).encode('utf-8')
+    return seal(key, plaintext, header=MAGIC + header.contents_hash,
+                associated_data=_path_bytes(db_filename))
+
+
+def _unseal_names(key, db_filename, data):
+    # Returns the contents hash and the candidates.
+    if not data.startswith(MAGIC):
+        return None
+    plaintext = unseal(key, data, _HEADER_SIZE, _path_bytes(db_filename))
+    if plaintext is None:
+        return None
+    lines = plaintext.decode('utf-8').split(u'\n')
+    separator = lines.index(u'')
+    return (data[len(MAGIC):_HEADER_SIZE],
+            (lines[:separator], lines[separator + 1:]))
+
+
+def _path_bytes(db_filename):
+    return os.path.abspath(db_filename).encode('utf-8')
@@ -1,41 +1,540 @@
+import io
 import sys
+import time
+import ctypes
 import struct
+import multiprocessing
 import hashlib
 import datetime
 import binascii
 import difflib
 from pprint import pformat
+from collections import OrderedDict
 
 from Crypto.Cipher import AES
 from six.moves import xrange
+from multiprocessing.pool import ThreadPool
 from six import integer_types
 
+from keepassx import instrument
+from keepassx.urlindex import DomainIndex
+from keepassx.timeindex import TimeIndex
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Before python 3.8 each process is sent its part of the
+    # payload instead, see parse_entries_parallel().
+    shared_memory = None
 
 if sys.version_info[0] == 2:
     TEXT_TYPE = unicode
 else:
     TEXT_TYPE = str
 SYSTEM_USER_UUID = '00000000000000000000000000000000'
+# This is how keepassx represents an expiration time of "never".
+NEVER_EXPIRES = datetime.datetime(2999, 12, 28, 23, 59, 59)
+# Marks record fields that are skipped when parsing.
+IGNORED_FIELD = object()
 # It's worth noting that keepassx has logic to try
 # encoding the password as both latin1 and utf-8
-# if this encoding doesn't work.  We aren't implementing
-# that logic here as all modern keepassx versions just
-# use cp1252.
+# if this encoding doesn't work.  All modern keepassx
+# versions use cp1252, but databases created by other
+# tools may not, see password_candidates().
 KP_PASSWORD_ENCODING = 'cp1252'
+PASSWORD_ENCODINGS = (KP_PASSWORD_ENCODING, 'latin1', 'utf-8')
+# The field type and size every group record starts with, after any
+# ignored (0x0) fields.
+_FIRST_FIELD = (0x1, 4)
+_FIELD_HEADER = struct.Struct('<HI')
+# The key encryption rounds are run in chunks of this many rounds,
+# progress is reported and cancellation is checked between chunks.
+KEY_TRANSFORM_CHUNK = 1 << 16
+# How often, in seconds, the progress of key transforms running in
+# other processes is checked.
+_PROGRESS_INTERVAL = 0.1
 
 
 class EntryNotFoundError(Exception):
     pass
 
 
+class GroupNotFoundError(Exception):
+    pass
+
+
 class InvalidPasswordError(Exception):
     pass
 
 
-def encode_password(password):
+class InvalidDatabaseError(Exception):
+    pass
+
+
+class UnsupportedDatabaseError(InvalidDatabaseError):
+    """The database uses a cipher or format that isn't supported."""
+    pass
+
+
+class KeyDerivationCancelledError(Exception):
+    pass
+
+
+class KeyDerivationTimeoutError(KeyDerivationCancelledError):
+    pass
+
+
+def calculate_key(password, key_file_contents, seed1, seed2, num_rounds,
+                  progress=None, deadline=None, cancel=None):
+    """Derive the final key used to decrypt the payload of a KDB file.
+
+    See ``KeyTransform.run`` for ``progress``, ``deadline`` and
+    ``cancel``.
+
+    """
+    key = composite_key(password, key_file_contents)
+    return derive_final_key(seed1, transform_key(
+        key, seed2, num_rounds, progress, deadline, cancel))
+
+
+def composite_key(password, key_file_contents):
+    """Combine the password and key file into the user's master key."""
+    # Based on Kdb3Database::setCompositeKey and Kdb3Database::loadReal.
+    key = hashlib.sha256(password).digest()
+    if key_file_contents is not None:
+        file_key_hash = key_file_key(key_file_contents)
+        if password == b"":
+            key = file_key_hash
+        else:
+            key = hashlib.sha256(key + file_key_hash).digest()
+    return key
+
+
+def key_file_key(key_file_contents):
+    """Return the 32 byte key stored in a key file."""
+    # The key derivation also supports a few extra modes, if the key
+    # file is 32 bytes, use that directly instead of taking the sha256
+    # of the contents, if it's 64 bits, assume it's hex encoded and
+    # decode and use the contents directly instead of taking the sha256
+    # hash.
+    if len(key_file_contents) == 64:
+        # Then the key file contents is treated as hex and we
+        # use the converted-to-binary contents as the file
+        # key hash.
+        return binascii.unhexlify(key_file_contents)
+    elif len(key_file_contents) == 32:
+        return key_file_contents
+    return hashlib.sha256(key_file_contents).digest()
+
+
+def transform_key(key, seed2, num_rounds, progress=None, deadline=None,
+                  cancel=None):
+    """Apply the key encryption rounds to a composite key.
+
+    This is the expensive part of the key derivation.  The result only
+    depends on the composite key and the header's ``master_seed2`` and
+    ``key_encryption_rounds``.  See ``KeyTransform.run`` for
+    ``progress``, ``deadline`` and ``cancel``.
+
+    """
+    return KeyTransform(key, seed2, num_rounds).run(progress, deadline,
+                                                    cancel)
+
+
+class KeyTransform(object):
+    """The key encryption rounds of a composite key, run in slices.
+
+    ``step()`` runs a slice of the rounds and returns, so a caller that
+    can't block for the whole key derivation, such as an event loop,
+    can run the rounds a slice at a time::
+
+        transform = KeyTransform(key, header.master_seed2,
+                                 header.key_encryption_rounds)
+        while not transform.step():
+            pass  # Handle other work here.
+        final_key = derive_final_key(header.master_seed,
+                                     transform.result())
+        db = Database(contents, final_key=final_key)
+
+    ``run()`` runs the remaining rounds with progress reporting, a
+    deadline and cancellation.  A transform that was stopped can be
+    resumed by calling ``run()`` or ``step()`` again.
+
+    """
+    def __init__(self, key, seed2, num_rounds):
+        self.num_rounds = num_rounds
+        self.rounds_done = 0
+        self._seed2 = seed2
+        # Each block of the key is encrypted on its own.
+        self._blocks = [key[i:i + AES.block_size]
+                        for i in xrange(0, len(key), AES.block_size)]
+
+    @property
+    def done(self):
+        return self.rounds_done >= self.num_rounds
+
+    def step(self, rounds=KEY_TRANSFORM_CHUNK):
+        """Run up to ``rounds`` more rounds.
+
+        Returns True once all of the rounds have run.
+
+        """
+        rounds = min(rounds, self.num_rounds - self.rounds_done)
+        if rounds > 0:
+            # Encrypting a block n times with ECB is the same as
+            # encrypting n zero blocks with CBC using the block as the
+            # IV, as each ciphertext block is then the encryption of
+            # the one before it.  That runs a chunk of rounds in a
+            # single call instead of a call per round.
+            zeros = b'\x00' * (AES.block_size * rounds)
+            self._blocks = [
+                AES.new(self._seed2, AES.MODE_CBC, block).encrypt(
+                    zeros)[-AES.block_size:]
+                for block in self._blocks]
+            self.rounds_done += rounds
+        return self.done
+
+    def result(self):
+        """Return the transformed key once all of the rounds have run."""
+        if not self.done:
+            raise ValueError("%s key encryption rounds haven't run yet."
+                             % (self.num_rounds - self.rounds_done))
+        return hashlib.sha256(b''.join(self._blocks)).digest()
+
+    def run(self, progress=None, deadline=None, cancel=None):
+        """Run the remaining rounds and return the transformed key.
+
+        :param progress: Called with the number of rounds that have
+            run and the total number of rounds after each chunk.
+        :param deadline: A ``time.time()`` value to give up at.
+        :param cancel: Something like a ``threading.Event``, the key
+            derivation stops once its ``is_set()`` returns True.
+        :raise: KeyDerivationTimeoutError if the deadline passes and
+            KeyDerivationCancelledError if ``cancel`` is set.
+
+        """
+        while not self.done:
+            _check_interrupted(deadline, cancel)
+            self.step()
+            if progress is not None:
+                progress(self.rounds_done, self.num_rounds)
+        return self.result()
+
+
+def _check_interrupted(deadline, cancel):
+    if cancel is not None and cancel.is_set():
+        raise KeyDerivationCancelledError("Key derivation was cancelled.")
+    if deadline is not None and time.time() >= deadline:
+        raise KeyDerivationTimeoutError(
+            "Key derivation didn't finish before the deadline.")
+
+
+def derive_final_key(seed1, transformed_key):
+    return hashlib.sha256(seed1 + transformed_key).digest()
+
+
+def transform_keys(keys, seed2, num_rounds, processes=None, progress=None,
+                   deadline=None, cancel=None):
+    """Apply the key encryption rounds to several composite keys.
+
+    The keys are transformed concurrently in separate processes, one
+    per core, and ``(index, transformed_key)`` pairs are yielded in
+    the order they finish.  Stopping the iteration early terminates
+    the transforms that haven't finished.  ``progress`` is given the
+    rounds done and the total rounds across all of the keys, see
+    ``KeyTransform.run`` for the other arguments.
+
+    """
+    return _transform_jobs(
+        [(i, key, seed2, num_rounds) for i, key in enumerate(keys)],
+        processes, progress, deadline, cancel)
+
+
+def _transform_jobs(jobs, processes=None, progress=None, deadline=None,
+                    cancel=None):
+    # Each job is a tuple of (id, key, seed2, num_rounds), and
+    # (id, transformed_key) pairs are yielded as they finish.
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    total_rounds = sum(job[3] for job in jobs)
+    if processes <= 1:
+        rounds_finished = 0
+        for i, key, seed2, num_rounds in jobs:
+            yield i, transform_key(
+                key, seed2, num_rounds,
+                _offset_progress(progress, rounds_finished, total_rounds),
+                deadline, cancel)
+            rounds_finished += num_rounds
+        return
+    # The workers count the rounds they've run in shared memory, so
+    # the progress can be reported from this process.
+    rounds_done = multiprocessing.Array(ctypes.c_uint64, len(jobs),
+                                        lock=False)
+    pool = multiprocessing.Pool(processes, _init_transform_worker,
+                                (rounds_done,))
+    try:
+        results = pool.imap_unordered(_transform_key_job, enumerate(jobs))
+        while True:
+            try:
+                result = results.next(timeout=_PROGRESS_INTERVAL)
+            except multiprocessing.TimeoutError:
+                _check_interrupted(deadline, cancel)
+                if progress is not None:
+                    progress(sum(rounds_done), total_rounds)
+                continue
+            except StopIteration:
+                return
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _offset_progress(progress, offset, total):
+    # Report a single key's progress as part of several keys'.
+    if progress is None:
+        return None
+
+    def job_progress(rounds_done, _):
+        progress(offset + rounds_done, total)
+    return job_progress
+
+
+# The shared rounds done counters, in a worker process.
+_worker_rounds_done = None
+
+
+def _init_transform_worker(rounds_done):
+    global _worker_rounds_done
+    _worker_rounds_done = rounds_done
+
+
+def _transform_key_job(args):
+    position, (i, key, seed2, num_rounds) = args
+
+    def progress(rounds_done, _):
+        _worker_rounds_done[position] = rounds_done
+    return i, transform_key(key, seed2, num_rounds, progress)
+
+
+def derive_key(header, ciphertext, passwords, key_file_contents=None,
+               processes=None, progress=None, deadline=None, cancel=None):
+    """Find the key for a database from a list of candidate passwords.
+
+    The keys for every candidate are derived concurrently (see
+    transform_keys()) and the first one that passes
+    check_final_key() is used, so trying several encodings of a
+    password takes no longer than trying one on a multi core machine.
+
+    Returns a tuple of the transformed key and the final key.  See
+    transform_keys() for ``progress``, ``deadline`` and ``cancel``.
+
+    :raise: InvalidPasswordError if none of the passwords match.
+
+    """
+    keys = [composite_key(password, key_file_contents)
+            for password in passwords]
+    error = None
+    transformed = transform_keys(keys, header.master_seed2,
+                                 header.key_encryption_rounds, processes,
+                                 progress, deadline, cancel)
+    try:
+        for _, transformed_key in transformed:
+            final_key = derive_final_key(header.master_seed, transformed_key)
+            try:
+                check_final_key(header, ciphertext, final_key)
+            except InvalidPasswordError as e:
+                error = e
+                continue
+            return transformed_key, final_key
+    finally:
+        transformed.close()
+    raise error
+
+
+def open_databases(contents_list, passwords, key_file_contents=None,
+                   processes=None):
+    """Open several databases that share a password.
+
+    The key derivations for every database and candidate password (see
+    password_candidates()) run concurrently, as with derive_key().
+
+    :raise: InvalidPasswordError if a database can't be opened with
+        any of the passwords.
+
+    """
+    headers = [Header(contents[:Header.HEADER_SIZE])
+               for contents in contents_list]
+    keys = [composite_key(password, key_file_contents)
+            for password in passwords]
+    jobs = [((i, j), key, header.master_seed2, header.key_encryption_rounds)
+            for i, header in enumerate(headers)
+            for j, key in enumerate(keys)]
+    final_keys = [None] * len(contents_list)
+    transformed = _transform_jobs(jobs, processes)
+    try:
+        for (i, _), transformed_key in transformed:
+            if final_keys[i] is not None:
+                continue
+            final_key = derive_final_key(headers[i].master_seed,
+                                         transformed_key)
+            try:
+                check_final_key(headers[i],
+                                contents_list[i][Header.HEADER_SIZE:],
+                                final_key)
+            except InvalidPasswordError:
+                continue
+            final_keys[i] = final_key
+            if None not in final_keys:
+                break
+    finally:
+        transformed.close()
+    if None in final_keys:
+        raise InvalidPasswordError(
+            "Decryption failed, no password matches database %s."
+            % final_keys.index(None))
+    return [Database(contents, final_key=final_key)
+            for contents, final_key in zip(contents_list, final_keys)]
+
+
+def check_final_key(header, ciphertext, final_key):
+    """Check a key against a database without decrypting the payload.
+
+    :raise: InvalidPasswordError if the key is wrong.
+
+    """
+    if not ciphertext or len(ciphertext) % AES.block_size:
+        raise InvalidDatabaseError(
+            "Database is truncated, encrypted payload has an "
+            "invalid size: %s" % len(ciphertext))
+    # With CBC, the last plaintext block only depends on the last
+    # two ciphertext blocks, so we can check that the padding
+    # is valid without decrypting the whole payload.  A wrong key
+    # produces invalid padding the vast majority of the time.
+    iv = header.encryption_iv
+    if len(ciphertext) > AES.block_size:
+        iv = ciphertext[-2 * AES.block_size:-AES.block_size]
+    last_block = bytearray(AES.new(final_key, AES.MODE_CBC, iv).decrypt(
+        ciphertext[-AES.block_size:]))
+    extra = last_block[-1]
+    if not 1 <= extra <= AES.block_size or \
+            last_block[-extra:] != bytearray([extra]) * extra:
+        raise InvalidPasswordError(
+            "Decryption failed, invalid padding.")
+    # The first group starts with its groupid field, which catches
+    # nearly all of the remaining wrong keys.  Ignored fields can come
+    # before it, those are skipped by decrypting just the blocks that
+    # hold the next field header.  Anything left is caught by the
+    # checksum.
+    if header.num_groups:
+        i = 0
+        while True:
+            if i + _FIELD_HEADER.size > len(ciphertext):
+                raise InvalidPasswordError(
+                    "Decryption failed, invalid first record.")
+            field = _FIELD_HEADER.unpack(decrypt_range(
+                final_key, header.encryption_iv, ciphertext,
+                i, i + _FIELD_HEADER.size))
+            if field[0] != 0x0:
+                break
+            i += _FIELD_HEADER.size + field[1]
+        if field != _FIRST_FIELD:
+            raise InvalidPasswordError(
+                "Decryption failed, invalid first record.")
+
+
+def decrypt_cbc(key, iv, ciphertext, workers=None):
+    """Decrypt AES-CBC ciphertext using multiple threads.
+
+    Each CBC plaintext block only depends on its own ciphertext block
+    and the one before it, so the ciphertext is split into block
+    aligned chunks that are decrypted concurrently, using the last
+    ciphertext block of the previous chunk as the IV of the next.  The
+    AES implementation releases the GIL so the chunks are decrypted in
+    parallel.
+
+    Returns a bytearray of the plaintext (including any padding).
+
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    size = len(ciphertext)
+    if not size:
+        return bytearray()
+    num_blocks = size // AES.block_size
+    chunk_size = -(-num_blocks // workers) * AES.block_size
+    output = bytearray(size)
+    ciphertext_view = memoryview(ciphertext)
+    output_view = memoryview(output)
+
+    def _decrypt_chunk(start):
+        end = min(start + chunk_size, size)
+        if start == 0:
+            chunk_iv = iv
+        else:
+            chunk_iv = ciphertext[start-AES.block_size:start]
+        decryptor = AES.new(key, AES.MODE_CBC, chunk_iv)
+        try:
+            decryptor.decrypt(ciphertext_view[start:end],
+                              output=output_view[start:end])
+        except TypeError:
+            # Older versions of pycrypto don't support decrypting
+            # into an existing buffer.
+            output[start:end] = decryptor.decrypt(ciphertext[start:end])
+
+    pool = ThreadPool(workers)
+    try:
+        pool.map(_decrypt_chunk, range(0, size, chunk_size))
+    finally:
+        pool.close()
+        pool.join()
+    return output
+
+
+def decrypt_range(key, iv, ciphertext, start, end):
+    """Decrypt the plaintext bytes from ``start`` to ``end``.
+
+    Only the CBC blocks that overlap the range are decrypted, using the
+    ciphertext block before the first of them (or ``iv``) as the IV.
+
+    """
+    first = start - start % AES.block_size
+    last = min(end + -end % AES.block_size, len(ciphertext))
+    if first == 0:
+        block_iv = iv
+    else:
+        block_iv = ciphertext[first-AES.block_size:first]
+    decryptor = AES.new(key, AES.MODE_CBC, block_iv)
+    plaintext = decryptor.decrypt(ciphertext[first:last])
+    return plaintext[start-first:end-first]
+
+
+def encode_password(password, encoding=KP_PASSWORD_ENCODING):
     # keepassx uses cp1252 encoding for its password
     # so we need to ensure that the password is encoded
     # as this.
+    return _password_text(password).encode(encoding, 'replace')
+
+
+def password_candidates(password):
+    """Return the distinct encodings of a password keepassx may have used.
+
+    The first candidate is always ``encode_password(password)``.  Pass
+    the result as the ``password`` of a Database to open it with
+    whichever encoding matches.
+
+    """
+    password = _password_text(password)
+    candidates = []
+    for encoding in PASSWORD_ENCODINGS:
+        candidate = password.encode(encoding, 'replace')
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+
+def _password_text(password):
     if not isinstance(password, TEXT_TYPE):
         # We'll need to decode back into text and then
         # encode to bytes.
@@ -47,7 +546,224 @@ def encode_password(password):
         if encoding is None:
             encoding = 'utf-8'
         password = password.decode(encoding)
-    return password.encode(KP_PASSWORD_ENCODING, 'replace')
+    return password
+
+
+def record_offsets(payload, start, count):
+    """Find where each of ``count`` records from ``start`` begins.
+
+    Only the field headers are read, each field's data is skipped
+    over.  Returns a list of ``count + 1`` offsets, the last one being
+    the end of the last record.
+
+    """
+    unpack_from = _FIELD_HEADER.unpack_from
+    offsets = []
+    i = start
+    for _ in xrange(count):
+        offsets.append(i)
+        while True:
+            field_type, field_size = unpack_from(payload, i)
+            i += 6 + field_size
+            if field_type == 0xFFFF:
+                break
+    offsets.append(i)
+    return offsets
+
+
+def parse_entries_parallel(payload, start, num_entries, processes=None,
+                           string_pool=None):
+    """Decode the entry records in a payload using a process per core.
+
+    The record boundaries are found first (see ``record_offsets()``),
+    then the records are split into one contiguous chunk per process
+    and the chunks are decoded concurrently.  The payload is shared
+    with the processes through shared memory where it's available
+    (python 3.8+), otherwise each process is sent its chunk.
+
+    Returns a tuple of the entries, in the same order and with the
+    same values as ``PayloadParser`` would decode them, and the number
+    of fields decoded.  Attachments refer to ``payload``.  If a
+    ``string_pool`` is given, the fields in ``Database.POOLED_FIELDS``
+    are interned in it as the entries are merged, so they're shared
+    across chunks and counted in its hits and misses just as if
+    they'd been decoded here.
+
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    with instrument.timed('find_records'):
+        offsets = record_offsets(payload, start, num_entries)
+    processes = max(1, min(processes, num_entries))
+    bounds = [num_entries * i // processes for i in range(processes + 1)]
+    shm = None
+    if shared_memory is not None and len(payload):
+        shm = shared_memory.SharedMemory(create=True, size=len(payload))
+        shm.buf[:len(payload)] = payload
+    jobs = []
+    for first, last in zip(bounds, bounds[1:]):
+        chunk_start, chunk_end = offsets[first], offsets[last]
+        if shm is not None:
+            jobs.append((shm.name, None, chunk_start, chunk_end,
+                         last - first))
+        else:
+            jobs.append((None, bytes(payload[chunk_start:chunk_end]),
+                         chunk_start, chunk_end, last - first))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_parse_entries_job, jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    entries = []
+    fields_decoded = 0
+    names = _entry_attributes()
+    pooled = []
+    if string_pool is not None:
+        pooled = [name for name in names if name in Database.POOLED_FIELDS]
+    new_entry = Entry.__new__
+    with instrument.timed('merge_entries'):
+        for rows, chunk_fields_decoded in results:
+            for row in rows:
+                entry = new_entry(Entry)
+                entry.__dict__.update(zip(names, row))
+                for name in pooled:
+                    value = entry.__dict__[name]
+                    if value is not None:
+                        entry.__dict__[name] = string_pool.intern(value)
+                if entry.attachment is not None:
+                    offset, length = entry.attachment
+                    if length:
+                        entry.attachment = Attachment(payload, offset,
+                                                      length)
+                    else:
+                        entry.attachment = Attachment(b'', 0, 0)
+                entries.append(entry)
+            fields_decoded += chunk_fields_decoded
+    return entries, fields_decoded
+
+
+def _entry_attributes():
+    return tuple(sorted(vars(Entry())))
+
+
+def _parse_entries_job(args):
+    shm_name, data, start, end, count = args
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            data = bytes(shm.buf[start:end])
+        finally:
+            shm.close()
+    parser = PayloadParser(data, StringPool())
+    names = _entry_attributes()
+    rows = []
+    i = 0
+    for _ in xrange(count):
+        entry, i = parser.parse_entry(i)
+        if entry.uuid == SYSTEM_USER_UUID:
+            continue
+        # Offsets are relative to the chunk, and attachments are
+        # sent back as their location rather than a copy of the data.
+        entry.record_span = (entry.record_span[0] + start,
+                             entry.record_span[1])
+        if entry.attachment is not None:
+            entry.attachment = (entry.attachment.offset + start,
+                                entry.attachment.length)
+        # Tuples of builtin types are much cheaper to send back
+        # than Entry objects.
+        rows.append(tuple(getattr(entry, name) for name in names))
+    return rows, parser.fields_decoded
+
+
+class BaseType(object):
+    @staticmethod
+    def decode(payload):
+        return payload
+
+    @staticmethod
+    def encode(value):
+        return bytes(value)
+
+
+class UUIDType(object):
+    @staticmethod
+    def decode(payload):
+        return binascii.b2a_hex(payload).decode('utf-8').replace('\0', '')
+
+    @staticmethod
+    def encode(value):
+        return binascii.unhexlify(value)
+
+
+class StringType(BaseType):
+    @staticmethod
+    def decode(payload):
+        # Strings are null terminated.  The terminator is sliced off
+        # the bytes rather than removed from the decoded string, which
+        # would make a second copy.
+        if payload.endswith(b'\0'):
+            payload = payload[:-1]
+        value = payload.decode('utf-8')
+        if u'\0' in value:
+            value = value.replace(u'\0', u'')
+        return value
+
+    @staticmethod
+    def encode(value):
+        return value.encode('utf-8') + b'\0'
+
+
+class IntegerType(BaseType):
+    @staticmethod
+    def decode(payload):
+        return struct.unpack('<I', payload)[0]
+
+    @staticmethod
+    def encode(value):
+        return struct.pack('<I', value)
+
+
+class ShortType(BaseType):
+    @staticmethod
+    def decode(payload):
+        return struct.unpack("<H", payload)[0]
+
+    @staticmethod
+    def encode(value):
+        return struct.pack('<H', value)
+
+
+class DateType(BaseType):
+    @staticmethod
+    def decode(payload):
+        # Little endian 5 unsigned chars.
+        # Based off of keepassx 0.4.3 source:
+        # Kdb3Database.cpp: Kdb3Database::dateFromPackedStruct5
+        uchar = struct.unpack('<5B', payload)
+        year = (uchar[0] << 6) | (uchar[1] >> 2)
+        month = ((uchar[1] & 0x00000003) << 2) | (uchar[2] >> 6)
+        day = (uchar[2] >> 1) & 0x0000001F
+        hour = ((uchar[2] & 0x00000001) << 4) | (uchar[3] >> 4)
+        minutes = ((uchar[3] & 0x0000000F) << 2) | (uchar[4] >> 6)
+        seconds = uchar[4] & 0x0000003F
+        return datetime.datetime(year, month, day, hour, minutes, seconds)
+
+    @staticmethod
+    def encode(value):
+        # The inverse of decode(), based off of keepassx 0.4.3 source:
+        # Kdb3Database.cpp: Kdb3Database::dateToPackedStruct5
+        return struct.pack(
+            '<5B',
+            (value.year >> 6) & 0x0000003F,
+            ((value.year & 0x0000003F) << 2) | ((value.month >> 2) & 0x3),
+            ((value.month & 0x00000003) << 6) |
+            ((value.day & 0x0000001F) << 1) | ((value.hour >> 4) & 0x1),
+            ((value.hour & 0x0000000F) << 4) | ((value.minute >> 2) & 0xF),
+            ((value.minute & 0x00000003) << 6) | (value.second & 0x3F))
 
 
 class Header(object):
@@ -102,6 +818,10 @@ class Header(object):
         ('key_encryption_rounds', 4, 'I'),
     ]
     HEADER_SIZE = sum(_s[1] for _s in STRUCTURE)
+    SIGNATURE1 = 0x9AA2D903
+    SIGNATURE2 = 0xB54BFB65
+    # The version written by keepassx 0.4.x.
+    VERSION = 0x00030002
 
     ENCRYPTION_TYPES = [
         ('SHA2', 1),
@@ -123,7 +843,21 @@ class Header(object):
         self.contents_hash = None
         self.master_seed2 = None
         self.key_encryption_rounds = None
+        if len(contents) < self.HEADER_SIZE:
+            raise InvalidDatabaseError(
+                "File is too small to be a KeePassX database.")
         self._populate_fields(contents)
+        self._validate()
+
+    def _validate(self):
+        if self.signature1 != self.SIGNATURE1 or \
+                self.signature2 != self.SIGNATURE2:
+            raise InvalidDatabaseError(
+                "File is not a KeePassX database, bad signature.")
+        # Same as keepassx, only the build number is allowed to differ.
+        if self.version & 0xFFFFFF00 != self.VERSION & 0xFFFFFF00:
+            raise InvalidDatabaseError(
+                "Unsupported database version: 0x%x" % self.version)
 
     def _populate_fields(self, contents):
         index = 0
@@ -145,190 +879,700 @@ class Header(object):
 
 class Database(object):
     """Database representing a KDB file."""
-    def __init__(self, contents, password=None, key_file_contents=None):
+
+    # Payloads at least this large are decrypted using
+    # a thread per core, see decrypt_cbc().
+    PARALLEL_DECRYPT_THRESHOLD = 16 * 1024 * 1024
+    # The number of threads used for parallel decryption,
+    # defaults to the number of cores.
+    DECRYPT_WORKERS = None
+    # Databases with at least this many entries have their entries
+    # decoded using a process per core, see parse_entries_parallel().
+    # The strings in POOLED_FIELDS are interned in the string pool
+    # when the workers' results are merged.
+    PARALLEL_PARSE_THRESHOLD = 200000
+    # The number of processes used for parallel parsing, defaults to
+    # the number of cores.  Parsing is serial with a single core.
+    PARSE_PROCESSES = None
+
+    # The field types of the group and entry records in the
+    # payload, mapped to the attribute name and type used to decode
+    # them.  A name of None marks the end of a record.
+    GROUP_TYPES = {
+        0x0: ('ignored', BaseType),
+        0x1: ('groupid', IntegerType),
+        0x2: ('group_name', StringType),
+        0x3: (IGNORED_FIELD, DateType),
+        0x4: (IGNORED_FIELD, DateType),
+        0x5: (IGNORED_FIELD, DateType),
+        0x6: (IGNORED_FIELD, DateType),
+        0x7: ('imageid', IntegerType),
+        0x8: ('level', ShortType),
+        0x9: ('flags', IntegerType),
+        0xFFFF: (None, None),
+    }
+    ENTRY_TYPES = {
+        0x0: ('ignored', BaseType),
+        0x1: ('uuid', UUIDType),
+        0x2: ('groupid', IntegerType),
+        0x3: ('imageid', IntegerType),
+        0x4: ('title', StringType),
+        0x5: ('url', StringType),
+        0x6: ('username', StringType),
+        0x7: ('password', StringType),
+        0x8: ('notes', StringType),
+        0x9: ('creation_time', DateType),
+        0xa: ('last_mod_time', DateType),
+        0xb: ('last_acc_time', DateType),
+        0xc: ('expiration_time', DateType),
+        0xd: ('binary_desc', StringType),
+        # Attachments aren't decoded, see PayloadParser.parse_entry.
+        0xe: ('attachment', None),
+        0xFFFF: (None, None),
+    }
+    # The string fields that are likely to repeat, which are decoded
+    # through a StringPool.  Passwords are never pooled so they aren't
+    # shared between entries or databases.
+    POOLED_FIELDS = frozenset(['group_name', 'username', 'url'])
+    # The entry fields compared by diff().  The uuid is what entries
+    # are matched on, and the last access time changes whenever an
+    # entry is looked at so it's ignored.
+    DIFF_FIELDS = frozenset([0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0x8, 0x9, 0xa,
+                             0xc, 0xd, 0xe])
+    # The file format.  diff() only compares databases of the same
+    # format.
+    FORMAT = 'kdb'
+
+    def __init__(self, contents, password=None, key_file_contents=None,
+                 final_key=None, string_pool=None):
+        # ``password`` can also be a list of candidate passwords, see
+        # password_candidates().  Everything that can be checked
+        # without the key is checked before the (potentially slow)
+        # key derivation.
         self.metadata = Header(contents[:Header.HEADER_SIZE])
+        ciphertext = contents[Header.HEADER_SIZE:]
+        self._check_encryption_type(self.metadata.encryption_type)
+        if not ciphertext or len(ciphertext) % AES.block_size:
+            raise InvalidDatabaseError(
+                "Database is truncated, encrypted payload has an "
+                "invalid size: %s" % len(ciphertext))
+        if final_key is not None:
+            # The caller has already derived the key, see
+            # calculate_key().
+            key = final_key
+            check_final_key(self.metadata, ciphertext, key)
+        elif isinstance(password, (list, tuple)):
+            with instrument.timed('calculate_key'):
+                key = derive_key(self.metadata, ciphertext, password,
+                                 key_file_contents)[1]
+        else:
+            with instrument.timed('calculate_key'):
+                key = self._calculate_key(
+                    password, key_file_contents,
+                    self.metadata.master_seed,
+                    self.metadata.master_seed2,
+                    self.metadata.key_encryption_rounds)
+            check_final_key(self.metadata, ciphertext, key)
         payload = self._decrypt_payload(
-            contents[Header.HEADER_SIZE:],
-            self._calculate_key(password, key_file_contents,
-                                self.metadata.master_seed,
-                                self.metadata.master_seed2,
-                                self.metadata.key_encryption_rounds),
+            ciphertext,
+            key,
             self.metadata.encryption_type,
             self.metadata.encryption_iv
         )
-        self.groups, self.entries = self._parse_payload(payload)
+        # The groups and entries are decoded the first time they're
+        # accessed.  Until then, find_by_uuid() and find_by_title() scan
+        # the records in the payload and only decode the matching entry.
+        self._payload = payload
+        self._groups = None
+        self._entries = None
+        self._entries_offset = None
+        self._groups_by_path = None
+        self._subtree_ends = None
+        self._url_index = None
+        self._time_indexes = {}
+        if string_pool is None:
+            string_pool = StringPool()
+        self.string_pool = string_pool
 
-    def _decrypt_payload(self, payload, key, encryption_type, iv):
+    @property
+    def groups(self):
+        if self._groups is None:
+            with instrument.timed('parse_groups'):
+                self._groups, self._entries_offset = \
+                    self._parse_groups_payload(self._payload)
+            self._build_group_tree(self._groups)
+        return self._groups
+
+    @groups.setter
+    def groups(self, groups):
+        self._groups = groups
+        self._build_group_tree(groups)
+
+    @property
+    def payload(self):
+        """The decrypted payload.
+
+        This is None once every entry has been decoded, and for
+        databases that don't have one, such as KDBX databases.
+
+        """
+        return self._payload
+
+    def encoded_entry_records(self):
+        """Return the entry records as they're stored, and their count.
+
+        The records can be copied to another database with
+        ``DatabaseWriter.add_entry_records``.  Returns None once the
+        entries have been decoded, as the payload is no longer kept.
+
+        """
+        if self._entries is not None or self._payload is None:
+            return None
+        self.groups
+        return (self._payload[self._entries_offset:],
+                self.metadata.num_entries)
+
+    @property
+    def root_groups(self):
+        """The top level groups of the group tree."""
+        return [group for group in self.groups if group.parent is None]
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            groups = self.groups
+            with instrument.timed('parse_entries'):
+                entries = self._parse_entries_payload(self._payload,
+                                                      self._entries_offset)
+            self._set_entry_groups(groups, entries)
+            for entry in entries:
+                entry.group.entries.append(entry)
+            self._entries = entries
+            # Everything has been decoded, so unless an attachment
+            # refers to it the payload can be freed.
+            self._payload = None
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries):
+        self._entries = entries
+        self._url_index = None
+        self._time_indexes = {}
+
+    def _check_encryption_type(self, encryption_type):
         if encryption_type != 'Rijndael':
-            raise ValueError("Unsupported encryption type: %s" %
-                             encryption_type)
-        decryptor = AES.new(key, AES.MODE_CBC, iv)
-        payload = decryptor.decrypt(payload)
-        extra = payload[-1]
-        if not isinstance(payload[-1], integer_types):
-            # Python 2.
-            extra = ord(extra)
-        payload = payload[:len(payload)-extra]
-        if self.metadata.contents_hash != hashlib.sha256(payload).digest():
+            raise UnsupportedDatabaseError(
+                "Unsupported encryption type: %s" % encryption_type)
+
+    def _decrypt_payload(self, payload, key, encryption_type, iv):
+        self._check_encryption_type(encryption_type)
+        with instrument.timed('decrypt'):
+            if len(payload) >= self.PARALLEL_DECRYPT_THRESHOLD:
+                decrypted = decrypt_cbc(key, iv, payload,
+                                        self.DECRYPT_WORKERS)
+                extra = decrypted[-1]
+                # Strip the padding in place.  The parsers read the
+                # bytearray directly, so the plaintext isn't copied.
+                del decrypted[len(decrypted)-extra:]
+                payload = decrypted
+            else:
+                decryptor = AES.new(key, AES.MODE_CBC, iv)
+                payload = decryptor.decrypt(payload)
+                extra = payload[-1]
+                if not isinstance(payload[-1], integer_types):
+                    # Python 2.
+                    extra = ord(extra)
+                payload = payload[:len(payload)-extra]
+        instrument.count('bytes_decrypted', len(payload) + extra)
+        with instrument.timed('verify'):
+            checksum = hashlib.sha256(payload).digest()
+        if self.metadata.contents_hash != checksum:
             raise InvalidPasswordError(
                 "Decryption failed, decrypted checksum does not match.")
         return payload
 
     def _calculate_key(self, password, key_file_contents,
                        seed1, seed2, num_rounds):
-        # Based on Kdb3Database::setCompositeKey and Kdb3Database::loadReal.
-        key = hashlib.sha256(password).digest()
-        if key_file_contents is not None:
-            # The key derivation also supports a few extra modes, if the key
-            # file is 32 bytes, use that directly instead of taking the sha256
-            # of the contents, if it's 64 bits, assume it's hex encoded and
-            # decode and use the contents directly instead of taking the sha256
-            # hash.
-            if len(key_file_contents) == 64:
-                # Then the key file contents is treated as hex and we
-                # use the converted-to-binary contents as the file
-                # key hash.
-                file_key_hash = binascii.unhexlify(key_file_contents)
-            elif len(key_file_contents) == 32:
-                file_key_hash = key_file_contents
-            else:
-                file_key_hash = hashlib.sha256(key_file_contents).digest()
-            if password == b"":
-                key = file_key_hash
-            else:
-                key = hashlib.sha256(key + file_key_hash).digest()
-
-        cipher = AES.new(seed2, AES.MODE_ECB)
-        for i in xrange(num_rounds):
-            key = cipher.encrypt(key)
-        key = hashlib.sha256(key).digest()
-        return hashlib.sha256(seed1 + key).digest()
+        return calculate_key(password, key_file_contents,
+                             seed1, seed2, num_rounds)
 
     def _parse_payload(self, payload):
-        groups, i = self._parse_groups_payload(payload)
+        with instrument.timed('parse_groups'):
+            groups, i = self._parse_groups_payload(payload)
+        with instrument.timed('parse_entries'):
+            entries = self._parse_entries_payload(payload, i)
+        self._set_entry_groups(groups, entries)
+        return groups, entries
+
+    def _set_entry_groups(self, groups, entries):
         groups_by_groupid = dict((g.groupid, g) for g in groups)
-        payload = payload[i:]
-        entries = self._parse_entries_payload(payload)
         for entry in entries:
             entry.group = groups_by_groupid[entry.groupid]
-        return groups, entries
+
+    def _build_group_tree(self, groups):
+        # Groups are stored depth first, each with its depth in the
+        # tree as its level, so a group's parent is the closest group
+        # before it with a lower level, and a group's subtree is the
+        # run of groups after it with a higher level.  This means a
+        # subtree is a contiguous slice of the groups.
+        self._groups_by_path = {}
+        self._subtree_ends = [len(groups)] * len(groups)
+        stack = []
+        for i, group in enumerate(groups):
+            level = group.level or 0
+            while stack and (groups[stack[-1]].level or 0) >= level:
+                self._subtree_ends[stack.pop()] = i
+            group.children = []
+            group.entries = []
+            if stack:
+                group.parent = groups[stack[-1]]
+                group.parent.children.append(group)
+                group.path = group.parent.path + '/' + group.group_name
+            else:
+                group.parent = None
+                group.path = group.group_name
+            self._groups_by_path.setdefault(group.path, []).append(i)
+            stack.append(i)
+
+    def find_groups(self, path):
+        """Find the groups with a path such as ``Internet/Email``.
+
+        A group's path is the names of the groups above it and its own
+        name, separated by ``/``.
+
+        :raise: GroupNotFoundError
+
+        """
+        groups = self.groups
+        indices = self._groups_by_path.get(path.strip('/'))
+        if not indices:
+            raise GroupNotFoundError("Group not found: %s" % path)
+        return [groups[i] for i in indices]
+
+    def subtree_groups(self, path):
+        """Return the groups at ``path`` along with all their subgroups.
+
+        :raise: GroupNotFoundError
+
+        """
+        self.find_groups(path)
+        groups = self.groups
+        subtree = []
+        for i in self._groups_by_path[path.strip('/')]:
+            subtree.extend(groups[i:self._subtree_ends[i]])
+        return subtree
+
+    def group_entries(self, path):
+        """Return the entries in the groups at ``path`` and their subgroups.
+
+        Only the groups in the subtree are visited.
+
+        :raise: GroupNotFoundError
+
+        """
+        groups = self.subtree_groups(path)
+        # Make sure the entries have been added to their groups.
+        self.entries
+        return [entry for group in groups for entry in group.entries]
+
+    def included_groups(self, paths=(), names=()):
+        """Return the groups that aren't excluded.
+
+        The groups at ``paths``, the groups named any of ``names``
+        wherever they are in the tree, and all of their subgroups are
+        excluded.  Excluded subtrees are skipped over rather than
+        checked group by group.  Unknown paths are ignored.
+
+        """
+        groups = self.groups
+        excluded = set()
+        for path in paths:
+            excluded.update(self._groups_by_path.get(path.strip('/'), []))
+        names = set(names)
+        included = []
+        i = 0
+        while i < len(groups):
+            if i in excluded or groups[i].group_name in names:
+                i = self._subtree_ends[i]
+                continue
+            included.append(groups[i])
+            i += 1
+        return included
+
+    def exclude_groups(self, paths=(), names=()):
+        """Return every entry except the ones in the excluded groups.
+
+        See ``included_groups()`` for which groups are excluded.
+
+        """
+        groups = self.included_groups(paths, names)
+        # Make sure the entries have been added to their groups.
+        self.entries
+        return [entry for group in groups for entry in group.entries]
+
+    def iter_entries(self, groups=None):
+        """Yield the entries, decoding each one as it's yielded.
+
+        If the entries haven't been decoded yet, they're decoded one
+        at a time in the order they're stored and aren't kept, so the
+        first entry is available right away and the memory used
+        doesn't grow with the number of entries.  If ``groups`` is
+        given, only the entries in those groups are yielded.
+
+        """
+        if self._entries is not None or self._payload is None:
+            for entry in self.entries:
+                if groups is None or entry.group in groups:
+                    yield entry
+            return
+        groups_by_groupid = dict((g.groupid, g) for g in self.groups)
+        parser = PayloadParser(self._payload, self.string_pool)
+        hits, misses = self.string_pool.hits, self.string_pool.misses
+        i = self._entries_offset
+        try:
+            for _ in xrange(self.metadata.num_entries):
+                entry, i = parser.parse_entry(i)
+                if entry.uuid == SYSTEM_USER_UUID:
+                    continue
+                entry.group = groups_by_groupid[entry.groupid]
+                if groups is None or entry.group in groups:
+                    yield entry
+        finally:
+            self._count_parsed(parser, hits, misses)
 
     def _parse_groups_payload(self, payload):
+        parser = PayloadParser(payload, self.string_pool)
+        hits, misses = self.string_pool.hits, self.string_pool.misses
         i = 0
-        ignore = object()
-        group_types = {
-            0x0: ('ignored', BaseType),
-            0x1: ('groupid', IntegerType),
-            0x2: ('group_name', StringType),
-            0x3: (ignore, DateType),
-            0x4: (ignore, DateType),
-            0x5: (ignore, DateType),
-            0x6: (ignore, DateType),
-            0x7: ('imageid', IntegerType),
-            0x8: ('level', ShortType),
-            0x9: ('flags', IntegerType),
-            0xFFFF: (None, None),
-            }
         groups = []
         for _ in xrange(self.metadata.num_groups):
-            group = Group()
-            while True:
-                # The payload has a structure of
-                # 2 bytes - field type
-                # 4 bytes - length of field
-                # n bytes - the field data
-                # The way that the n bytes are interpreted will
-                # depend on what the field type is.  Some will
-                # be ints, some will be dates, some will be strings, etc.
-                # So first read the field type and the field size.
-                header = payload[i:i+6]
-                i += 6
-                # < == little endian
-                # H == unsigned short, 2 bytes
-                # I == unsigned int, 4 bytes
-                field_type, field_size = struct.unpack('<HI', header)
-                field_data = payload[i:i+field_size]
-                i += field_size
-                name, decoder = group_types[field_type]
-                if name is ignore:
-                    continue
-                elif name is None:
-                    break
-                else:
-                    setattr(group, name, decoder.decode(field_data))
+            group, i = parser.parse_group(i)
             groups.append(group)
+        self._count_parsed(parser, hits, misses)
         return groups, i
 
-    def _parse_entries_payload(self, payload):
-        entry_types = {
-            0x0: ('ignored', BaseType),
-            0x1: ('uuid', UUIDType),
-            0x2: ('groupid', IntegerType),
-            0x3: ('imageid', IntegerType),
-            0x4: ('title', StringType),
-            0x5: ('url', StringType),
-            0x6: ('username', StringType),
-            0x7: ('password', StringType),
-            0x8: ('notes', StringType),
-            0x9: ('creation_time', DateType),
-            0xa: ('last_mod_time', DateType),
-            0xb: ('last_acc_time', DateType),
-            0xc: ('expiration_time', DateType),
-            0xd: ('binary_desc', StringType),
-            0xe: ('binary_data', BaseType),
-            0xFFFF: (None, None),
-        }
-        i = 0
+    def _parse_entries_payload(self, payload, start=0):
+        num_entries = self.metadata.num_entries
+        if num_entries >= self.PARALLEL_PARSE_THRESHOLD:
+            processes = self.PARSE_PROCESSES
+            if processes is None:
+                processes = multiprocessing.cpu_count()
+            if processes > 1:
+                hits = self.string_pool.hits
+                misses = self.string_pool.misses
+                entries, fields_decoded = parse_entries_parallel(
+                    payload, start, num_entries, processes,
+                    self.string_pool)
+                instrument.count('fields_decoded', fields_decoded)
+                instrument.count('string_pool_hits',
+                                 self.string_pool.hits - hits)
+                instrument.count('string_pool_misses',
+                                 self.string_pool.misses - misses)
+                return entries
+        parser = PayloadParser(payload, self.string_pool)
+        hits, misses = self.string_pool.hits, self.string_pool.misses
+        i = start
         entries = []
         for _ in xrange(self.metadata.num_entries):
-            entry = Entry()
-            while True:
-                # The payload has a structure of
-                # 2 bytes - field type
-                # 4 bytes - length of field
-                # n bytes - the field data
-                # The way that the n bytes are interpreted will
-                # depend on what the field type is.  Some will
-                # be ints, some will be dates, some will be strings, etc.
-                # So first read the field type and the field size.
-                header = payload[i:i+6]
-                i += 6
-                # < == little endian
-                # H == unsigned short, 2 bytes
-                # I == unsigned int, 4 bytes
-                field_type, field_size = struct.unpack('<HI', header)
-                field_data = payload[i:i+field_size]
-                i += field_size
-                name, decoder = entry_types[field_type]
-                if name is None:
-                    break
-                else:
-                    setattr(entry, name, decoder.decode(field_data))
+            entry, i = parser.parse_entry(i)
             if entry.uuid != SYSTEM_USER_UUID:
                 entries.append(entry)
+        self._count_parsed(parser, hits, misses)
         return entries
 
+    def diff(self, other):
+        """Compare the entries of this database with another database.
+
+        Entries are matched by uuid.  Rather than comparing the decoded
+        entries, a digest of each field is compared, and only the
+        entries that differ are decoded.  Returns a list of
+        ``EntryDiff`` for the entries that have changed or are only in
+        this database, in this database's order, followed by the
+        entries that are only in ``other``.
+
+        :raise: ValueError if ``other`` is a different format.  A KDB
+            file and its KDBX export don't store the same fields (KDBX
+            adds a root group and has its own groupids and icons), so
+            every entry would look changed.
+
+        """
+        if self.FORMAT != other.FORMAT:
+            raise ValueError("Can't compare a %s database with a %s "
+                             "database." % (self.FORMAT, other.FORMAT))
+        ours = self._entry_digests()
+        theirs = other._entry_digests()
+        diffs = []
+        for uuid, (location, digests) in ours.items():
+            if uuid not in theirs:
+                diffs.append(EntryDiff(EntryDiff.REMOVED,
+                                       self._entry_at(location), None))
+                continue
+            their_location, their_digests = theirs[uuid]
+            if digests == their_digests:
+                continue
+            fields = sorted(
+                self.ENTRY_TYPES[field_type][0] for field_type in
+                set(digests) | set(their_digests)
+                if digests.get(field_type) != their_digests.get(field_type))
+            diffs.append(EntryDiff(EntryDiff.CHANGED,
+                                   self._entry_at(location),
+                                   other._entry_at(their_location), fields))
+        for uuid, (location, _) in theirs.items():
+            if uuid not in ours:
+                diffs.append(EntryDiff(EntryDiff.ADDED, None,
+                                       other._entry_at(location)))
+        instrument.count('entries_diffed', len(ours) + len(theirs))
+        return diffs
+
+    def _entry_digests(self):
+        # Map the raw uuid of every entry to its location and a dict of
+        # field type to a digest of the field's data.  The location is
+        # the offset of the record in the payload if the entries
+        # haven't been decoded yet, otherwise it's the entry.
+        digests = OrderedDict()
+        if self._entries is None:
+            # Parsing the groups finds where the entries start.
+            self.groups
+            payload = self._payload
+            parser = PayloadParser(payload)
+            i = self._entries_offset
+            for _ in xrange(self.metadata.num_entries):
+                start = i
+                fields, i = parser.record_fields(i)
+                offset, size = fields.get(0x1, (0, 0))
+                uuid = bytes(payload[offset:offset + size])
+                if UUIDType.decode(uuid) == SYSTEM_USER_UUID:
+                    continue
+                digests[uuid] = (start, dict(
+                    (field_type, _field_digest(
+                        self.ENTRY_TYPES[field_type][1], payload[o:o + n]))
+                    for field_type, (o, n) in fields.items()
+                    if field_type in self.DIFF_FIELDS))
+            return digests
+        for entry in self.entries:
+            fields = {}
+            for field_type in self.DIFF_FIELDS:
+                name, type_ = self.ENTRY_TYPES[field_type]
+                if type_ is None:
+                    # The attachment field is stored even if it's empty.
+                    data = entry.binary_data or b''
+                else:
+                    data = getattr(entry, name)
+                    if data is not None:
+                        data = type_.encode(data)
+                if data is not None:
+                    fields[field_type] = _field_digest(type_, data)
+            digests[UUIDType.encode(entry.uuid)] = (entry, fields)
+        return digests
+
+    def _entry_at(self, location):
+        if isinstance(location, Entry):
+            return location
+        entry = PayloadParser(self._payload,
+                              self.string_pool).parse_entry(location)[0]
+        self._set_entry_groups(self.groups, [entry])
+        return entry
+
+    def _count_parsed(self, parser, hits, misses):
+        instrument.count('fields_decoded', parser.fields_decoded)
+        instrument.count('string_pool_hits', self.string_pool.hits - hits)
+        instrument.count('string_pool_misses',
+                         self.string_pool.misses - misses)
+
     def find_by_uuid(self, uuid):
         """Find an entry by uuid.
 
+        Until the entries are decoded (see ``entries``), only the
+        matching record is decoded and the entry returned is a new
+        object each time, not the one later found in ``entries`` or
+        in its group's ``entries``.
+
         :raise: EntryNotFoundError
         """
-        for entry in self.entries:
+        if self._entries is None:
+            entry = self._scan_for_entry(uuid=uuid)
+            if entry is None:
+                raise EntryNotFoundError("Entry not found for uuid: %s" % uuid)
+            return entry
+        for i, entry in enumerate(self.entries):
             if entry.uuid == uuid:
+                instrument.count('entries_scanned', i + 1)
                 return entry
+        instrument.count('entries_scanned', len(self.entries))
         raise EntryNotFoundError("Entry not found for uuid: %s" % uuid)
 
     def find_by_title(self, title):
         """Find an entry by exact title.
 
+        As with ``find_by_uuid``, the entry is a new object each time
+        until the entries are decoded.
+
         :raise: EntryNotFoundError
 
         """
-        for entry in self.entries:
+        if self._entries is None:
+            entry = self._scan_for_entry(title=title)
+            if entry is None:
+                raise EntryNotFoundError(
+                    "Entry not found for title: %s" % title)
+            return entry
+        for i, entry in enumerate(self.entries):
             if entry.title == title:
+                instrument.count('entries_scanned', i + 1)
                 return entry
+        instrument.count('entries_scanned', len(self.entries))
         raise EntryNotFoundError("Entry not found for title: %s" % title)
 
+    def _scan_for_entry(self, uuid=None, title=None):
+        # Find the first entry with a matching uuid or title without
+        # decoding any of the other entries.  The query is encoded
+        # the same way the field is stored and compared against the
+        # raw field data, and only a matching record is decoded.
+        # Note that the returned entry is not the same object you'd
+        # find in self.entries.
+        if uuid is not None:
+            try:
+                field, expected = 0x1, [UUIDType.encode(uuid)]
+            except (TypeError, ValueError):
+                # Not a valid uuid, so nothing can match.
+                return None
+        else:
+            # Titles are null terminated, but not always.
+            encoded = StringType.encode(title)
+            field, expected = 0x4, [encoded, encoded[:-1]]
+        expected = dict((len(value), value) for value in expected)
+        groups = self.groups
+        payload = self._payload
+        scanned = 0
+        for start, fields in self._entry_records():
+            scanned += 1
+            offset, size = fields.get(field, (0, None))
+            if size not in expected or \
+                    not payload.startswith(expected[size], offset):
+                continue
+            parser = PayloadParser(payload, self.string_pool)
+            entry = parser.parse_entry(start)[0]
+            instrument.count('fields_decoded', parser.fields_decoded)
+            if entry.uuid != SYSTEM_USER_UUID:
+                self._set_entry_groups(groups, [entry])
+                instrument.count('entries_scanned', scanned)
+                return entry
+        instrument.count('entries_scanned', scanned)
+        return None
+
+    def _entry_records(self):
+        # Yield the offset of every entry record, and where each of
+        # its fields is (see PayloadParser.record_fields).
+        self.groups
+        parser = PayloadParser(self._payload)
+        i = self._entries_offset
+        for _ in xrange(self.metadata.num_entries):
+            start = i
+            fields, i = parser.record_fields(i)
+            yield start, fields
+
+    def scan_fields(self, names):
+        """Yield a tuple of the ``names`` fields of every entry.
+
+        If the entries haven't been decoded yet, only those fields are
+        decoded and no entries are created, so this is much faster than
+        going through ``entries`` when only a few fields are needed::
+
+            for uuid, title in db.scan_fields(['uuid', 'title']):
+                ...
+
+        A field an entry doesn't have is None.  Meta stream entries
+        are skipped, as they are in ``entries``.
+
+        :raise: ValueError if a name isn't one of the decoded entry
+            fields, such as ``attachment``.
+
+        """
+        field_types = dict((name, (field_type, decoder))
+                           for field_type, (name, decoder)
+                           in self.ENTRY_TYPES.items()
+                           if decoder is not None)
+        for name in names:
+            if name not in field_types:
+                raise ValueError("Can't scan for the %s field." % name)
+        if self._entries is not None or self._payload is None:
+            for entry in self.entries:
+                yield tuple(getattr(entry, name) for name in names)
+            return
+        wanted = [field_types[name] for name in names]
+        payload = self._payload
+        meta_stream_uuid = UUIDType.encode(SYSTEM_USER_UUID)
+        for _, fields in self._entry_records():
+            offset, size = fields.get(0x1, (0, 0))
+            if payload[offset:offset + size] == meta_stream_uuid:
+                continue
+            values = []
+            for field_type, decoder in wanted:
+                if field_type in fields:
+                    offset, size = fields[field_type]
+                    values.append(decoder.decode(
+                        payload[offset:offset + size]))
+                else:
+                    values.append(None)
+            yield tuple(values)
+
+    def find_by_url(self, url):
+        """Find the entries for the domain of ``url``.
+
+        Entries for the URL's host and for each of its parent domains
+        match, so ``https://login.example.com/x`` matches entries for
+        ``login.example.com`` and ``example.com``, in that order.  The
+        scheme, port, path and a leading ``www.`` are ignored.  The
+        domain index is built from every entry the first time it's
+        needed, see ``keepassx.urlindex``.
+
+        Returns a list of matches (an empty list is returned if no
+        matches are found).
+
+        """
+        if self._url_index is None:
+            entries = self.entries
+            with instrument.timed('build_url_index'):
+                self._url_index = DomainIndex(entries)
+        return self._url_index.find(url)
+
+    def time_index(self, field):
+        """Return the entries sorted by ``field``.
+
+        ``field`` is one of ``creation_time``, ``last_mod_time`` or
+        ``expiration_time``.  Each index is built from every entry the
+        first time it's needed.  Entries that never expire aren't in
+        the ``expiration_time`` index.
+
+        :rtype: keepassx.timeindex.TimeIndex
+
+        """
+        index = self._time_indexes.get(field)
+        if index is None:
+            entries = self.entries
+            ignore = (NEVER_EXPIRES,) if field == 'expiration_time' else ()
+            with instrument.timed('build_time_index'):
+                index = TimeIndex(entries, field, ignore)
+            self._time_indexes[field] = index
+        return index
+
+    def modified_since(self, since):
+        """Return the entries last modified at or after ``since``,
+        earliest first."""
+        return self.time_index('last_mod_time').between(start=since)
+
+    def expires_before(self, before):
+        """Return the entries that expire before ``before``, soonest
+        first.  This includes entries that have already expired."""
+        return self.time_index('expiration_time').between(end=before)
+
+    def next_to_expire(self, count, now=None):
+        """Return the ``count`` entries that expire next after ``now``,
+        which defaults to the current time."""
+        if now is None:
+            now = datetime.datetime.now()
+        return self.time_index('expiration_time').first(count, start=now)
+
     def fuzzy_search_by_title(self, title, ignore_groups=None):
         """Find an entry by by fuzzy match.
 
@@ -351,6 +1595,7 @@ class Database(object):
         for entry in self.entries:
             if entry.title == title:
                 entries.append(entry)
+        instrument.count('entries_scanned', len(self.entries))
         if entries:
             return self._filter_entries(entries, ignore_groups)
         # Case insensitive matches next.
@@ -358,16 +1603,19 @@ class Database(object):
         for entry in self.entries:
             if entry.title.lower() == title.lower():
                 entries.append(entry)
+        instrument.count('entries_scanned', len(self.entries))
         if entries:
             return self._filter_entries(entries, ignore_groups)
         # Subsequence/prefix matches next.
         for entry in self.entries:
             if self._is_subsequence(title_lower, entry.title.lower()):
                 entries.append(entry)
+        instrument.count('entries_scanned', len(self.entries))
         if entries:
             return self._filter_entries(entries, ignore_groups)
         # Finally close matches that might have mispellings.
         entry_map = {entry.title.lower(): entry for entry in self.entries}
+        instrument.count('entries_scanned', len(self.entries))
         matches = difflib.get_close_matches(
             title.lower(), entry_map.keys(), cutoff=0.7)
         if matches:
@@ -391,6 +1639,226 @@ class Database(object):
         return False
 
 
+def _field_digest(type_, data):
+    # Strings are compared without their null terminator, which the
+    # raw fields don't always have.
+    if type_ is StringType:
+        data = bytes(data).replace(b'\0', b'')
+    return hashlib.sha1(data).digest()
+
+
+class EntryDiff(object):
+    """How an entry differs between two databases.
+
+    ``ours`` is the entry from the database ``diff()`` was called on
+    and ``theirs`` is the entry from the other database.  Either is
+    None if the entry only exists in one of the databases.  For
+    changed entries, ``fields`` is the names of the fields that are
+    different.
+
+    """
+    ADDED = 'added'
+    REMOVED = 'removed'
+    CHANGED = 'changed'
+
+    def __init__(self, status, ours, theirs, fields=None):
+        self.status = status
+        self.ours = ours
+        self.theirs = theirs
+        self.fields = fields or []
+
+    @property
+    def entry(self):
+        return self.ours if self.ours is not None else self.theirs
+
+    @property
+    def newer(self):
+        """Which side was modified most recently, to merge from.
+
+        Returns ``'ours'``, ``'theirs'`` or None if the entries were
+        modified at the same time (or aren't both present).
+
+        """
+        if self.ours is None or self.theirs is None:
+            return None
+        ours = self.ours.last_mod_time
+        theirs = self.theirs.last_mod_time
+        if ours is None or theirs is None or ours == theirs:
+            return None
+        return 'ours' if ours > theirs else 'theirs'
+
+    def __repr__(self):
+        return 'EntryDiff(status=%s, entry=%r, fields=%s)' % (
+            self.status, self.entry, self.fields)
+
+
+class StringPool(object):
+    """Share a single string between the fields with the same value.
+
+    Usernames, urls and group names tend to repeat across the entries
+    of a database, so every decoded value is looked up in the pool and
+    the string already there is used instead.  The pool is keyed on the
+    decoded strings themselves, so a value that doesn't repeat costs a
+    dict slot rather than another copy of its data.  A pool can be
+    shared by several databases with the ``string_pool`` argument of
+    ``Database``, which also shares the strings between them.
+
+    """
+    def __init__(self):
+        self._strings = {}
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, payload, offset, size):
+        """Decode the string field at ``offset`` in ``payload``."""
+        return self.intern(StringType.decode(payload[offset:offset + size]))
+
+    def intern(self, value):
+        """Return the pooled string equal to ``value``."""
+        pooled = self._strings.get(value)
+        if pooled is None:
+            self._strings[value] = value
+            self.misses += 1
+            return value
+        self.hits += 1
+        return pooled
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def __len__(self):
+        return len(self._strings)
+
+
+class PayloadParser(object):
+    """Decodes the group and entry records in a decrypted payload.
+
+    A record is a sequence of fields followed by an end of record
+    field.  Each field has a structure of:
+
+    * 2 bytes - field type
+    * 4 bytes - length of field
+    * n bytes - the field data
+
+    The way that the n bytes are interpreted depends on the field type,
+    see ``Database.GROUP_TYPES`` and ``Database.ENTRY_TYPES``.
+
+    """
+    def __init__(self, payload, string_pool=None):
+        self.payload = payload
+        self.fields_decoded = 0
+        # The fields in Database.POOLED_FIELDS are decoded through
+        # this pool when one is given.
+        self.string_pool = string_pool
+
+    def parse_group(self, i):
+        """Decode the group record starting at offset ``i``.
+
+        Returns a tuple of the group and the offset of the next record.
+
+        """
+        payload = self.payload
+        group_types = Database.GROUP_TYPES
+        pooled_fields = self._pooled_fields()
+        start = i
+        group = Group()
+        while True:
+            # First read the field type and the field size.
+            header = payload[i:i+6]
+            i += 6
+            # < == little endian
+            # H == unsigned short, 2 bytes
+            # I == unsigned int, 4 bytes
+            field_type, field_size = struct.unpack('<HI', header)
+            name, decoder = group_types[field_type]
+            if name is IGNORED_FIELD:
+                i += field_size
+                continue
+            elif name is None:
+                i += field_size
+                break
+            elif name in pooled_fields:
+                setattr(group, name,
+                        self.string_pool.decode(payload, i, field_size))
+            else:
+                setattr(group, name,
+                        decoder.decode(payload[i:i+field_size]))
+            self.fields_decoded += 1
+            i += field_size
+        group.record_span = (start, i - start)
+        return group, i
+
+    def parse_entry(self, i):
+        """Decode the entry record starting at offset ``i``.
+
+        Returns a tuple of the entry and the offset of the next record.
+
+        """
+        payload = self.payload
+        entry_types = Database.ENTRY_TYPES
+        pooled_fields = self._pooled_fields()
+        start = i
+        fields_decoded = 0
+        entry = Entry()
+        while True:
+            header = payload[i:i+6]
+            i += 6
+            field_type, field_size = struct.unpack('<HI', header)
+            name, decoder = entry_types[field_type]
+            if name is None:
+                i += field_size
+                break
+            elif decoder is None:
+                # Attachments can be arbitrarily large, so rather
+                # than copying the data out of the payload we only
+                # record where it lives.  Empty attachments don't
+                # hold a reference to the payload so it can be
+                # freed if nothing else needs it.
+                if field_size:
+                    entry.attachment = Attachment(payload, i, field_size)
+                else:
+                    entry.attachment = Attachment(b'', 0, 0)
+            elif name in pooled_fields:
+                setattr(entry, name,
+                        self.string_pool.decode(payload, i, field_size))
+                fields_decoded += 1
+            else:
+                setattr(entry, name,
+                        decoder.decode(payload[i:i+field_size]))
+                fields_decoded += 1
+            i += field_size
+        self.fields_decoded += fields_decoded
+        entry.record_span = (start, i - start)
+        return entry, i
+
+    def _pooled_fields(self):
+        if self.string_pool is None:
+            return ()
+        return Database.POOLED_FIELDS
+
+    def record_fields(self, i):
+        """Locate the fields of the record at offset ``i`` without decoding.
+
+        Returns a tuple of a dict mapping each field type to the
+        (offset, size) of its data, and the offset of the next record.
+
+        """
+        payload = self.payload
+        unpack_from = _FIELD_HEADER.unpack_from
+        fields = {}
+        while True:
+            field_type, field_size = unpack_from(payload, i)
+            i += 6
+            fields[field_type] = (i, field_size)
+            i += field_size
+            if field_type == 0xFFFF:
+                return fields, i
+
+
 class Group(object):
     """The group associated with an entry."""
     def __init__(self):
@@ -400,6 +1868,15 @@ class Group(object):
         self.imageid = None
         self.level = None
         self.flags = None
+        # The (offset, length) of the group's record
+        # in the decrypted payload.
+        self.record_span = None
+        # The group tree, set by the Database.  The entries are added
+        # when the database's entries are loaded.
+        self.parent = None
+        self.children = []
+        self.entries = []
+        self.path = None
 
     def __repr__(self):
         return 'Group(groupid=%s, group_name=%s)' % (
@@ -423,59 +1900,110 @@ class Entry(object):
         self.last_acc_time = None
         self.expiration_time = None
         self.binary_desc = None
-        self.binary_data = None
+        # An Attachment object, or None if the entry
+        # has no attachment field.
+        self.attachment = None
+        # The (offset, length) of the entry's record
+        # in the decrypted payload.
+        self.record_span = None
         # This is filled in when the database
         # is initially loaded (a Group object with
         # a matching groupid is populated).
         self.group = None
 
+    @property
+    def binary_data(self):
+        """The attachment contents as bytes.
+
+        This reads the entire attachment into memory.  Use
+        ``entry.attachment.open()`` to stream large attachments.
+
+        """
+        if self.attachment is None:
+            return None
+        return self.attachment.read()
+
+    @binary_data.setter
+    def binary_data(self, value):
+        if value is None:
+            self.attachment = None
+        else:
+            self.attachment = Attachment(value, 0, len(value))
+
     def __repr__(self):
         return "Entry(uuid=%s, title=%s)" % (
             self.uuid, self.title)
 
 
-class BaseType(object):
-    @staticmethod
-    def decode(payload):
-        return payload
+class Attachment(object):
+    """The binary data attached to an entry.
 
+    Only the location of the data within the decrypted payload is
+    recorded when a database is loaded.  The data itself is not read
+    until it's asked for, either all at once with ``read()`` or
+    incrementally through the file like object returned from ``open()``.
 
-class UUIDType(object):
-    @staticmethod
-    def decode(payload):
-        return binascii.b2a_hex(payload).decode('utf-8').replace('\0', '')
+    """
+    def __init__(self, payload, offset, length):
+        self._payload = payload
+        self.offset = offset
+        self.length = length
 
+    def open(self):
+        """Return a read only file like object over the attachment."""
+        return AttachmentReader(self._payload, self.offset, self.length)
 
-class StringType(BaseType):
-    @staticmethod
-    def decode(payload):
-        # Strings are null terminated.
-        return payload.decode('utf-8').replace('\0', '')
+    def read(self):
+        # A single copy, whether the payload is bytes or a bytearray.
+        view = memoryview(self._payload)
+        return view[self.offset:self.offset+self.length].tobytes()
 
+    def __len__(self):
+        return self.length
 
-class IntegerType(BaseType):
-    @staticmethod
-    def decode(payload):
-        return struct.unpack('<I', payload)[0]
+    def __repr__(self):
+        return 'Attachment(offset=%s, length=%s)' % (self.offset, self.length)
 
 
-class ShortType(BaseType):
-    @staticmethod
-    def decode(payload):
-        return struct.unpack("<H", payload)[0]
+class AttachmentReader(io.RawIOBase):
+    """File like object that reads an attachment without copying it."""
+    def __init__(self, payload, offset, length):
+        super(AttachmentReader, self).__init__()
+        self._view = memoryview(payload)[offset:offset+length]
+        self._position = 0
 
+    def readable(self):
+        return True
 
-class DateType(BaseType):
-    @staticmethod
-    def decode(payload):
-        # Little endian 5 unsigned chars.
-        # Based off of keepassx 0.4.3 source:
-        # Kdb3Database.cpp: Kdb3Database::dateFromPackedStruct5
-        uchar = struct.unpack('<5B', payload)
-        year = (uchar[0] << 6) | (uchar[1] >> 2)
-        month = ((uchar[1] & 0x00000003) << 2) | (uchar[2] >> 6)
-        day = (uchar[2] >> 1) & 0x0000001F
-        hour = ((uchar[2] & 0x00000001) << 4) | (uchar[3] >> 4)
-        minutes = ((uchar[3] & 0x0000000F) << 2) | (uchar[4] >> 6)
-        seconds = uchar[4] & 0x0000003F
-        return datetime.datetime(year, month, day, hour, minutes, seconds)
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        remaining = len(self._view) - self._position
+        size = min(len(buf), max(remaining, 0))
+        buf[:size] = self._view[self._position:self._position+size]
+        self._position += size
+        return size
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError("Invalid whence value: %s" % whence)
+        if position < 0:
+            raise ValueError("Negative seek position: %s" % position)
+        self._position = position
+        return position
+
+    def close(self):
+        if not self.closed and hasattr(self._view, 'release'):
+            # Python 3 only, lets the payload be freed.
+            self._view.release()
+        super(AttachmentReader, self).close()
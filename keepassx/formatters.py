@@ -0,0 +1,133 @@
+"""Output formats for the kp command.
+
+Every formatter except the table formatter writes and flushes each row
+as soon as it's given one, so the output of a command can be consumed
+by another program before all of the rows have been produced.
+
+"""
+import csv
+import json
+
+import six
+from prettytable import PrettyTable
+
+
+def get_formatter(name, stream, fields, headers=None):
+    try:
+        formatter_cls = _FORMATTERS[name]
+    except KeyError:
+        raise ValueError("Unknown output format: %s" % name)
+    return formatter_cls(stream, fields, headers)
+
+
+class Formatter(object):
+    """Base class for writing rows of values to a stream.
+
+    :param stream: The file like object to write to.
+    :param fields: The machine readable name of each column.
+    :param headers: The human readable name of each column, defaults
+        to ``fields``.
+
+    """
+    # Whether or not rows are written as they're added.
+    STREAMING = True
+
+    def __init__(self, stream, fields, headers=None):
+        self._stream = stream
+        self._fields = fields
+        if headers is None:
+            headers = fields
+        self._headers = headers
+
+    def write_row(self, row):
+        raise NotImplementedError("write_row")
+
+    def close(self):
+        pass
+
+
+class TableFormatter(Formatter):
+    STREAMING = False
+
+    def __init__(self, stream, fields, headers=None):
+        super(TableFormatter, self).__init__(stream, fields, headers)
+        self._table = PrettyTable(self._headers)
+
+    def set_alignment(self, header, align):
+        self._table.align[header] = align
+
+    def write_row(self, row):
+        self._table.add_row(row)
+
+    def close(self):
+        self._stream.write(six.text_type(self._table))
+        self._stream.write('\n')
+
+
+class JSONFormatter(Formatter):
+    """Writes a JSON list of objects, one object per row."""
+
+    def __init__(self, stream, fields, headers=None):
+        super(JSONFormatter, self).__init__(stream, fields, headers)
+        self._separator = '[\n'
+
+    def write_row(self, row):
+        self._stream.write(self._separator)
+        self._stream.write(json.dumps(dict(zip(self._fields, row)),
+                                      sort_keys=True))
+        self._separator = ',\n'
+        self._stream.flush()
+
+    def close(self):
+        if self._separator == '[\n':
+            # No rows were written.
+            self._stream.write('[')
+        else:
+            self._stream.write('\n')
+        self._stream.write(']\n')
+
+
+class JSONLinesFormatter(Formatter):
+    """Writes one JSON object per line."""
+
+    def write_row(self, row):
+        self._stream.write(json.dumps(dict(zip(self._fields, row)),
+                                      sort_keys=True))
+        self._stream.write('\n')
+        self._stream.flush()
+
+
+class CSVFormatter(Formatter):
+    DIALECT = 'excel'
+
+    def __init__(self, stream, fields, headers=None):
+        super(CSVFormatter, self).__init__(stream, fields, headers)
+        self._writer = csv.writer(stream, dialect=self.DIALECT,
+                                  lineterminator='\n')
+        self._writer.writerow(self._encode(self._fields))
+
+    def _encode(self, row):
+        if six.PY2:
+            # The python2 csv module doesn't support unicode.
+            return [value.encode('utf-8')
+                    if isinstance(value, six.text_type) else value
+                    for value in row]
+        return row
+
+    def write_row(self, row):
+        self._writer.writerow(self._encode(row))
+        self._stream.flush()
+
+
+class TSVFormatter(CSVFormatter):
+    DIALECT = 'excel-tab'
+
+
+_FORMATTERS = {
+    'table': TableFormatter,
+    'json': JSONFormatter,
+    'jsonl': JSONLinesFormatter,
+    'csv': CSVFormatter,
+    'tsv': TSVFormatter,
+}
+FORMATS = sorted(_FORMATTERS)
@@ -0,0 +1,278 @@
+"""Import entries into a KDB file from CSV or JSON lines.
+
+Records are read one at a time and each one is encoded into a
+``DatabaseWriter`` as soon as it's read, so memory use grows with the
+size of the database being written rather than with the number of
+records that have been parsed.  The password is transformed once, when
+the writer serializes the database::
+
+    writer = DatabaseWriter(password=encode_password(u'password'))
+    with io.open('passwords.csv', encoding='utf-8-sig', newline='') as f:
+        import_records(writer, read_csv(f))
+    with open('passwords.kdb', 'wb') as f:
+        f.write(writer.serialize())
+
+Each record is a dict of field names to values.  The names are case
+insensitive and the common spellings used by password manager exports
+are understood, see ``FIELD_NAMES``.  ``group`` is the path of the
+group the entry goes in, such as ``Internet/Email``, and any group
+that doesn't exist yet is created.  Columns that aren't listed are
+ignored.
+
+"""
+import csv
+import json
+import datetime
+
+import six
+
+from keepassx.db import Group, Entry, UUIDType
+
+
+DEFAULT_GROUP = u'Imported'
+FORMATS = ['csv', 'jsonl']
+# Maps the lower cased names of input fields to the Entry attribute
+# they're imported as.
+FIELD_NAMES = {
+    'uuid': 'uuid',
+    'title': 'title',
+    'name': 'title',
+    'username': 'username',
+    'user name': 'username',
+    'login': 'username',
+    'password': 'password',
+    'url': 'url',
+    'web site': 'url',
+    'website': 'url',
+    'notes': 'notes',
+    'comments': 'notes',
+    'group': 'group',
+    'created': 'creation_time',
+    'creation time': 'creation_time',
+    'modified': 'last_mod_time',
+    'last modified': 'last_mod_time',
+    'expires': 'expiration_time',
+    'expiration time': 'expiration_time',
+}
+TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
+GROUP_SEPARATOR = u'/'
+
+
+class InvalidRecordError(ValueError):
+    pass
+
+
+def guess_format(filename):
+    """Return the format of an input file based on its extension."""
+    if filename.lower().endswith(('.jsonl', '.json', '.ndjson')):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_records(stream, input_format):
+    if input_format == 'csv':
+        return read_csv(stream)
+    elif input_format == 'jsonl':
+        return read_jsonl(stream)
+    raise ValueError("Unknown import format: %s" % input_format)
+
+
+def read_csv(stream):
+    """Yield a dict for every row of a CSV file with a header row.
+
+    ``stream`` must be opened in text mode with ``newline=''``.
+
+    """
+    lines = _text_lines(stream)
+    if six.PY2:
+        # The python 2 csv module only reads bytes.
+        reader = csv.reader(line.encode('utf-8') for line in lines)
+        rows = ([cell.decode('utf-8') for cell in row] for row in reader)
+    else:
+        reader = rows = csv.reader(lines)
+    try:
+        header = next(rows, None)
+        if header is None:
+            return
+        for row in rows:
+            if row:
+                yield dict(zip(header, row))
+    except csv.Error as e:
+        raise InvalidRecordError("Line %s: %s" % (reader.line_num, e))
+
+
+def read_jsonl(stream):
+    """Yield the object on every non blank line of a JSON lines file."""
+    for line_number, line in enumerate(_text_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise InvalidRecordError("Line %s: %s" % (line_number, e))
+        if not isinstance(record, dict):
+            raise InvalidRecordError(
+                "Line %s: expected an object, not %s" % (
+                    line_number, type(record).__name__))
+        yield record
+
+
+def _text_lines(stream):
+    # The stream decodes its input in chunks, so a decoding error
+    # can't be tied to a line.
+    lines = iter(stream)
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration:
+            return
+        except UnicodeDecodeError as e:
+            raise InvalidRecordError("Invalid text: %s" % e)
+        yield line
+
+
+def import_records(writer, records, db=None, default_group=DEFAULT_GROUP):
+    """Add every record to ``writer``.
+
+    See ``Importer`` for the arguments.  Returns the number of
+    entries imported.
+
+    """
+    importer = Importer(writer, db, default_group)
+    for record in records:
+        importer.add(record)
+    importer.finish()
+    return importer.num_imported
+
+
+class Importer(object):
+    """Encode records as entries of a ``DatabaseWriter``.
+
+    Entries are written as they're added.  The groups are only written
+    by ``finish``, because every subgroup has to follow its parent and
+    the groups a record needs aren't known until it's been read.
+
+    :param writer: The ``DatabaseWriter`` to add the entries to.
+    :param db: An existing ``Database`` whose groups and entries are
+        copied to the writer first.  If its entries haven't been
+        decoded yet, their records are copied as they are.
+    :param default_group: The group of records without one.
+
+    """
+    def __init__(self, writer, db=None, default_group=DEFAULT_GROUP):
+        self.writer = writer
+        self.default_group = default_group
+        self.num_imported = 0
+        self._groups_by_path = {}
+        self._children = {None: []}
+        self._next_groupid = 1
+        self._payload = None
+        # The encoded uuids of the entries written so far.
+        self._uuids = set()
+        if db is not None:
+            self._copy_database(db)
+
+    def _copy_database(self, db):
+        groups = db.groups
+        for group in groups:
+            self._add_group(group, group.parent)
+        self._next_groupid = max(
+            [group.groupid for group in groups] + [0]) + 1
+        records = db.encoded_entry_records()
+        if records is not None:
+            # The group records are copied from the same payload.
+            self._payload = db.payload
+            self.writer.add_entry_records(*records)
+        else:
+            for entry in db.entries:
+                self.writer.add_entry(entry)
+        self._uuids.update(UUIDType.encode(uuid)
+                           for uuid, in db.scan_fields(['uuid']))
+
+    def _add_group(self, group, parent):
+        self._groups_by_path.setdefault(group.path, group)
+        self._children.setdefault(id(group), [])
+        self._children[id(parent) if parent is not None else None].append(
+            group)
+
+    def add(self, record):
+        """Encode one record as an entry."""
+        self.num_imported += 1
+        entry = Entry()
+        group_path = None
+        for key, value in record.items():
+            name = FIELD_NAMES.get(key.strip().lower())
+            if name is None or value is None or value == u'':
+                continue
+            if not isinstance(value, six.string_types):
+                value = json.dumps(value)
+            elif isinstance(value, bytes):
+                value = value.decode('utf-8')
+            if name == 'group':
+                group_path = value
+            elif name.endswith('_time'):
+                setattr(entry, name, self._parse_time(key, value))
+            else:
+                setattr(entry, name, value)
+        if entry.uuid is not None:
+            self._check_uuid(entry.uuid)
+        entry.groupid = self._find_or_create_group(
+            group_path or self.default_group).groupid
+        entry = self.writer.add_entry(entry)
+        self._uuids.add(UUIDType.encode(entry.uuid))
+
+    def _parse_time(self, key, value):
+        for time_format in TIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, time_format)
+            except ValueError:
+                pass
+        raise InvalidRecordError("Record %s: invalid %s: %s" % (
+            self.num_imported, key, value))
+
+    def _check_uuid(self, uuid):
+        try:
+            encoded = UUIDType.encode(uuid)
+        except (TypeError, ValueError):
+            encoded = None
+        if encoded is None or len(encoded) != 16:
+            raise InvalidRecordError("Record %s: invalid uuid: %s" % (
+                self.num_imported, uuid))
+        if encoded in self._uuids:
+            raise InvalidRecordError("Record %s: duplicate uuid: %s" % (
+                self.num_imported, uuid))
+
+    def _find_or_create_group(self, path):
+        names = [name.strip() for name in path.split(GROUP_SEPARATOR)]
+        names = [name for name in names if name]
+        if not names:
+            names = [self.default_group]
+        parent = None
+        for i in range(len(names)):
+            group_path = GROUP_SEPARATOR.join(names[:i + 1])
+            group = self._groups_by_path.get(group_path)
+            if group is None:
+                group = Group()
+                group.groupid = self._next_groupid
+                group.group_name = names[i]
+                group.imageid = 0
+                group.level = i
+                group.flags = 0
+                group.path = group_path
+                self._next_groupid += 1
+                self._add_group(group, parent)
+            parent = group
+        return parent
+
+    def finish(self):
+        """Write the groups, depth first."""
+        stack = list(reversed(self._children[None]))
+        while stack:
+            group = stack.pop()
+            if group.record_span is not None and self._payload is not None:
+                start, length = group.record_span
+                self.writer.add_group_record(
+                    self._payload[start:start + length])
+            else:
+                self.writer.add_group(group)
+            stack.extend(reversed(self._children[id(group)]))
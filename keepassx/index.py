@@ -0,0 +1,212 @@
+"""An encrypted sidecar index for looking up single entries.
+
+The payload of a KDB file is encrypted with AES-CBC, so any range of
+it can be decrypted from the ciphertext and the block before the
+range.  The index records where each entry's record lives in the
+payload, which lets a lookup by uuid or exact title decrypt and decode
+only the blocks that hold the matching entries instead of the whole
+payload::
+
+    final_key = calculate_key(password, None, header.master_seed,
+                              header.master_seed2,
+                              header.key_encryption_rounds)
+    entries = find_entries(contents, final_key, index_data, 'Github')
+
+The index is encrypted and authenticated with keys derived from the
+database's final key, so only someone who can open the database can
+read it.  It's bound to the database's contents hash, and each record
+carries a digest of the entry's plaintext, so an index that doesn't
+match the database is rejected with ``InvalidIndexError`` and the
+caller should fall back to loading the whole database.
+
+"""
+import struct
+import hashlib
+import binascii
+
+from keepassx.db import Header, PayloadParser, SYSTEM_USER_UUID
+from keepassx.db import InvalidPasswordError, decrypt_range
+from keepassx.utils import read_file, write_private_file, seal, unseal
+
+
+INDEX_SUFFIX = '.kpidx'
+MAGIC = b'KPIDX\x00\x00\x01'
+# The magic and the contents hash of the database, in the clear.
+_HEADER_SIZE = len(MAGIC) + 32
+_DIGEST_SIZE = 16
+
+
+class InvalidIndexError(Exception):
+    pass
+
+
+def index_filename(db_filename):
+    """Return the filename of the index for a database file."""
+    return db_filename + INDEX_SUFFIX
+
+
+def read_index(filename):
+    """Return the contents of an index file, or None if it doesn't exist."""
+    return read_file(filename)
+
+
+def write_index(filename, data):
+    """Write an index file that is only readable by the current user."""
+    write_private_file(filename, data)
+
+
+def find_entries(contents, final_key, index_data, term):
+    """Find the entries with a uuid or exact title of ``term``.
+
+    Only the groups and the records of the matching entries are
+    decrypted.  Returns an empty list if nothing matches.
+
+    :raise: InvalidIndexError if the index doesn't belong to the
+        database or can't be decrypted with ``final_key``.
+
+    """
+    header = Header(contents[:Header.HEADER_SIZE])
+    index = EntryIndex.load(index_data, final_key, header.contents_hash)
+    records = index.lookup(term)
+    if not records:
+        return []
+    ciphertext = contents[Header.HEADER_SIZE:]
+    groups_payload = decrypt_range(final_key, header.encryption_iv,
+                                   ciphertext, 0, index.groups_length)
+    if _digest(groups_payload) != index.groups_digest:
+        raise InvalidIndexError("Groups do not match the index.")
+    parser = PayloadParser(groups_payload)
+    groups_by_groupid = {}
+    i = 0
+    for _ in range(header.num_groups):
+        group, i = parser.parse_group(i)
+        groups_by_groupid[group.groupid] = group
+    entries = []
+    for _, _, record_digest, offset, length in records:
+        record = decrypt_range(final_key, header.encryption_iv,
+                               ciphertext, offset, offset + length)
+        if _digest(record) != record_digest:
+            raise InvalidIndexError("Entry does not match the index.")
+        entry = PayloadParser(record).parse_entry(0)[0]
+        entry.record_span = (offset, length)
+        entry.group = groups_by_groupid[entry.groupid]
+        entries.append(entry)
+    return entries
+
+
+class EntryIndex(object):
+    """The location of every entry record in a database's payload."""
+
+    # The uuid, a digest of the title, a digest of the record, and
+    # the offset and length of the record in the payload.
+    RECORD = struct.Struct('<16s16s16sII')
+    # The length and digest of the group records, and the number
+    # of entry records.
+    PREAMBLE = struct.Struct('<I16sI')
+
+    def __init__(self, contents_hash, groups_length, groups_digest, records):
+        self.contents_hash = contents_hash
+        self.groups_length = groups_length
+        self.groups_digest = groups_digest
+        self.records = records
+        self._by_uuid = {}
+        self._by_title = {}
+        for record in records:
+            self._by_uuid.setdefault(record[0], []).append(record)
+            self._by_title.setdefault(record[1], []).append(record)
+
+    @classmethod
+    def build(cls, contents, final_key):
+        """Build the index for a database.
+
+        This decrypts the entire payload, so it's only worth doing
+        when the index is missing or stale.
+
+        """
+        header = Header(contents[:Header.HEADER_SIZE])
+        ciphertext = contents[Header.HEADER_SIZE:]
+        payload = decrypt_range(final_key, header.encryption_iv,
+                                ciphertext, 0, len(ciphertext))
+        payload = payload[:len(payload) - bytearray(payload[-1:])[0]]
+        if hashlib.sha256(payload).digest() != header.contents_hash:
+            raise InvalidPasswordError(
+                "Decryption failed, decrypted checksum does not match.")
+        return cls.from_payload(payload, header)
+
+    @classmethod
+    def from_database(cls, db):
+        """Build the index from a database's decrypted payload.
+
+        :raise: ValueError if the database no longer holds its payload,
+            which happens once all of its entries have been decoded.
+
+        """
+        if db.payload is None:
+            raise ValueError("Database payload is not available.")
+        return cls.from_payload(db.payload, db.metadata)
+
+    @classmethod
+    def from_payload(cls, payload, header):
+        """Build the index from a payload that has been verified."""
+        parser = PayloadParser(payload)
+        i = 0
+        for _ in range(header.num_groups):
+            i = parser.record_fields(i)[1]
+        groups_length = i
+        records = []
+        for _ in range(header.num_entries):
+            start = i
+            fields, i = parser.record_fields(i)
+            uuid = _field_data(payload, fields, 0x1)
+            if binascii.b2a_hex(uuid).decode('ascii') == SYSTEM_USER_UUID:
+                continue
+            title = _field_data(payload, fields, 0x4).rstrip(b'\0')
+            records.append((uuid, _digest(title),
+                            _digest(payload[start:i]), start, i - start))
+        return cls(header.contents_hash, groups_length,
+                   _digest(payload[:groups_length]), records)
+
+    def lookup(self, term):
+        """Return the records whose uuid or exact title is ``term``."""
+        try:
+            uuid = binascii.unhexlify(term)
+        except (TypeError, ValueError, binascii.Error):
+            uuid = None
+        if uuid is not None and uuid in self._by_uuid:
+            return self._by_uuid[uuid]
+        if not isinstance(term, bytes):
+            term = term.encode('utf-8')
+        return self._by_title.get(_digest(term), [])
+
+    def serialize(self, final_key):
+        body = self.PREAMBLE.pack(self.groups_length, self.groups_digest,
+                                  len(self.records))
+        body += b''.join(self.RECORD.pack(*r) for r in self.records)
+        return seal(final_key, body, header=MAGIC + self.contents_hash)
+
+    @classmethod
+    def load(cls, data, final_key, contents_hash):
+        if data is None or not data.startswith(MAGIC):
+            raise InvalidIndexError("Not an index file.")
+        if data[len(MAGIC):_HEADER_SIZE] != contents_hash:
+            raise InvalidIndexError("Index is stale.")
+        body = unseal(final_key, data, _HEADER_SIZE)
+        if body is None:
+            raise InvalidIndexError("Index could not be authenticated.")
+        groups_length, groups_digest, num_records = \
+            cls.PREAMBLE.unpack_from(body)
+        records = []
+        offset = cls.PREAMBLE.size
+        for _ in range(num_records):
+            records.append(cls.RECORD.unpack_from(body, offset))
+            offset += cls.RECORD.size
+        return cls(contents_hash, groups_length, groups_digest, records)
+
+
+def _field_data(payload, fields, field_type):
+    offset, size = fields.get(field_type, (0, 0))
+    return payload[offset:offset + size]
+
+
+def _digest(data):
+    return hashlib.sha256(data).digest()[:_DIGEST_SIZE]
@@ -0,0 +1,155 @@
+"""Lightweight instrumentation for the hot paths in keepassx.
+
+Code that wants to be measured wraps a stage in ``timed()`` and reports
+counters through ``count()``.  Nothing is recorded unless a hook has been
+registered with ``add_hook()``, in which case every hook is notified
+of each timing and counter::
+
+    from keepassx import instrument
+
+    profile = instrument.Profile()
+    instrument.add_hook(profile)
+    try:
+        db = Database(contents, password)
+    finally:
+        instrument.remove_hook(profile)
+    print(profile.report())
+
+Stages can be nested, for example a search that decodes the entries
+the first time they're needed.  The time reported for a stage doesn't
+include the time spent in the stages nested inside it, so the times
+of all of the stages add up to the total.
+
+When no hooks are registered ``timed()`` returns a shared no-op context
+manager and ``count()`` returns immediately, so the instrumentation
+costs a function call per stage.
+
+"""
+import timeit
+import threading
+from collections import OrderedDict
+
+
+_HOOKS = []
+# The timers that are running in each thread, innermost last.
+_running = threading.local()
+# The most precise clock available (time.perf_counter on python3).
+_clock = timeit.default_timer
+
+
+def add_hook(hook):
+    """Register a hook to receive timings and counters.
+
+    A hook is any object that has the same methods as ``Hook``.
+
+    """
+    _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    _HOOKS.remove(hook)
+
+
+def enabled():
+    return bool(_HOOKS)
+
+
+def timed(stage):
+    """Return a context manager that times the ``stage`` it wraps."""
+    if not _HOOKS:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+
+def count(name, value=1):
+    """Add ``value`` to the counter ``name``."""
+    if not _HOOKS:
+        return
+    for hook in list(_HOOKS):
+        hook.count(name, value)
+
+
+class Hook(object):
+    """Base class for hooks, every method is a no-op."""
+
+    def timing(self, stage, seconds):
+        """Called with the time spent in ``stage``, not counting the
+        stages nested inside it."""
+        pass
+
+    def count(self, name, value):
+        pass
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, stage):
+        self.stage = stage
+        self._start = None
+        # The time spent in the stages nested inside this one.
+        self._nested = 0.0
+
+    def __enter__(self):
+        stack = getattr(_running, 'stack', None)
+        if stack is None:
+            stack = _running.stack = []
+        stack.append(self)
+        self._start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = _clock() - self._start
+        stack = _running.stack
+        stack.remove(self)
+        if stack:
+            stack[-1]._nested += elapsed
+        for hook in list(_HOOKS):
+            hook.timing(self.stage, elapsed - self._nested)
+        return False
+
+
+class Profile(Hook):
+    """A hook that accumulates timings and counters.
+
+    Stages and counters are kept in the order they were first seen,
+    which for a single ``kp`` command is the order they ran in.
+
+    """
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.counters = OrderedDict()
+
+    def timing(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Return a human readable breakdown of where time was spent."""
+        total = sum(self.timings.values())
+        lines = ['%-20s %12s %7s' % ('Stage', 'Time (ms)', '%')]
+        for stage, seconds in self.timings.items():
+            if total:
+                percent = 100.0 * seconds / total
+            else:
+                percent = 0.0
+            lines.append('%-20s %12.3f %6.1f%%' % (stage, seconds * 1000,
+                                                   percent))
+        lines.append('%-20s %12.3f' % ('total', total * 1000))
+        if self.counters:
+            lines.append('')
+            lines.append('%-20s %12s' % ('Counter', 'Value'))
+            for name, value in self.counters.items():
+                lines.append('%-20s %12s' % (name, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,689 @@
+"""Read support for KDBX (KeePass 2.x) databases.
+
+KDBX 3.1 and 4 files are read into the same ``Group`` and ``Entry``
+objects as KDB files, and ``KdbxDatabase`` supports the same lookups
+as ``Database``::
+
+    db = KdbxDatabase(contents, password=b'password')
+    db.find_by_title('Github').password
+
+The payload is decrypted, checked, decompressed and parsed as a stream,
+so the decrypted XML is never held in memory all at once.
+
+Argon2 key derivation needs the ``argon2-cffi`` package.  Each Argon2
+lane is computed by its own thread, so the parallelism stored in the
+database spreads the key derivation across that many cores.
+
+"""
+import io
+import gzip
+import hmac
+import struct
+import base64
+import hashlib
+import binascii
+import datetime
+import importlib
+from xml.etree import ElementTree
+
+from Crypto.Cipher import AES
+
+from keepassx import instrument
+from keepassx.db import Database, Group, Entry, Attachment
+from keepassx.db import InvalidPasswordError, InvalidDatabaseError
+from keepassx.db import UnsupportedDatabaseError
+from keepassx.db import transform_key, key_file_key, encode_password
+from keepassx.writer import NEVER_EXPIRES
+from keepassx.utils import compare_digest
+
+
+SIGNATURE1 = 0x9AA2D903
+SIGNATURE2 = 0xB54BFB67
+AES_CIPHER = binascii.unhexlify('31c1f2e6bf714350be5805216afc5aff')
+CHACHA20_CIPHER = binascii.unhexlify('d6038a2b8b6f4cb5a524339a31dbb59a')
+TWOFISH_CIPHER = binascii.unhexlify('ad68f29f576f4bb9a36ad47af965346c')
+AES_KDF = binascii.unhexlify('c9d9f39a628a4460bf740d08c18a4fea')
+AES_KDF_KDBX4 = binascii.unhexlify('7c02bb8279a74ac0927d114a00648238')
+ARGON2D_KDF = binascii.unhexlify('ef636ddf8c29444b91f7a9a403e30a0c')
+ARGON2ID_KDF = binascii.unhexlify('9e298b1956db4773b23dfc3ec6f0a1e6')
+SALSA20_STREAM = 2
+CHACHA20_STREAM = 3
+SALSA20_NONCE = b'\xe8\x30\x09\x4b\x97\x20\x5d\x2a'
+# How much of the file is decrypted at a time.
+CHUNK_SIZE = 64 * 1024
+_EPOCH = datetime.datetime(1, 1, 1)
+
+
+def is_kdbx(contents):
+    """Return True if ``contents`` look like a KDBX file."""
+    if len(contents) < 12:
+        return False
+    return struct.unpack('<II', contents[:8]) == (SIGNATURE1, SIGNATURE2)
+
+
+def encode_kdbx_password(password):
+    # KeePass 2 always uses utf-8.
+    return encode_password(password, 'utf-8')
+
+
+def composite_key(password, key_file_contents):
+    """Combine the password and key file into the user's master key."""
+    parts = []
+    if password is not None:
+        parts.append(hashlib.sha256(password).digest())
+    if key_file_contents is not None:
+        parts.append(_key_file_key(key_file_contents))
+    return hashlib.sha256(b''.join(parts)).digest()
+
+
+def transform_kdbx_key(key, kdf_parameters):
+    """Run the key derivation function given in the header."""
+    kdf = kdf_parameters['$UUID']
+    if kdf in (AES_KDF, AES_KDF_KDBX4):
+        return transform_key(key, kdf_parameters['S'], kdf_parameters['R'])
+    elif kdf in (ARGON2D_KDF, ARGON2ID_KDF):
+        return _argon2(key, kdf_parameters, kdf == ARGON2ID_KDF)
+    raise UnsupportedDatabaseError(
+        "Unsupported key derivation function: %s" %
+        binascii.hexlify(kdf).decode('ascii'))
+
+
+def _argon2(key, kdf_parameters, argon2id):
+    try:
+        from argon2.low_level import hash_secret_raw, Type
+    except ImportError:
+        raise UnsupportedDatabaseError(
+            "This database uses Argon2, which requires the argon2-cffi "
+            "package.")
+    # hash_secret_raw computes each of the parallelism lanes on its
+    # own thread.
+    return hash_secret_raw(
+        secret=key, salt=kdf_parameters['S'],
+        time_cost=kdf_parameters['I'],
+        memory_cost=kdf_parameters['M'] // 1024,
+        parallelism=kdf_parameters['P'], hash_len=32,
+        type=Type.ID if argon2id else Type.D,
+        version=kdf_parameters.get('V', 0x13))
+
+
+class KdbxHeader(object):
+    """The unencrypted header of a KDBX file."""
+
+    END = 0
+    CIPHER_ID = 2
+    COMPRESSION_FLAGS = 3
+    MASTER_SEED = 4
+    TRANSFORM_SEED = 5
+    TRANSFORM_ROUNDS = 6
+    ENCRYPTION_IV = 7
+    PROTECTED_STREAM_KEY = 8
+    STREAM_START_BYTES = 9
+    INNER_RANDOM_STREAM_ID = 10
+    KDF_PARAMETERS = 11
+
+    def __init__(self, contents):
+        if not is_kdbx(contents):
+            raise InvalidDatabaseError("Not a KDBX file.")
+        minor, major = struct.unpack('<HH', contents[8:12])
+        if major not in (3, 4):
+            raise InvalidDatabaseError(
+                "Unsupported KDBX version: %s.%s" % (major, minor))
+        self.version = (major, minor)
+        self.compressed = False
+        self.protected_stream_key = None
+        self.stream_start_bytes = None
+        self.inner_random_stream_id = None
+        self.kdf_parameters = {}
+        fields = {}
+        i = 12
+        size_format = '<BH' if major == 3 else '<BI'
+        size_length = struct.calcsize(size_format)
+        while True:
+            if i + size_length > len(contents):
+                raise InvalidDatabaseError("Header is truncated.")
+            field_id, size = struct.unpack_from(size_format, contents, i)
+            i += size_length
+            fields[field_id] = contents[i:i + size]
+            i += size
+            if field_id == self.END:
+                break
+        # The header bytes are checked against the hash and HMAC that
+        # follow them in KDBX 4.
+        self.header_bytes = contents[:i]
+        self.size = i
+        self.cipher_id = fields.get(self.CIPHER_ID)
+        self.master_seed = fields.get(self.MASTER_SEED)
+        self.encryption_iv = fields.get(self.ENCRYPTION_IV)
+        if self.COMPRESSION_FLAGS in fields:
+            self.compressed = struct.unpack(
+                '<I', fields[self.COMPRESSION_FLAGS])[0] == 1
+        if major == 3:
+            self.protected_stream_key = fields.get(self.PROTECTED_STREAM_KEY)
+            self.stream_start_bytes = fields.get(self.STREAM_START_BYTES)
+            if self.INNER_RANDOM_STREAM_ID in fields:
+                self.inner_random_stream_id = struct.unpack(
+                    '<I', fields[self.INNER_RANDOM_STREAM_ID])[0]
+            self.kdf_parameters = {
+                '$UUID': AES_KDF,
+                'S': fields.get(self.TRANSFORM_SEED),
+                'R': struct.unpack(
+                    '<Q', fields.get(self.TRANSFORM_ROUNDS, b'\0' * 8))[0],
+            }
+        elif self.KDF_PARAMETERS in fields:
+            self.kdf_parameters = parse_variant_dictionary(
+                fields[self.KDF_PARAMETERS])
+        if self.master_seed is None or self.cipher_id is None or \
+                self.encryption_iv is None or \
+                '$UUID' not in self.kdf_parameters or \
+                (major == 3 and self.stream_start_bytes is None):
+            raise InvalidDatabaseError("Header is missing required fields.")
+
+    @property
+    def encryption_type(self):
+        return {AES_CIPHER: 'Rijndael', CHACHA20_CIPHER: 'ChaCha20',
+                TWOFISH_CIPHER: 'Twofish'}.get(self.cipher_id, 'Unknown')
+
+
+_VARIANT_TYPES = {
+    0x04: lambda data: struct.unpack('<I', data)[0],
+    0x05: lambda data: struct.unpack('<Q', data)[0],
+    0x08: lambda data: data != b'\x00',
+    0x0C: lambda data: struct.unpack('<i', data)[0],
+    0x0D: lambda data: struct.unpack('<q', data)[0],
+    0x18: lambda data: data.decode('utf-8'),
+    0x42: lambda data: data,
+}
+
+
+def parse_variant_dictionary(data):
+    """Parse the KDBX 4 key/value structure used for the KDF parameters."""
+    i = 2
+    values = {}
+    while i < len(data):
+        value_type = struct.unpack_from('<B', data, i)[0]
+        i += 1
+        if value_type == 0:
+            break
+        key_size = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        key = data[i:i + key_size].decode('utf-8')
+        i += key_size
+        value_size = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        value = data[i:i + value_size]
+        i += value_size
+        if value_type in _VARIANT_TYPES:
+            values[key] = _VARIANT_TYPES[value_type](value)
+    return values
+
+
+class KdbxDatabase(Database):
+    """A KDBX file, read into the same groups and entries as a KDB file.
+
+    Every group and entry is read when the database is opened.  The
+    top level group of a KDBX file (usually named after the database)
+    is the one root group.  Only the first attachment of an entry is
+    kept, and entry history isn't read.
+
+    """
+    FORMAT = 'kdbx'
+
+    def __init__(self, contents, password=None, key_file_contents=None,
+                 final_key=None, string_pool=None):
+        # ``password`` should be encoded as utf-8, see
+        # encode_kdbx_password().  A list of candidates is also
+        # accepted, as with Database.
+        self.metadata = KdbxHeader(contents)
+        self._check_encryption_type(self.metadata.encryption_type)
+        self._payload = None
+        self._entries_offset = None
+        self._groups = None
+        self._entries = None
+        self._groups_by_path = None
+        self._subtree_ends = None
+        self._url_index = None
+        self._time_indexes = {}
+        self.string_pool = string_pool
+        if isinstance(password, (list, tuple)):
+            candidates = password
+        else:
+            candidates = [password]
+        error = None
+        for candidate in candidates:
+            try:
+                groups, entries = self._open(contents, candidate,
+                                             key_file_contents)
+                break
+            except InvalidPasswordError as e:
+                error = e
+        else:
+            raise error
+        self.groups = groups
+        for entry in entries:
+            entry.group.entries.append(entry)
+        self._entries = entries
+
+    def _check_encryption_type(self, encryption_type):
+        if encryption_type not in ('Rijndael', 'ChaCha20'):
+            raise UnsupportedDatabaseError(
+                "Unsupported encryption type: %s" % encryption_type)
+
+    def _open(self, contents, password, key_file_contents):
+        header = self.metadata
+        if password is not None and not isinstance(password, bytes):
+            password = encode_kdbx_password(password)
+        with instrument.timed('calculate_key'):
+            transformed_key = transform_kdbx_key(
+                composite_key(password, key_file_contents),
+                header.kdf_parameters)
+        final_key = hashlib.sha256(header.master_seed +
+                                   transformed_key).digest()
+        if header.version[0] == 3:
+            stream = self._open_kdbx3(contents, final_key)
+            binaries = None
+        else:
+            hmac_key = hashlib.sha512(header.master_seed + transformed_key +
+                                      b'\x01').digest()
+            stream, binaries = self._open_kdbx4(contents, final_key,
+                                                hmac_key)
+        with instrument.timed('parse_entries'):
+            return _XMLReader(stream, header, binaries).read()
+
+    def _open_kdbx3(self, contents, final_key):
+        header = self.metadata
+        ciphertext = io.BytesIO(contents)
+        ciphertext.seek(header.size)
+        plaintext = _CipherReader(ciphertext, header.cipher_id, final_key,
+                                  header.encryption_iv)
+        # The payload starts with a copy of a header field, which
+        # checks the key after decrypting a couple of blocks.
+        start_bytes = _read_exactly(plaintext,
+                                    len(header.stream_start_bytes))
+        if start_bytes != header.stream_start_bytes:
+            raise InvalidPasswordError(
+                "Decryption failed, invalid stream start bytes.")
+        stream = io.BufferedReader(_HashedBlockReader(plaintext))
+        if header.compressed:
+            stream = gzip.GzipFile(fileobj=stream)
+        return stream
+
+    def _open_kdbx4(self, contents, final_key, hmac_key):
+        header = self.metadata
+        i = header.size
+        header_hash, header_hmac = contents[i:i + 32], contents[i + 32:i + 64]
+        if hashlib.sha256(header.header_bytes).digest() != header_hash:
+            raise InvalidDatabaseError("Header checksum does not match.")
+        # The header HMAC checks the key before anything is decrypted.
+        expected = _hmac(_block_key(hmac_key, 0xFFFFFFFFFFFFFFFF),
+                         header.header_bytes)
+        if not compare_digest(expected, header_hmac):
+            raise InvalidPasswordError(
+                "Decryption failed, header HMAC does not match.")
+        blocks = io.BytesIO(contents)
+        blocks.seek(i + 64)
+        stream = io.BufferedReader(_CipherReader(
+            _HMACBlockReader(blocks, hmac_key), header.cipher_id, final_key,
+            header.encryption_iv))
+        if header.compressed:
+            stream = gzip.GzipFile(fileobj=stream)
+        # The inner header holds the protected value stream settings
+        # and the attachments.
+        binaries = []
+        while True:
+            field_id, size = struct.unpack('<BI', _read_exactly(stream, 5))
+            data = _read_exactly(stream, size)
+            if field_id == 0:
+                break
+            elif field_id == 1:
+                header.inner_random_stream_id = struct.unpack('<I', data)[0]
+            elif field_id == 2:
+                header.protected_stream_key = data
+            elif field_id == 3:
+                # The first byte is a flag saying whether the
+                # attachment should be protected in memory.
+                binaries.append(data[1:])
+        return stream, binaries
+
+
+class _XMLReader(object):
+    """Builds the groups and entries from the inner XML as it's parsed."""
+
+    STRING_FIELDS = {
+        'Title': 'title',
+        'UserName': 'username',
+        'Password': 'password',
+        'URL': 'url',
+        'Notes': 'notes',
+    }
+    TIME_FIELDS = {
+        'CreationTime': 'creation_time',
+        'LastModificationTime': 'last_mod_time',
+        'LastAccessTime': 'last_acc_time',
+        'ExpiryTime': 'expiration_time',
+    }
+
+    def __init__(self, stream, header, binaries=None):
+        self._stream = stream
+        self._header = header
+        self._binaries = binaries if binaries is not None else []
+        self._protected = _protected_stream(header.inner_random_stream_id,
+                                            header.protected_stream_key)
+
+    def read(self):
+        self._groups = []
+        self._entries = []
+        self._group_stack = []
+        self._entry = None
+        # History entries are skipped, but their protected values
+        # still have to be decrypted to keep the stream in step.
+        self._history_depth = 0
+        self._key = self._value = self._ref = None
+        self._expires = False
+        path = []
+        for event, elem in ElementTree.iterparse(self._stream,
+                                                 events=('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                self._start(elem.tag)
+                continue
+            path.pop()
+            if elem.tag == 'Value' and elem.get('Protected') == 'True':
+                elem.text = self._unprotect(elem.text)
+            self._end(elem, path[-1] if path else None)
+            if elem.tag in ('Entry', 'Group', 'String', 'Binary', 'Times',
+                            'Meta'):
+                # The values have been copied out, so free the
+                # parsed elements as we go.
+                elem.clear()
+        instrument.count('entries_parsed', len(self._entries))
+        return self._groups, self._entries
+
+    def _start(self, tag):
+        if tag == 'Group':
+            group = Group()
+            group.groupid = len(self._groups) + 1
+            group.group_name = u''
+            group.level = len(self._group_stack)
+            group.imageid = 0
+            group.flags = 0
+            self._groups.append(group)
+            self._group_stack.append(group)
+        elif tag == 'History':
+            self._history_depth += 1
+        elif tag == 'Entry' and not self._history_depth:
+            self._entry = _new_entry(self._group_stack[-1])
+            self._expires = False
+
+    def _end(self, elem, parent):
+        tag = elem.tag
+        if tag == 'Binary' and parent == 'Binaries':
+            # KDBX 3 keeps the attachments in the metadata.
+            self._binaries.append(_meta_binary(elem))
+        elif tag == 'Group':
+            self._group_stack.pop()
+        elif tag == 'History':
+            self._history_depth -= 1
+        elif self._history_depth:
+            return
+        elif parent == 'Group' and tag == 'Name':
+            self._group_stack[-1].group_name = elem.text or u''
+        elif parent == 'Group' and tag == 'IconID':
+            self._group_stack[-1].imageid = int(elem.text or 0)
+        elif self._entry is not None:
+            self._end_entry_field(elem, parent)
+
+    def _end_entry_field(self, elem, parent):
+        entry = self._entry
+        tag = elem.tag
+        if tag == 'Entry':
+            if not self._expires:
+                entry.expiration_time = NEVER_EXPIRES
+            self._entries.append(entry)
+            self._entry = None
+        elif parent == 'Entry' and tag == 'UUID':
+            entry.uuid = binascii.hexlify(
+                base64.b64decode(elem.text)).decode('ascii')
+        elif parent == 'Entry' and tag == 'IconID':
+            entry.imageid = int(elem.text or 0)
+        elif parent in ('String', 'Binary') and tag == 'Key':
+            self._key = elem.text
+        elif parent == 'String' and tag == 'Value':
+            self._value = elem.text or u''
+        elif parent == 'Binary' and tag == 'Value':
+            self._ref = elem.get('Ref')
+        elif parent == 'Entry' and tag == 'String':
+            if self._key in self.STRING_FIELDS:
+                setattr(entry, self.STRING_FIELDS[self._key], self._value)
+            self._key = self._value = None
+        elif parent == 'Entry' and tag == 'Binary':
+            if entry.attachment is None and self._ref is not None:
+                data = self._binaries[int(self._ref)]
+                entry.binary_desc = self._key
+                entry.attachment = Attachment(data, 0, len(data))
+            self._key = self._ref = None
+        elif parent == 'Times' and tag in self.TIME_FIELDS:
+            setattr(entry, self.TIME_FIELDS[tag], _parse_time(elem.text))
+        elif parent == 'Times' and tag == 'Expires':
+            self._expires = elem.text == 'True'
+
+    def _unprotect(self, text):
+        if not text:
+            return text
+        data = base64.b64decode(text)
+        if self._protected is not None:
+            data = self._protected.decrypt(data)
+        return data.decode('utf-8')
+
+
+def _new_entry(group):
+    entry = Entry()
+    entry.group = group
+    entry.groupid = group.groupid
+    entry.imageid = 0
+    for name in _XMLReader.STRING_FIELDS.values():
+        setattr(entry, name, u'')
+    entry.binary_desc = u''
+    return entry
+
+
+def _meta_binary(elem):
+    data = base64.b64decode(elem.text or b'')
+    if elem.get('Compressed') == 'True':
+        data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    return data
+
+
+def _parse_time(text):
+    if not text:
+        return None
+    if '-' in text:
+        # KDBX 3 stores times as ISO 8601.
+        return datetime.datetime.strptime(text[:19], '%Y-%m-%dT%H:%M:%S')
+    # KDBX 4 stores the number of seconds since 0001-01-01.
+    seconds = struct.unpack('<q', base64.b64decode(text))[0]
+    return _EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def _protected_stream(stream_id, key):
+    if stream_id == SALSA20_STREAM:
+        return _new_cipher('Salsa20', key=hashlib.sha256(key).digest(),
+                           nonce=SALSA20_NONCE)
+    elif stream_id == CHACHA20_STREAM:
+        digest = hashlib.sha512(key).digest()
+        return _new_cipher('ChaCha20', key=digest[:32], nonce=digest[32:44])
+    elif stream_id in (None, 0):
+        return None
+    raise UnsupportedDatabaseError(
+        "Unsupported protected value stream: %s" % stream_id)
+
+
+def _new_cipher(name, **kwargs):
+    # Salsa20 and ChaCha20 come from pycryptodome.  PyCrypto, which
+    # provides the same Crypto package, doesn't have them.
+    try:
+        module = importlib.import_module('Crypto.Cipher.' + name)
+        return module.new(**kwargs)
+    except (ImportError, TypeError):
+        raise UnsupportedDatabaseError(
+            "%s isn't available, pycryptodome needs to be installed "
+            "to open this database." % name)
+
+
+def _key_file_key(key_file_contents):
+    # KeePass 2 key files are usually XML.
+    stripped = key_file_contents.lstrip()
+    if stripped.startswith(b'<?xml') or stripped.startswith(b'<KeyFile'):
+        try:
+            root = ElementTree.fromstring(key_file_contents)
+        except ElementTree.ParseError:
+            return key_file_key(key_file_contents)
+        data = root.find('Key/Data')
+        version = root.findtext('Meta/Version') or ''
+        if data is not None and version.startswith('2.'):
+            return binascii.unhexlify(''.join(data.text.split()))
+        elif data is not None:
+            return base64.b64decode(data.text.strip())
+    return key_file_key(key_file_contents)
+
+
+def _block_key(hmac_key, index):
+    return hashlib.sha512(struct.pack('<Q', index) + hmac_key).digest()
+
+
+def _hmac(key, data):
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+
+def _read_exactly(stream, size):
+    # Raw streams may return less than asked for, so keep reading
+    # until there's enough or the stream ends.
+    chunks = []
+    remaining = size
+    while remaining:
+        data = stream.read(remaining)
+        if not data:
+            raise InvalidDatabaseError("Database is truncated.")
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+class _BlockReader(io.RawIOBase):
+    # Serves the data of a sequence of blocks, reading the next block
+    # from the underlying stream only when the current one runs out.
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._block = b''
+        self._position = 0
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self._position == len(self._block):
+            if self._done:
+                return 0
+            block = self._next_block()
+            if block is None:
+                self._done = True
+                return 0
+            self._block = block
+            self._position = 0
+        size = min(len(buf), len(self._block) - self._position)
+        buf[:size] = self._block[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def _next_block(self):
+        raise NotImplementedError("_next_block")
+
+
+class _HashedBlockReader(_BlockReader):
+    # KDBX 3: each block is an index, the sha256 of the data, the
+    # size and the data.  The last block is empty.
+    def __init__(self, stream):
+        super(_HashedBlockReader, self).__init__(stream)
+        self._index = 0
+
+    def _next_block(self):
+        index, block_hash, size = struct.unpack(
+            '<I32sI', _read_exactly(self._stream, 40))
+        if index != self._index:
+            raise InvalidDatabaseError("Blocks are out of order.")
+        self._index += 1
+        if size == 0:
+            return None
+        data = _read_exactly(self._stream, size)
+        if hashlib.sha256(data).digest() != block_hash:
+            raise InvalidDatabaseError("Block %s is corrupt." % index)
+        return data
+
+
+class _HMACBlockReader(_BlockReader):
+    # KDBX 4: each block is an HMAC of the block's index, size and
+    # data, the size and the data.  The last block is empty.
+    def __init__(self, stream, hmac_key):
+        super(_HMACBlockReader, self).__init__(stream)
+        self._hmac_key = hmac_key
+        self._index = 0
+
+    def _next_block(self):
+        block_hmac, size = struct.unpack(
+            '<32si', _read_exactly(self._stream, 36))
+        data = _read_exactly(self._stream, size) if size else b''
+        expected = _hmac(_block_key(self._hmac_key, self._index),
+                         struct.pack('<Qi', self._index, size) + data)
+        if not compare_digest(expected, block_hmac):
+            raise InvalidDatabaseError(
+                "Block %s is corrupt." % self._index)
+        self._index += 1
+        if size == 0:
+            return None
+        return data
+
+
+class _CipherReader(_BlockReader):
+    # Decrypts the stream a chunk at a time.  With AES-CBC the last
+    # block is held back until the end of the stream so the padding
+    # can be removed.
+    def __init__(self, stream, cipher_id, key, iv):
+        super(_CipherReader, self).__init__(stream)
+        if cipher_id == AES_CIPHER:
+            self._cipher = AES.new(key, AES.MODE_CBC, iv)
+            self._padded = True
+        else:
+            self._cipher = _new_cipher('ChaCha20', key=key, nonce=iv)
+            self._padded = False
+        self._pending = b''
+        self._eof = False
+
+    def _next_block(self):
+        while not self._eof:
+            chunk = self._stream.read(CHUNK_SIZE)
+            if not chunk:
+                self._eof = True
+                break
+            instrument.count('bytes_decrypted', len(chunk))
+            if not self._padded:
+                return self._cipher.decrypt(chunk)
+            data = self._pending + chunk
+            usable = len(data) - len(data) % AES.block_size
+            if usable == len(data):
+                # Keep the last block back in case it's the final one.
+                usable -= AES.block_size
+            self._pending = data[usable:]
+            if usable:
+                return self._cipher.decrypt(data[:usable])
+        if not self._padded or not self._pending:
+            return None
+        if len(self._pending) != AES.block_size:
+            raise InvalidDatabaseError("Database is truncated.")
+        last = bytearray(self._cipher.decrypt(self._pending))
+        self._pending = b''
+        extra = last[-1]
+        if not 1 <= extra <= AES.block_size or \
+                last[-extra:] != bytearray([extra]) * extra:
+            raise InvalidPasswordError("Decryption failed, invalid padding.")
+        return bytes(last[:-extra]) or None
@@ -1,21 +1,46 @@
+import io
 import sys
 import os
+import time
+import shutil
 import argparse
 import getpass
+import itertools
+import datetime
 
 import yaml
-from prettytable import PrettyTable
 
-from keepassx.db import Database, encode_password
+from keepassx.db import Database, Header, password_candidates
+from keepassx.db import encode_password, NEVER_EXPIRES
+from keepassx.db import derive_key, derive_final_key, open_databases
 from keepassx.db import InvalidPasswordError, EntryNotFoundError
+from keepassx.db import InvalidDatabaseError, GroupNotFoundError
+from keepassx.db import KeyDerivationTimeoutError
 from keepassx import clipboard
+from keepassx import formatters
+from keepassx import instrument
+from keepassx import index
+from keepassx import session
+from keepassx import audit
+from keepassx import kdbx
+from keepassx import importer
+from keepassx import shell
+from keepassx import completion
+from keepassx import utils
+from keepassx.writer import DatabaseWriter, DEFAULT_KEY_ENCRYPTION_ROUNDS
 from keepassx import __version__
 
 
 CONFIG_FILENAME = os.path.expanduser('~/.kpconfig')
+# How much of an attachment is written out at a time.
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# The names of the groups that aren't listed unless asked for with
+# --group.  They're matched by name wherever they are in the tree,
+# along with their subgroups.
+EXCLUDED_GROUPS = ['Backup']
 
 
-def open_db_file(args):
+def get_db_filename(args):
     if args.db_file is not None:
         db_file = args.db_file
     elif 'KP_DB_FILE' in os.environ:
@@ -23,7 +48,11 @@ def open_db_file(args):
     else:
         sys.stderr.write("Must supply a db filename.\n")
         sys.exit(1)
-    return open(os.path.expanduser(db_file), 'rb')
+    return os.path.expanduser(db_file)
+
+
+def open_db_file(args):
+    return open(get_db_filename(args), 'rb')
 
 
 def open_key_file(args):
@@ -37,7 +66,7 @@ def open_key_file(args):
     return open(os.path.expanduser(key_file), 'rb')
 
 
-def create_db(args):
+def read_password_text(args):
     if 'KP_INSECURE_PASSWORD' in os.environ:
         # This env var is really intended for testing purposes.
         # No one should be using this var.
@@ -46,40 +75,258 @@ def create_db(args):
         password = sys.stdin.read()
     else:
         password = getpass.getpass('Password: ')
-    password = encode_password(password)
-    db_file = open_db_file(args)
+    return password
+
+
+def read_password(args):
+    # Every encoding keepassx may have used is tried at once.
+    return password_candidates(read_password_text(args))
+
+
+def read_key_file(args):
     key_file = open_key_file(args)
-    if key_file is not None:
-        key_file_contents = key_file.read()
-    else:
+    if key_file is None:
         # A key file is optional, so it's ok if no key file
         # was specified.
-        key_file_contents = None
-    db = Database(db_file.read(), password=password,
-                  key_file_contents=key_file_contents)
+        return None
+    with instrument.timed('read'):
+        return key_file.read()
+
+
+def read_db_file(args):
+    """Read the database file.
+
+    Returns a tuple of the db filename, the db file contents and
+    the parsed header, which is a ``KdbxHeader`` for KDBX files.
+
+    """
+    db_file = open_db_file(args)
+    with instrument.timed('read'):
+        contents = db_file.read()
+    if kdbx.is_kdbx(contents):
+        return db_file.name, contents, kdbx.KdbxHeader(contents)
+    return db_file.name, contents, Header(contents[:Header.HEADER_SIZE])
+
+
+def get_transformed_key(args, db_filename, contents, header,
+                        use_session=True):
+    """Return the transformed key of the database.
+
+    The key from an unlocked session is used if there is one,
+    otherwise the user is prompted for their password.
+
+    """
+    if use_session:
+        transformed_key = session.load_session(db_filename, header)
+        if transformed_key is not None:
+            return transformed_key
+    passwords = read_password(args)
+    key_file_contents = read_key_file(args)
+    deadline = None
+    if args.deadline is not None:
+        deadline = time.time() + args.deadline
+    progress = None
+    if sys.stderr.isatty():
+        progress = ProgressBar('Deriving key', sys.stderr)
+    try:
+        with instrument.timed('calculate_key'):
+            return derive_key(header, contents[Header.HEADER_SIZE:],
+                              passwords, key_file_contents,
+                              progress=progress.update if progress else None,
+                              deadline=deadline)[0]
+    finally:
+        if progress is not None:
+            progress.clear()
+
+
+class ProgressBar(object):
+    """A progress bar for slow operations.
+
+    Nothing is drawn until the operation has taken ``delay`` seconds,
+    so quick operations don't flash a bar.
+
+    """
+    WIDTH = 30
+
+    def __init__(self, label, stream, delay=0.5):
+        self.label = label
+        self.stream = stream
+        self._start = time.time()
+        self._delay = delay
+        self._percent = None
+
+    def update(self, done, total):
+        if time.time() - self._start < self._delay:
+            return
+        percent = 100 * done // total if total else 100
+        if percent == self._percent:
+            return
+        self._percent = percent
+        filled = self.WIDTH * percent // 100
+        self.stream.write('\r%s [%s%s] %3d%%' % (
+            self.label, '#' * filled, ' ' * (self.WIDTH - filled), percent))
+        self.stream.flush()
+
+    def clear(self):
+        if self._percent is not None:
+            self.stream.write('\r%s\r' % (
+                ' ' * (len(self.label) + self.WIDTH + 8)))
+            self.stream.flush()
+            self._percent = None
+
+
+def unlock_db_file(args, db_filename, contents, header):
+    """Derive the final key of a KDB file."""
+    transformed_key = get_transformed_key(args, db_filename, contents,
+                                          header)
+    return derive_final_key(header.master_seed, transformed_key)
+
+
+def open_kdbx(args, contents):
+    # KDBX passwords are always utf-8, and the key derivation
+    # happens as the database is opened.  Sessions and the
+    # index only support KDB files.
+    return kdbx.KdbxDatabase(contents, password=read_password_text(args),
+                             key_file_contents=read_key_file(args))
+
+
+def create_db(args):
+    db_filename, contents, header = read_db_file(args)
+    if isinstance(header, kdbx.KdbxHeader):
+        return open_kdbx(args, contents)
+    final_key = unlock_db_file(args, db_filename, contents, header)
+    db = Database(contents, final_key=final_key)
+    refresh_completion_cache(args, db_filename, header, db)
     return db
 
 
+def refresh_completion_cache(args, db_filename, header, db, names=None):
+    if not args.completion_cache:
+        return
+    try:
+        with instrument.timed('completion_cache'):
+            completion.refresh_cache(db_filename, header, db, names)
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write("Could not update the completion cache: %s\n" % e)
+
+
 def do_list(args):
     db = create_db(args)
-    t = PrettyTable(['Title', 'Uuid', 'GroupName'])
-    t.align['Title'] = 'l'
-    t.align['GroupName'] = 'l'
-    if args.term is None:
-        entries = sorted(db.entries, key=lambda x: x.title.lower())
+    formatter = formatters.get_formatter(
+        args.format, sys.stdout, fields=['title', 'uuid', 'group'],
+        headers=['Title', 'Uuid', 'GroupName'])
+    if not formatter.STREAMING:
+        formatter.set_alignment('Title', 'l')
+        formatter.set_alignment('GroupName', 'l')
+    by_time = (args.modified_since is not None or
+               args.expires_before is not None)
+    if args.term is None and by_time:
+        entries = _filter_groups(db, args, _query_times(db, args))
+    elif args.term is None:
+        # Entries are decoded as they're written, so streaming
+        # formats start writing right away and don't hold every
+        # entry in memory.
+        entries = db.iter_entries(_listed_groups(db, args))
+        sort = args.sort
+        if sort is None:
+            # Streaming formats write rows in the order they're
+            # stored by default.
+            sort = not formatter.STREAMING
+        if sort:
+            entries = sorted(entries, key=_title_sort_key)
     else:
-        entries = _search_for_entry(db, args.term)
+        entries = _filter_groups(db, args, _search_for_entry(db, args.term))
+        if by_time:
+            entries = _filter_times(args, entries)
+    if by_time and args.sort:
+        entries = sorted(entries, key=_title_sort_key)
+    if args.limit is not None:
+        entries = itertools.islice(entries, args.limit)
     for entry in entries:
-        if entry.group.group_name == 'Backup':
-            continue
-        t.add_row([entry.title, entry.uuid, entry.group.group_name])
-    print(t)
+        formatter.write_row([entry.title, entry.uuid, entry.group.path])
+    formatter.close()
+
+
+def _listed_groups(db, args):
+    # The groups whose entries are listed, which is the --group
+    # subtree, or every group that isn't excluded.
+    if args.group is not None:
+        return set(db.subtree_groups(args.group))
+    return set(db.included_groups(names=EXCLUDED_GROUPS))
+
+
+def _filter_groups(db, args, entries):
+    groups = _listed_groups(db, args)
+    return [entry for entry in entries if entry.group in groups]
+
+
+def _query_times(db, args):
+    # Entries expiring soonest or, without --expires-before, modified
+    # most recently come first, so --limit keeps the most urgent ones.
+    with instrument.timed('search'):
+        if args.expires_before is not None:
+            entries = db.expires_before(args.expires_before)
+            if args.modified_since is not None:
+                entries = _filter_times(args, entries)
+        else:
+            entries = db.modified_since(args.modified_since)[::-1]
+    return entries
+
+
+def _filter_times(args, entries):
+    if args.modified_since is not None:
+        entries = [entry for entry in entries
+                   if entry.last_mod_time is not None and
+                   entry.last_mod_time >= args.modified_since]
+    if args.expires_before is not None:
+        entries = [entry for entry in entries
+                   if entry.expiration_time is not None and
+                   entry.expiration_time != NEVER_EXPIRES and
+                   entry.expiration_time < args.expires_before]
+    return entries
+
+
+def _duration(value):
+    try:
+        return session.parse_duration(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected a duration such as 30s or 2m: %s" % value)
+
+
+def _time_ago(value):
+    return _parse_time(value, -1)
+
+
+def _time_from_now(value):
+    return _parse_time(value, 1)
+
+
+def _parse_time(value, direction):
+    # Either a date, or a duration such as "7d" that's counted back
+    # from now (direction -1) or forward from now (direction 1).
+    for time_format in importer.TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    try:
+        seconds = session.parse_duration(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected a date such as 2015-02-03 or a duration such as "
+            "7d: %s" % value)
+    return (datetime.datetime.now() +
+            datetime.timedelta(seconds=seconds * direction))
+
+
+def _title_sort_key(entry):
+    return entry.title.lower()
 
 
 def do_get(args):
-    db = create_db(args)
     try:
-        entry = _search_for_entry(db, args.entry_id)[0]
+        entry = _get_entry(args, args.entry_id)
     except EntryNotFoundError as e:
         sys.stderr.write(str(e))
         sys.stderr.write("\n")
@@ -93,11 +340,328 @@ def do_get(args):
     for field in fields:
         print("%-10s %s" % (field + ':', getattr(entry, field)))
     if args.clipboard_copy:
-        clipboard.copy(entry.password)
+        clipboard.copy(entry.password, clear_after=args.clear_after)
         sys.stderr.write("\nPassword has been copied to clipboard.\n")
+        if args.clear_after:
+            sys.stderr.write("The clipboard will be restored in %s "
+                             "seconds.\n" % args.clear_after)
+
+
+def _get_entry(args, term):
+    if args.url:
+        db = create_db(args)
+        with instrument.timed('search'):
+            entries = db.find_by_url(term)
+        if not entries:
+            raise EntryNotFoundError("Could not find an entry for: %s" % term)
+        return entries[0]
+    if args.index:
+        return _get_entry_with_index(args, term)
+    db = create_db(args)
+    return _search_for_entry(db, term)[0]
+
+
+def _get_entry_with_index(args, term):
+    # An exact uuid or title match only needs to decrypt the
+    # blocks holding that entry.  Anything else falls back to
+    # loading the whole database, reusing the derived key.
+    db_filename, contents, header = read_db_file(args)
+    if isinstance(header, kdbx.KdbxHeader):
+        return _search_for_entry(open_kdbx(args, contents), term)[0]
+    final_key = unlock_db_file(args, db_filename, contents, header)
+    index_filename = index.index_filename(db_filename)
+    rebuild_index = False
+    try:
+        with instrument.timed('index_lookup'):
+            entries = index.find_entries(
+                contents, final_key, index.read_index(index_filename), term)
+        if entries:
+            return entries[0]
+    except index.InvalidIndexError:
+        rebuild_index = True
+    db = Database(contents, final_key=final_key)
+    refresh_completion_cache(args, db_filename, header, db)
+    if rebuild_index:
+        try:
+            # Built from the payload the database has already
+            # decrypted, before the search decodes the entries.
+            index.write_index(index_filename, index.EntryIndex.from_database(
+                db).serialize(final_key))
+        except (IOError, OSError) as e:
+            sys.stderr.write("Could not write index file: %s\n" % e)
+    return _search_for_entry(db, term)[0]
+
+
+def do_attachment(args):
+    db = create_db(args)
+    try:
+        entry = _search_for_entry(db, args.entry_id)[0]
+    except EntryNotFoundError as e:
+        sys.stderr.write(str(e))
+        sys.stderr.write("\n")
+        return
+    if not entry.attachment:
+        sys.stderr.write("Entry has no attachment: %s\n" % entry.title)
+        return
+    reader = entry.attachment.open()
+    try:
+        if args.output is None or args.output == '-':
+            # Attachments are binary, so on python3 we need to write
+            # to the underlying byte stream.
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            shutil.copyfileobj(reader, out, ATTACHMENT_CHUNK_SIZE)
+            out.flush()
+        else:
+            with open(os.path.expanduser(args.output), 'wb') as out:
+                shutil.copyfileobj(reader, out, ATTACHMENT_CHUNK_SIZE)
+            sys.stderr.write("Attachment %s written to %s\n" % (
+                entry.binary_desc, args.output))
+    finally:
+        reader.close()
+
+
+def do_audit(args):
+    db = create_db(args)
+    with audit.HashList(os.path.expanduser(args.breached)) as hashes:
+        if args.prefix_index and not hashes.load_prefix_index():
+            with instrument.timed('build_prefix_index'):
+                hashes.build_prefix_index()
+            try:
+                hashes.save_prefix_index()
+            except (IOError, OSError) as e:
+                sys.stderr.write("Could not write prefix index: %s\n" % e)
+        breached = audit.find_breached(
+            db.exclude_groups(names=EXCLUDED_GROUPS), hashes)
+    if not breached:
+        sys.stderr.write("No breached passwords found.\n")
+        return
+    formatter = formatters.get_formatter(
+        args.format, sys.stdout, fields=['title', 'uuid', 'group', 'count'],
+        headers=['Title', 'Uuid', 'GroupName', 'Breaches'])
+    if not formatter.STREAMING:
+        formatter.set_alignment('Title', 'l')
+        formatter.set_alignment('GroupName', 'l')
+    for entry, count in breached:
+        formatter.write_row([entry.title, entry.uuid, entry.group.path,
+                             count])
+    formatter.close()
+
+
+def do_diff(args):
+    filenames = [args.ours, args.theirs]
+    contents_list = []
+    with instrument.timed('read'):
+        for filename in filenames:
+            with open(os.path.expanduser(filename), 'rb') as f:
+                contents_list.append(f.read())
+    if len(set(kdbx.is_kdbx(contents) for contents in contents_list)) > 1:
+        sys.stderr.write("Can't compare a KDB database with a KDBX "
+                         "database.\n")
+        return
+    password = read_password_text(args)
+    key_file_contents = read_key_file(args)
+    with instrument.timed('calculate_key'):
+        if any(kdbx.is_kdbx(contents) for contents in contents_list):
+            ours, theirs = [_open_database(contents, password,
+                                           key_file_contents)
+                            for contents in contents_list]
+        else:
+            # Both databases are unlocked at the same time.
+            ours, theirs = open_databases(
+                contents_list, password_candidates(password),
+                key_file_contents)
+    diffs = ours.diff(theirs)
+    if not diffs:
+        sys.stderr.write("No differences.\n")
+        return
+    names = {'ours': args.ours, 'theirs': args.theirs}
+    formatter = formatters.get_formatter(
+        args.format, sys.stdout,
+        fields=['status', 'title', 'uuid', 'fields', 'newer'],
+        headers=['Status', 'Title', 'Uuid', 'Fields', 'Newer'])
+    if not formatter.STREAMING:
+        formatter.set_alignment('Title', 'l')
+        formatter.set_alignment('Fields', 'l')
+    for diff in diffs:
+        status = diff.status
+        if status == diff.ADDED:
+            status = 'only in %s' % args.theirs
+        elif status == diff.REMOVED:
+            status = 'only in %s' % args.ours
+        formatter.write_row([status, diff.entry.title, diff.entry.uuid,
+                             ', '.join(diff.fields),
+                             names.get(diff.newer, '')])
+    formatter.close()
+
+
+def _open_database(contents, password, key_file_contents):
+    if kdbx.is_kdbx(contents):
+        return kdbx.KdbxDatabase(contents, password, key_file_contents)
+    return Database(contents, password_candidates(password),
+                    key_file_contents)
+
+
+def do_import(args):
+    db_filename = get_db_filename(args)
+    input_format = args.input_format or importer.guess_format(args.input)
+    db = None
+    if os.path.exists(db_filename):
+        db_filename, contents, header = read_db_file(args)
+        if isinstance(header, kdbx.KdbxHeader):
+            sys.stderr.write("Can only import into KDB files.\n")
+            return
+        # The existing transformed key is reused, so the password is
+        # only transformed once for both reading and writing.
+        transformed_key = get_transformed_key(args, db_filename, contents,
+                                              header)
+        db = Database(contents, final_key=derive_final_key(
+            header.master_seed, transformed_key))
+        writer = DatabaseWriter(
+            key_encryption_rounds=header.key_encryption_rounds,
+            master_seed2=header.master_seed2,
+            transformed_key=transformed_key)
+    else:
+        password = _read_new_password(args)
+        if password is None:
+            sys.stderr.write("Passwords do not match.\n")
+            return
+        writer = DatabaseWriter(password=encode_password(password),
+                                key_file_contents=read_key_file(args),
+                                key_encryption_rounds=args.rounds)
+    if args.input == '-':
+        stream = io.open(sys.stdin.fileno(), encoding='utf-8-sig',
+                         newline='', closefd=False)
+    else:
+        stream = io.open(os.path.expanduser(args.input),
+                         encoding='utf-8-sig', newline='')
+    try:
+        with instrument.timed('import'):
+            count = importer.import_records(
+                writer, importer.read_records(stream, input_format),
+                db=db, default_group=args.group)
+    except importer.InvalidRecordError as e:
+        sys.stderr.write("Could not import %s: %s\n" % (args.input, e))
+        return
+    finally:
+        stream.close()
+    # Drop the existing records before the new file is encrypted.
+    del db
+    with instrument.timed('serialize'):
+        contents = writer.serialize()
+    utils.replace_file(db_filename, contents)
+    sys.stderr.write("Imported %s entr%s into %s.\n" % (
+        count, 'y' if count == 1 else 'ies', db_filename))
+
+
+def _read_new_password(args):
+    if 'KP_INSECURE_PASSWORD' in os.environ or args.stdin:
+        return read_password_text(args)
+    password = getpass.getpass('New password: ')
+    if getpass.getpass('Confirm password: ') != password:
+        return None
+    return password
+
+
+def do_shell(args):
+    db = create_db(args)
+    entries = db.exclude_groups(names=EXCLUDED_GROUPS)
+    shell.Shell(entries, clear_after=args.clear_after).cmdloop()
+
+
+def do_complete(args):
+    # This runs on every tab press, so it never prompts for a
+    # password.  The cache is used if it's enabled, and an unlocked
+    # session brings it up to date (or stands in for it).
+    db_filename = get_db_filename(args)
+    with open(db_filename, 'rb') as f:
+        contents = f.read(Header.HEADER_SIZE)
+    if kdbx.is_kdbx(contents):
+        return
+    header = Header(contents)
+    cached = None
+    if args.completion_cache:
+        cached = completion.read_cache(db_filename)
+    if cached is not None and cached[0] == header.contents_hash:
+        names = cached[1]
+    else:
+        transformed_key = session.load_session(db_filename, header)
+        if transformed_key is not None:
+            names = _session_candidates(args, db_filename, header,
+                                        transformed_key)
+        elif cached is not None:
+            # Titles from before the database last changed are
+            # better than nothing.
+            names = cached[1]
+        else:
+            return
+    for name in completion.complete(names, args.prefix):
+        print(name)
+
+
+def _session_candidates(args, db_filename, header, transformed_key):
+    # Reading the titles decrypts the whole database, so they're kept
+    # with the session for the tab presses that follow.
+    names = completion.read_session_cache(db_filename, header,
+                                          transformed_key)
+    if names is not None:
+        return names
+    with open(db_filename, 'rb') as f:
+        contents = f.read()
+    db = Database(contents, final_key=derive_final_key(
+        header.master_seed, transformed_key))
+    names = completion.candidates(completion.entry_names(db))
+    if args.completion_cache:
+        refresh_completion_cache(args, db_filename, header, db, names)
+        return names
+    try:
+        completion.write_session_cache(db_filename, header, transformed_key,
+                                       names)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Could not update the completion cache: %s\n" % e)
+    return names
+
+
+def do_completion(args):
+    commands = sorted(name for name in args.commands if name != 'complete')
+    sys.stdout.write(completion.completion_script(args.shell, commands))
+
+
+def do_unlock(args):
+    try:
+        duration = session.parse_duration(args.duration)
+    except ValueError as e:
+        sys.stderr.write("%s\n" % e)
+        return
+    db_filename, contents, header = read_db_file(args)
+    if isinstance(header, kdbx.KdbxHeader):
+        raise session.SessionError(
+            "Sessions are not supported for KDBX databases.")
+    # Always ask for the password so unlocking extends a session
+    # only for someone who knows it.
+    transformed_key = get_transformed_key(args, db_filename, contents,
+                                          header, use_session=False)
+    # Opening the database verifies the password before it's stored.
+    Database(contents, final_key=derive_final_key(header.master_seed,
+                                                  transformed_key))
+    expires = session.create_session(db_filename, header, transformed_key,
+                                     duration)
+    sys.stderr.write("Unlocked %s until %s.\n" % (
+        db_filename, time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.localtime(expires))))
+
+
+def do_lock(args):
+    removed = session.end_sessions()
+    sys.stderr.write("Ended %s session%s.\n" % (
+        removed, '' if removed == 1 else 's'))
 
 
 def _search_for_entry(db, term):
+    with instrument.timed('search'):
+        return _find_entries(db, term)
+
+
+def _find_entries(db, term):
     entries = None
     try:
         entries = [db.find_by_uuid(term)]
@@ -124,6 +688,11 @@ def merge_config_file_values(args):
             args.db_file = config_data.get('db_file')
         if args.key_file is None:
             args.key_file = config_data.get('key_file')
+        if not args.index:
+            args.index = config_data.get('index', False)
+        if not args.completion_cache:
+            args.completion_cache = config_data.get('completion_cache',
+                                                    False)
 
 
 def create_parser():
@@ -142,6 +711,21 @@ def create_parser():
                              'password will be read from stdin and '
                              'you will not be prompted for your '
                              'master password')
+    parser.add_argument('--index', action='store_true',
+                        help='Look up entries by uuid or exact title using '
+                             'an encrypted index file stored next to the '
+                             '.kdb file, so only that entry is decrypted.')
+    parser.add_argument('--completion-cache', action='store_true',
+                        help='Keep an encrypted cache of entry titles and '
+                             'uuids so "kp complete" can answer without '
+                             'the password.  See "kp completion".')
+    parser.add_argument('--deadline', type=_duration, metavar='DURATION',
+                        help='Give up if deriving the key from the '
+                             'password takes longer than this, for '
+                             'example "30s".')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print a breakdown of where time was spent '
+                             'to stderr.')
     parser.add_argument('--version', action='version',
                         version='%(prog)s version ' + __version__)
     subparsers = parser.add_subparsers()
@@ -151,16 +735,149 @@ def create_parser():
                              'match the specified term.  Can be an entry id, '
                              'a uuid, or anything else supported by the "get" '
                              'command.')
+    list_parser.add_argument('-g', '--group',
+                             help='Only list entries in this group and its '
+                                  'subgroups, for example "Internet/Email".')
+    list_parser.add_argument('-f', '--format', default='table',
+                             choices=formatters.FORMATS,
+                             help='The output format.  Every format other '
+                                  'than "table" is written as entries are '
+                                  'read.')
+    list_parser.add_argument('--sort', action='store_true', default=None,
+                             help='Sort entries by title.  This is the '
+                                  'default for the table format.')
+    list_parser.add_argument('--no-sort', action='store_false', dest='sort',
+                             help='List entries in the order they are '
+                                  'stored in the database.')
+    list_parser.add_argument('--modified-since', type=_time_ago,
+                             metavar='TIME',
+                             help='Only list entries modified at or after '
+                                  'this time, either a date such as '
+                                  '"2015-02-03" or "2015-02-03 14:00" or a '
+                                  'duration such as "7d" ago.  The most '
+                                  'recently modified entries are listed '
+                                  'first.')
+    list_parser.add_argument('--expires-before', type=_time_from_now,
+                             metavar='TIME',
+                             help='Only list entries that expire before '
+                                  'this time, either a date or a duration '
+                                  'such as "30d" from now.  Entries that '
+                                  'have already expired are included, and '
+                                  'the entries that expire first are listed '
+                                  'first.')
+    list_parser.add_argument('--limit', type=int, metavar='COUNT',
+                             help='List at most this many entries.')
     list_parser.set_defaults(run=do_list)
 
     get_parser = subparsers.add_parser('get', help='Get password for entry')
     get_parser.add_argument('entry_id', help='Entry name or uuid.')
     get_parser.add_argument('entry_fields', nargs='*',
                             help='Either username or password')
+    get_parser.add_argument('-u', '--url', action='store_true',
+                            help='Treat entry_id as a URL and get the entry '
+                                 'for its domain, or the closest parent '
+                                 'domain that has one.')
     get_parser.add_argument('-n', '--no-clipboard-copy', action="store_false",
                             dest="clipboard_copy", default=True,
                             help="Don't copy the password to the clipboard")
+    get_parser.add_argument('-c', '--clear-after', type=int, metavar='SECONDS',
+                            help='Restore the previous clipboard contents '
+                                 'after this many seconds.  This happens in '
+                                 'the background, kp exits immediately.')
     get_parser.set_defaults(run=do_get)
+
+    attachment_parser = subparsers.add_parser(
+        'attachment', help='Save the attachment of an entry')
+    attachment_parser.add_argument('entry_id', help='Entry name or uuid.')
+    attachment_parser.add_argument('-o', '--output',
+                                   help='The filename to write the '
+                                        'attachment to.  By default the '
+                                        'attachment is written to stdout.')
+    attachment_parser.set_defaults(run=do_attachment)
+
+    audit_parser = subparsers.add_parser(
+        'audit', help='Check passwords against a list of breached passwords')
+    audit_parser.add_argument('--breached', required=True, metavar='FILE',
+                              help='A sorted list of SHA-1 password hashes '
+                                   'in the Have I Been Pwned format.  The '
+                                   'list is searched in place, nothing is '
+                                   'sent over the network.')
+    audit_parser.add_argument('--prefix-index', action='store_true',
+                              help='Build (or reuse) an index of the hash '
+                                   'list stored next to it, which makes '
+                                   'each lookup touch fewer pages.')
+    audit_parser.add_argument('-f', '--format', default='table',
+                              choices=formatters.FORMATS,
+                              help='The output format.')
+    audit_parser.set_defaults(run=do_audit)
+
+    diff_parser = subparsers.add_parser(
+        'diff', help='Compare the entries of two databases')
+    diff_parser.add_argument('ours', help='The first .kdb file.')
+    diff_parser.add_argument('theirs', help='The second .kdb file.  Both '
+                             'databases are opened with the same password '
+                             'and key file.')
+    diff_parser.add_argument('-f', '--format', default='table',
+                             choices=formatters.FORMATS,
+                             help='The output format.')
+    diff_parser.set_defaults(run=do_diff)
+
+    import_parser = subparsers.add_parser(
+        'import', help='Import entries from a CSV or JSON lines file')
+    import_parser.add_argument('input', help='The file to import, or "-" '
+                               'to read from stdin.  CSV files must '
+                               'have a header row.')
+    import_parser.add_argument('-f', '--format', dest='input_format',
+                               choices=importer.FORMATS,
+                               help='The format of the input.  By default '
+                                    'it is guessed from the extension.')
+    import_parser.add_argument('-g', '--group',
+                               default=importer.DEFAULT_GROUP,
+                               help='The group of entries that don\'t have '
+                                    'one.  Defaults to "%s".' %
+                                    importer.DEFAULT_GROUP)
+    import_parser.add_argument('--rounds', type=int,
+                               default=DEFAULT_KEY_ENCRYPTION_ROUNDS,
+                               help='The key transformation rounds of a '
+                                    'new database.  An existing database '
+                                    'keeps its own.')
+    import_parser.set_defaults(run=do_import)
+
+    shell_parser = subparsers.add_parser(
+        'shell', help='Unlock the database once and search it '
+                      'interactively')
+    shell_parser.add_argument('-c', '--clear-after', type=int,
+                              metavar='SECONDS',
+                              help='Restore the previous clipboard '
+                                   'contents this many seconds after '
+                                   'copying to it.')
+    shell_parser.set_defaults(run=do_shell)
+
+    complete_parser = subparsers.add_parser(
+        'complete', help='Print the titles and uuids that start with a '
+                         'prefix, for shell completion')
+    complete_parser.add_argument('prefix', nargs='?', default='')
+    complete_parser.set_defaults(run=do_complete)
+
+    completion_parser = subparsers.add_parser(
+        'completion', help='Print a shell completion script, for example '
+                           'eval "$(kp completion bash)"')
+    completion_parser.add_argument('shell', choices=sorted(
+        completion.SCRIPTS))
+    completion_parser.set_defaults(run=do_completion)
+
+    unlock_parser = subparsers.add_parser(
+        'unlock', help='Open the database without a password for a while')
+    unlock_parser.add_argument('--for', dest='duration', default='15m',
+                               help='How long the database stays unlocked, '
+                                    'for example "90s", "15m" or "2h".  '
+                                    'Defaults to 15m.')
+    unlock_parser.set_defaults(run=do_unlock)
+
+    lock_parser = subparsers.add_parser(
+        'lock', help='End every unlocked session')
+    lock_parser.set_defaults(run=do_lock)
+    completion_parser.set_defaults(commands=list(subparsers.choices))
     return parser
 
 
@@ -183,6 +900,10 @@ def main(args=None):
     parser = create_parser()
     args = _parse_args(parser, args)
     merge_config_file_values(args)
+    profile = None
+    if args.profile:
+        profile = instrument.Profile()
+        instrument.add_hook(profile)
     try:
         args.run(args)
     except KeyboardInterrupt:
@@ -191,3 +912,17 @@ def main(args=None):
     except InvalidPasswordError:
         sys.stderr.write("Invalid password, could not open "
                          "password database.\n")
+    except InvalidDatabaseError as e:
+        sys.stderr.write("Could not open password database: %s\n" % e)
+    except GroupNotFoundError as e:
+        sys.stderr.write("%s\n" % e)
+    except session.SessionError as e:
+        sys.stderr.write("%s\n" % e)
+    except KeyDerivationTimeoutError as e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    finally:
+        if profile is not None:
+            instrument.remove_hook(profile)
+            sys.stderr.write('\n')
+            sys.stderr.write(profile.report())
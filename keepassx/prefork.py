@@ -0,0 +1,301 @@
+"""Share one unlocked database between forked worker processes.
+
+A server that forks workers, such as gunicorn with ``preload_app``,
+can unlock and decode the database once in the master process instead
+of once per worker.  Forked workers share the master's memory until
+they write to it, but python writes to every object it touches when it
+updates the object's reference count, so a database held as thousands
+of ``Entry`` objects ends up copied into every worker.
+
+``FrozenDatabase`` instead holds the records in a handful of bytes
+objects: the encoded group and entry records, the offset of each
+entry, and tables of uuids and title digests sorted for binary
+search.  Lookups decode only the entry they return, so the shared
+pages are read but never written::
+
+    # gunicorn.conf.py
+    from keepassx import prefork
+
+    preload_app = True
+    db = prefork.FrozenDatabase.freeze(Database(contents, password))
+
+    def pre_fork(server, worker):
+        prefork.before_fork()
+
+    def post_fork(server, worker):
+        prefork.after_fork()
+
+``before_fork`` collects garbage and freezes everything allocated so
+far, so the garbage collector in the workers doesn't write to the
+shared objects either.  It's only meant for the forks that start
+workers.  Servers without fork hooks of their own can run them around
+every fork made inside ``fork_hooks()``::
+
+    with prefork.fork_hooks():
+        server.serve_forever()
+
+"""
+import gc
+import os
+import bisect
+import struct
+import hashlib
+from contextlib import contextmanager
+
+from keepassx import instrument
+from keepassx.db import Database, PayloadParser, StringPool, StringType
+from keepassx.db import UUIDType, EntryNotFoundError, SYSTEM_USER_UUID
+from keepassx.writer import DatabaseWriter
+
+
+_OFFSET = struct.Struct('<I')
+# A uuid, and the index of the entry.
+_UUID_ROW = struct.Struct('<16sI')
+# The first 8 bytes of the sha1 of the title, and the index of the
+# entry.
+_TITLE_ROW = struct.Struct('<8sI')
+# Whether the hooks registered with os.register_at_fork run (they
+# can't be unregistered so they're turned off instead), and whether
+# before_fork() disabled the garbage collector.
+_state = {'registered': False, 'enabled': False, 'gc_disabled': False}
+
+
+class FrozenMetadata(object):
+    """The record counts of a ``FrozenDatabase``."""
+
+    def __init__(self, num_groups, num_entries):
+        self.num_groups = num_groups
+        self.num_entries = num_entries
+        self.encryption_type = 'Rijndael'
+
+
+class FrozenDatabase(Database):
+    """A database stored as flat bytes that can be shared across forks.
+
+    The groups are decoded the first time they're needed in each
+    process.  ``find_by_uuid`` and ``find_by_title`` binary search the
+    sorted tables and decode only the matching entry, which is a new
+    object every time.  Everything else ``Database`` supports works
+    too, but accessing ``entries`` decodes every entry in the process
+    that accesses it.
+
+    """
+    def __init__(self, records, num_groups, offsets, uuid_table,
+                 title_table):
+        self.metadata = FrozenMetadata(num_groups,
+                                       len(offsets) // _OFFSET.size)
+        self._records = records
+        self._offsets = offsets
+        self._uuid_table = uuid_table
+        self._title_table = title_table
+        self._payload = records
+        self._entries_offset = (_OFFSET.unpack_from(offsets, 0)[0]
+                                if offsets else len(records))
+        self._groups = None
+        self._entries = None
+        self._groups_by_path = None
+        self._subtree_ends = None
+        self._url_index = None
+        self._time_indexes = {}
+        self.string_pool = StringPool()
+
+    @classmethod
+    def freeze(cls, db):
+        """Encode every group and entry of ``db`` into a FrozenDatabase.
+
+        ``db`` can be any ``Database``, including a ``KdbxDatabase``.
+        Drop every reference to ``db`` afterwards so the decoded
+        objects can be freed before forking.
+
+        """
+        with instrument.timed('freeze'):
+            writer = DatabaseWriter()
+            groups = db.groups
+            for group in groups:
+                writer.add_group(group)
+            for entry in db.entries:
+                writer.add_entry(entry)
+            records = bytes(writer.payload())
+            parser = PayloadParser(records)
+            i = 0
+            for _ in range(len(groups)):
+                i = parser.record_fields(i)[1]
+            offsets = []
+            uuid_rows = []
+            title_rows = []
+            for index in range(writer.num_entries):
+                offsets.append(_OFFSET.pack(i))
+                fields, i = parser.record_fields(i)
+                uuid_rows.append(_UUID_ROW.pack(
+                    _field_data(records, fields, 0x1), index))
+                title_rows.append(_TITLE_ROW.pack(
+                    _title_digest(_field_data(records, fields, 0x4)),
+                    index))
+        return cls(records, len(groups), b''.join(offsets),
+                   b''.join(sorted(uuid_rows)), b''.join(sorted(title_rows)))
+
+    @property
+    def nbytes(self):
+        """The number of bytes shared between processes."""
+        return (len(self._records) + len(self._offsets) +
+                len(self._uuid_table) + len(self._title_table))
+
+    def find_by_uuid(self, uuid):
+        """Find an entry by uuid.
+
+        :raise: EntryNotFoundError
+        """
+        try:
+            key = UUIDType.encode(uuid)
+        except (TypeError, ValueError):
+            key = None
+        if key is not None and len(key) == 16:
+            for index in _search(self._uuid_table, _UUID_ROW, key):
+                entry = self._entry_at_index(index)
+                if entry.uuid != SYSTEM_USER_UUID:
+                    return entry
+        raise EntryNotFoundError("Entry not found for uuid: %s" % uuid)
+
+    def find_by_title(self, title):
+        """Find an entry by exact title.
+
+        :raise: EntryNotFoundError
+
+        """
+        key = _title_digest(StringType.encode(title))
+        # Entries with the same title digest are checked in the order
+        # they're stored, so the first entry with the title is found.
+        for index in sorted(_search(self._title_table, _TITLE_ROW, key)):
+            entry = self._entry_at_index(index)
+            if entry.title == title and entry.uuid != SYSTEM_USER_UUID:
+                return entry
+        raise EntryNotFoundError("Entry not found for title: %s" % title)
+
+    def _entry_at_index(self, index):
+        offset = _OFFSET.unpack_from(self._offsets,
+                                     index * _OFFSET.size)[0]
+        entry = PayloadParser(self._records).parse_entry(offset)[0]
+        instrument.count('entries_decoded')
+        self._set_entry_groups(self.groups, [entry])
+        return entry
+
+
+def before_fork():
+    """Collect garbage and freeze every object allocated so far.
+
+    Call this in the master process right before forking.  Frozen
+    objects are left alone by the garbage collector, so the workers
+    don't write to the pages they share with the master.  On pythons
+    without ``gc.freeze`` (before 3.7) the collector is disabled
+    instead, and ``after_fork`` enables it in the workers and
+    ``after_fork_in_parent`` in the master.
+
+    """
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    elif gc.isenabled():
+        gc.disable()
+        _state['gc_disabled'] = True
+
+
+def after_fork():
+    """Call this in each worker process after it has been forked."""
+    _state['gc_disabled'] = False
+    gc.enable()
+
+
+def after_fork_in_parent():
+    """Call this in the master process after forking a worker."""
+    if _state['gc_disabled']:
+        _state['gc_disabled'] = False
+        gc.enable()
+
+
+def install_fork_hooks():
+    """Run the fork hooks around every ``os.fork`` until uninstalled.
+
+    Requires python 3.7 or later, returns False if the hooks couldn't
+    be installed.
+
+    """
+    if not hasattr(os, 'register_at_fork'):
+        return False
+    if not _state['registered']:
+        os.register_at_fork(before=_before_fork_hook,
+                            after_in_child=_after_fork_hook,
+                            after_in_parent=_after_fork_in_parent_hook)
+        _state['registered'] = True
+    _state['enabled'] = True
+    return True
+
+
+def uninstall_fork_hooks():
+    """Stop running the fork hooks installed by ``install_fork_hooks``."""
+    _state['enabled'] = False
+
+
+@contextmanager
+def fork_hooks():
+    """Run the fork hooks around the forks made inside the block.
+
+    Yields whether the hooks could be installed.
+
+    """
+    installed = install_fork_hooks()
+    try:
+        yield installed
+    finally:
+        uninstall_fork_hooks()
+
+
+def _before_fork_hook():
+    if _state['enabled']:
+        before_fork()
+
+
+def _after_fork_hook():
+    if _state['enabled']:
+        after_fork()
+
+
+def _after_fork_in_parent_hook():
+    if _state['enabled']:
+        after_fork_in_parent()
+
+
+def _search(table, row, key):
+    # Yield the index of every row in the sorted table that starts
+    # with key.
+    size = row.size
+    lo = bisect.bisect_left(_Keys(table, size, len(key)), key)
+    for i in range(lo, len(table) // size):
+        row_key, index = row.unpack_from(table, i * size)
+        if row_key != key:
+            break
+        yield index
+
+
+class _Keys(object):
+    # A read only sequence of the keys in a table of rows, which
+    # is what bisect searches.
+    def __init__(self, table, row_size, key_size):
+        self._table = table
+        self._row_size = row_size
+        self._key_size = key_size
+
+    def __len__(self):
+        return len(self._table) // self._row_size
+
+    def __getitem__(self, i):
+        start = i * self._row_size
+        return self._table[start:start + self._key_size]
+
+
+def _field_data(records, fields, field_type):
+    offset, size = fields.get(field_type, (0, 0))
+    return records[offset:offset + size]
+
+
+def _title_digest(encoded_title):
+    return hashlib.sha1(encoded_title).digest()[:8]
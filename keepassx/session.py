@@ -0,0 +1,176 @@
+"""Unlock sessions that skip the key derivation.
+
+Deriving the key of a database runs ``key_encryption_rounds`` AES
+rounds, which is deliberately slow.  ``kp unlock`` does this once and
+stores the transformed key for a limited time, so the ``kp`` commands
+that follow can open the database without the password::
+
+    $ kp unlock --for 15m
+    $ kp get github
+    $ kp lock
+
+Session files are kept in ``$XDG_RUNTIME_DIR/keepassx`` (or a per user
+directory in the system temp dir) which is only accessible by the
+current user.  The transformed key is encrypted and authenticated with
+keys derived from a random secret that's generated for each session and
+stored in a file of its own, so a copy of the session file alone (in a
+backup for example) doesn't reveal the key.  The secret is removed
+along with the session when it expires or by ``kp lock``.  A session
+is bound to the database's path and to the header values the
+transformed key depends on, so it stops working as soon as the
+database is saved with new seeds.
+
+"""
+import os
+import re
+import time
+import struct
+import hashlib
+
+from keepassx.utils import read_file, write_private_file, remove_file
+from keepassx.utils import private_directory, runtime_path, seal, unseal
+
+
+MAGIC = b'KPSESSN\x01'
+SESSION_SUFFIX = '.session'
+SECRET_SUFFIX = '.secret'
+CACHE_SUFFIX = '.cache'
+# The magic and the time the session expires, in the clear.
+_HEADER = struct.Struct('<8sQ')
+_DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+class SessionError(Exception):
+    pass
+
+
+def parse_duration(value):
+    """Convert a duration such as "90s", "15m" or "2h" to seconds."""
+    match = re.match(r'^\s*(\d+)\s*([smhd]?)\s*$', value)
+    if match is None:
+        raise ValueError("Invalid duration: %s" % value)
+    return int(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+def session_dir(create=True):
+    """Return the directory sessions are stored in.
+
+    The directory is created if it doesn't exist and ``create`` is
+    true, otherwise None is returned.
+
+    :raise: SessionError if the directory is accessible by other users.
+
+    """
+    path = runtime_path()
+    try:
+        return private_directory(path, create)
+    except ValueError:
+        raise SessionError("Session directory %s must only be accessible "
+                           "by the current user." % path)
+
+
+def create_session(db_filename, header, transformed_key, duration):
+    """Store the transformed key of a database for ``duration`` seconds."""
+    directory = session_dir()
+    filename = _session_filename(directory, db_filename)
+    secret = os.urandom(32)
+    write_private_file(_secret_filename(filename), secret)
+    expires = int(time.time() + duration)
+    write_private_file(filename, seal(
+        secret, transformed_key, header=_HEADER.pack(MAGIC, expires),
+        associated_data=_associated_data(db_filename, header)))
+    return expires
+
+
+def load_session(db_filename, header):
+    """Return the stored transformed key for a database.
+
+    Returns None if there's no session, or if it has expired or
+    doesn't match the database.  Expired sessions are removed.
+
+    """
+    try:
+        directory = session_dir(create=False)
+    except (SessionError, OSError):
+        return None
+    if directory is None:
+        return None
+    filename = _session_filename(directory, db_filename)
+    token = read_file(filename)
+    secret = read_file(_secret_filename(filename))
+    if token is None or secret is None or len(token) < _HEADER.size:
+        return None
+    magic, expires = _HEADER.unpack_from(token)
+    if magic != MAGIC:
+        return None
+    if expires <= time.time():
+        _remove_session(filename)
+        return None
+    transformed_key = unseal(secret, token, _HEADER.size,
+                             _associated_data(db_filename, header))
+    if transformed_key is None or len(transformed_key) != 32:
+        return None
+    return transformed_key
+
+
+def end_sessions():
+    """Remove every session along with its secret and cache."""
+    try:
+        directory = session_dir(create=False)
+    except (SessionError, OSError):
+        return 0
+    if directory is None:
+        return 0
+    removed = 0
+    for name in os.listdir(directory):
+        if name.endswith(SESSION_SUFFIX):
+            _remove_session(os.path.join(directory, name))
+            removed += 1
+        elif name.endswith((SECRET_SUFFIX, CACHE_SUFFIX)):
+            # Left behind by a session that's gone.
+            remove_file(os.path.join(directory, name))
+    return removed
+
+
+def session_cache_filename(db_filename):
+    """Return the file for data that lasts as long as a session.
+
+    ``keepassx.completion`` keeps the entry titles it reads through a
+    session there.  The file is removed along with the session.
+    Returns None if there's no session directory.
+
+    """
+    try:
+        directory = session_dir(create=False)
+    except (SessionError, OSError):
+        return None
+    if directory is None:
+        return None
+    filename = _session_filename(directory, db_filename)
+    return filename[:-len(SESSION_SUFFIX)] + CACHE_SUFFIX
+
+
+def _session_filename(directory, db_filename):
+    name = hashlib.sha256(
+        os.path.abspath(db_filename).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(directory, name + SESSION_SUFFIX)
+
+
+def _secret_filename(session_filename):
+    return session_filename[:-len(SESSION_SUFFIX)] + SECRET_SUFFIX
+
+
+def _remove_session(filename):
+    remove_file(filename)
+    remove_file(_secret_filename(filename))
+    remove_file(filename[:-len(SESSION_SUFFIX)] + CACHE_SUFFIX)
+
+
+def _associated_data(db_filename, header):
+    # The transformed key only depends on master_seed2 and the number of
+    # rounds (along with the password and key file), so those are what
+    # the session is bound to.
+    return b''.join([
+        os.path.abspath(db_filename).encode('utf-8'),
+        header.master_seed2,
+        struct.pack('<I', header.key_encryption_rounds)])
@@ -0,0 +1,216 @@
+"""An interactive shell over an unlocked database.
+
+``kp shell`` unlocks the database once and then answers any number of
+searches against the decoded entries::
+
+    kp> search git
+     1  Github                           Internet
+    kp> get username url
+    kp> copy
+
+Searches use the same tiers as ``Database.fuzzy_search_by_title``:
+exact titles, then case insensitive titles, then titles the query is
+a subsequence of, then close matches.  When a query extends the one
+before it, as it does while it's being typed or tab completed, only
+the candidates of the previous query are searched, because a title
+can't contain the longer query as a subsequence without containing
+the shorter one too.
+
+"""
+import cmd
+import difflib
+
+from keepassx import clipboard
+from keepassx import instrument
+
+
+DEFAULT_FIELDS = ['title', 'username', 'url', 'notes']
+# The number of search results that are printed.
+MAX_RESULTS = 20
+
+
+class IncrementalSearch(object):
+    """Fuzzy title search that reuses the work of earlier queries.
+
+    The lower cased titles are computed once.  The candidates of
+    each query, the entries whose title contains it as a subsequence,
+    are kept on a stack, so extending the query narrows the top of the
+    stack and deleting characters pops back to an earlier query.
+
+    """
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self._titles = [entry.title.lower() for entry in self.entries]
+        # (query, indices of the candidates) pairs, each query
+        # extending the one below it.
+        self._stack = [(u'', list(range(len(self.entries))))]
+
+    def search(self, query):
+        """Return the entries matching ``query``, best matches first."""
+        query_lower = query.lower()
+        candidates = self._candidates(query_lower)
+        titles = self._titles
+        entries = self.entries
+        exact = [i for i in candidates if entries[i].title == query]
+        if exact:
+            return [entries[i] for i in exact]
+        same_case = [i for i in candidates if titles[i] == query_lower]
+        if same_case:
+            return [entries[i] for i in same_case]
+        if candidates:
+            return [entries[i] for i in candidates]
+        # Close matches can't be narrowed down, as a typo in the
+        # query is what they're meant to catch.
+        by_title = {}
+        for i, title in enumerate(titles):
+            by_title.setdefault(title, i)
+        instrument.count('entries_scanned', len(titles))
+        matches = difflib.get_close_matches(query_lower, by_title.keys(),
+                                            cutoff=0.7)
+        return [entries[by_title[title]] for title in matches]
+
+    def _candidates(self, query):
+        stack = self._stack
+        while not query.startswith(stack[-1][0]):
+            stack.pop()
+        previous_query, previous = stack[-1]
+        if previous_query == query:
+            return previous
+        titles = self._titles
+        candidates = [i for i in previous
+                      if _is_subsequence(query, titles[i])]
+        instrument.count('entries_scanned', len(previous))
+        stack.append((query, candidates))
+        return candidates
+
+
+def _is_subsequence(short_str, full_str):
+    # Each character is searched for after the previous match.
+    remaining = iter(full_str)
+    return all(char in remaining for char in short_str)
+
+
+class Shell(cmd.Cmd):
+    """The commands of ``kp shell``.
+
+    :param entries: The entries to search.
+    :param clear_after: Restore the clipboard this many seconds after
+        copying to it.
+
+    """
+    intro = ('Type "search <title>" (or just the title) to find an entry, '
+             '"help" for the other commands.')
+    prompt = 'kp> '
+
+    def __init__(self, entries, clear_after=None, stdin=None, stdout=None):
+        cmd.Cmd.__init__(self, stdin=stdin, stdout=stdout)
+        if stdin is not None:
+            self.use_rawinput = False
+        self.title_search = IncrementalSearch(entries)
+        self.clear_after = clear_after
+        self.results = []
+        self.selected = None
+
+    def emptyline(self):
+        pass
+
+    def default(self, line):
+        if line == 'EOF':
+            return self.do_quit(line)
+        return self.do_search(line)
+
+    def do_search(self, query):
+        """search QUERY: Find entries by title and select the best match."""
+        query = query.strip()
+        if not query:
+            self._write("Usage: search QUERY")
+            return
+        self.results = self.title_search.search(query)
+        self.selected = self.results[0] if self.results else None
+        if not self.results:
+            self._write("No entries found for: %s" % query)
+            return
+        self._print_results()
+
+    def complete_search(self, text, line, begidx, endidx):
+        # Each tab press extends the query, so it only searches the
+        # candidates of the previous press.  readline replaces just
+        # the word being completed, so titles that start with the
+        # query are completed from that word on, and other matches
+        # are only offered while the query is a single word.
+        start = line.index(' ') + 1
+        query = line[start:endidx]
+        offset = begidx - start
+        titles = [entry.title for entry in self.title_search.search(query)]
+        completions = [title[offset:] for title in titles
+                       if title.lower().startswith(query.lower())]
+        if not completions and offset == 0:
+            completions = titles
+        return completions[:MAX_RESULTS]
+
+    def do_select(self, arg):
+        """select NUMBER: Select one of the results of the last search."""
+        try:
+            self.selected = self.results[int(arg) - 1]
+        except (ValueError, IndexError):
+            self._write("Select a result between 1 and %s." %
+                        len(self.results))
+            return
+        self._write("Selected %s" % self.selected.title)
+
+    def do_results(self, arg):
+        """results: Print the results of the last search again."""
+        self._print_results()
+
+    def do_get(self, arg):
+        """get [FIELD ...]: Print fields of the selected entry.
+
+        Prints the title, username, url and notes by default.
+
+        """
+        entry = self._selected_entry()
+        if entry is None:
+            return
+        for field in arg.split() or DEFAULT_FIELDS:
+            if not hasattr(entry, field):
+                self._write("Unknown field: %s" % field)
+                continue
+            self._write("%-10s %s" % (field + ':', getattr(entry, field)))
+
+    def do_copy(self, arg):
+        """copy [FIELD]: Copy the password (or FIELD) of the selected
+        entry to the clipboard."""
+        entry = self._selected_entry()
+        if entry is None:
+            return
+        field = arg.strip() or 'password'
+        if not hasattr(entry, field):
+            self._write("Unknown field: %s" % field)
+            return
+        clipboard.copy(getattr(entry, field) or u'',
+                       clear_after=self.clear_after)
+        self._write("Copied the %s of %s to the clipboard." % (
+            field, entry.title))
+
+    def do_quit(self, arg):
+        """quit: Leave the shell."""
+        return True
+
+    do_exit = do_quit
+
+    def _selected_entry(self):
+        if self.selected is None:
+            self._write("No entry selected, search for one first.")
+        return self.selected
+
+    def _print_results(self):
+        for i, entry in enumerate(self.results[:MAX_RESULTS], 1):
+            marker = '*' if entry is self.selected else ' '
+            self._write("%s%2d  %-32s %s" % (marker, i, entry.title,
+                                             entry.group.path))
+        if len(self.results) > MAX_RESULTS:
+            self._write("... and %s more." % (
+                len(self.results) - MAX_RESULTS))
+
+    def _write(self, text):
+        self.stdout.write(text + '\n')
@@ -0,0 +1,224 @@
+"""A database that can be shared between threads.
+
+``Database`` decodes its groups and entries the first time they're
+accessed, so two threads using the same instance can race to decode
+them.  ``SharedDatabase`` instead serves every lookup from a
+``Snapshot``, a fully decoded set of groups and entries that is never
+changed once it has been published::
+
+    shared = SharedDatabase(Database(contents, password))
+    # In any number of threads:
+    shared.find_by_title('Github').password
+
+Lookups don't take a lock, they read the current snapshot once and
+query it.  Reloading the database or editing its entries builds a new
+snapshot from copies of the groups and entries and publishes it with a
+single assignment, so a lookup sees either the old snapshot or the new
+one, never a mix of the two.  Only writers are serialized.
+
+"""
+import copy
+import threading
+
+from keepassx import instrument
+from keepassx.db import Database, EntryNotFoundError
+from keepassx.urlindex import DomainIndex
+
+
+class Snapshot(Database):
+    """An immutable set of groups and entries.
+
+    Every group and entry is decoded up front, exact lookups by uuid
+    and title are served from dicts, and the domain index used by
+    ``find_by_url`` is built right away.  The time indexes are built
+    the first time they're queried; threads that race to build one
+    build identical copies, and one of them is kept.  Nothing should
+    modify a snapshot, or the groups and entries in it, once it has
+    been created; see ``SharedDatabase.update`` to make changes.
+
+    """
+    def __init__(self, groups, entries, metadata=None):
+        self.metadata = metadata
+        self._payload = None
+        self._entries_offset = None
+        self._groups = None
+        self._entries = None
+        self._groups_by_path = None
+        self._subtree_ends = None
+        self._url_index = None
+        self._time_indexes = {}
+        self.string_pool = None
+        self.groups = list(groups)
+        for entry in entries:
+            entry.group.entries.append(entry)
+        self._entries = tuple(entries)
+        self._by_uuid = {}
+        self._by_title = {}
+        for entry in self._entries:
+            self._by_uuid.setdefault(entry.uuid, entry)
+            self._by_title.setdefault(entry.title, entry)
+        self._url_index = DomainIndex(self._entries)
+
+    @classmethod
+    def from_database(cls, db):
+        """Create a snapshot of every group and entry in ``db``.
+
+        ``db`` shouldn't be used after this, as the snapshot takes
+        ownership of its groups and entries.
+
+        """
+        groups = db.groups
+        entries = db.entries
+        return cls(groups, entries, db.metadata)
+
+    def find_by_uuid(self, uuid):
+        """Find an entry by uuid.
+
+        :raise: EntryNotFoundError
+        """
+        try:
+            return self._by_uuid[uuid]
+        except KeyError:
+            raise EntryNotFoundError("Entry not found for uuid: %s" % uuid)
+
+    def find_by_title(self, title):
+        """Find an entry by exact title.
+
+        :raise: EntryNotFoundError
+
+        """
+        try:
+            return self._by_title[title]
+        except KeyError:
+            raise EntryNotFoundError("Entry not found for title: %s" % title)
+
+
+class SharedDatabase(object):
+    """A database whose lookups are safe to make from any thread."""
+
+    def __init__(self, db):
+        self._write_lock = threading.Lock()
+        self._snapshot = _snapshot_of(db)
+
+    @property
+    def snapshot(self):
+        """The current snapshot.
+
+        Hold on to the snapshot to make several lookups that are
+        consistent with each other.
+
+        """
+        return self._snapshot
+
+    @property
+    def groups(self):
+        return self._snapshot.groups
+
+    @property
+    def entries(self):
+        return self._snapshot.entries
+
+    def find_by_uuid(self, uuid):
+        return self._snapshot.find_by_uuid(uuid)
+
+    def find_by_title(self, title):
+        return self._snapshot.find_by_title(title)
+
+    def find_by_url(self, url):
+        return self._snapshot.find_by_url(url)
+
+    def modified_since(self, since):
+        return self._snapshot.modified_since(since)
+
+    def expires_before(self, before):
+        return self._snapshot.expires_before(before)
+
+    def next_to_expire(self, count, now=None):
+        return self._snapshot.next_to_expire(count, now)
+
+    def fuzzy_search_by_title(self, title, ignore_groups=None):
+        return self._snapshot.fuzzy_search_by_title(title, ignore_groups)
+
+    def group_entries(self, path):
+        return self._snapshot.group_entries(path)
+
+    def subtree_groups(self, path):
+        return self._snapshot.subtree_groups(path)
+
+    def included_groups(self, paths=(), names=()):
+        return self._snapshot.included_groups(paths, names)
+
+    def exclude_groups(self, paths=(), names=()):
+        return self._snapshot.exclude_groups(paths, names)
+
+    def iter_entries(self, groups=None):
+        return self._snapshot.iter_entries(groups)
+
+    def reload(self, db):
+        """Replace every group and entry with the ones in ``db``.
+
+        ``db`` is decoded before the write lock is taken, so lookups
+        and edits carry on against the current snapshot until the new
+        one is published.
+
+        """
+        snapshot = _snapshot_of(db)
+        with self._write_lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def update(self, func):
+        """Edit the entries and publish the result as a new snapshot.
+
+        ``func`` is called with a list of copies of the current
+        entries, which it can change in place: modify the entries,
+        remove them, or append new ones.  Entries are put in the group
+        they refer to, either through ``entry.group`` or, for new
+        entries without a group, ``entry.groupid``.  The current
+        snapshot isn't affected by anything ``func`` does, and if
+        ``func`` raises an exception nothing is published.
+
+        Edits are serialized, so every edit sees the result of the
+        one before it.  Returns the new snapshot.
+
+        """
+        with self._write_lock:
+            current = self._snapshot
+            with instrument.timed('copy_snapshot'):
+                groups, entries = _copy_tree(current.groups, current.entries)
+            func(entries)
+            groups_by_groupid = dict((g.groupid, g) for g in groups)
+            group_copies = dict((id(original), group) for original, group
+                                in zip(current.groups, groups))
+            for entry in entries:
+                if entry.group is not None:
+                    entry.group = group_copies.get(id(entry.group),
+                                                   entry.group)
+                else:
+                    entry.group = groups_by_groupid[entry.groupid]
+            snapshot = Snapshot(groups, entries, current.metadata)
+            self._snapshot = snapshot
+        return snapshot
+
+
+def _snapshot_of(db):
+    if isinstance(db, Snapshot):
+        return db
+    return Snapshot.from_database(db)
+
+
+def _copy_tree(groups, entries):
+    # Shallow copies are enough, the snapshot only replaces the
+    # group tree attributes, and the attachments are immutable.
+    group_copies = {}
+    new_groups = []
+    for group in groups:
+        new_group = copy.copy(group)
+        group_copies[id(group)] = new_group
+        new_groups.append(new_group)
+    new_entries = []
+    for entry in entries:
+        new_entry = copy.copy(entry)
+        new_entry.group = group_copies[id(entry.group)]
+        new_entries.append(new_entry)
+    return new_groups, new_entries
@@ -0,0 +1,68 @@
+"""Range queries over the creation, modification and expiration times.
+
+A ``TimeIndex`` holds the entries sorted by one of their times, so
+"modified since" and "expires before" queries are a binary search
+followed by a slice, and "the next N to expire" is a binary search
+followed by taking N entries::
+
+    index = TimeIndex(db.entries, 'last_mod_time')
+    index.between(start=datetime(2015, 2, 1))
+
+"""
+import bisect
+
+
+TIME_FIELDS = ('creation_time', 'last_mod_time', 'expiration_time')
+
+
+class TimeIndex(object):
+    """Entries sorted by the time in ``field``.
+
+    Entries without a time, or with a time in ``ignore``, aren't
+    indexed.  Entries with the same time keep the order they were
+    given in.
+
+    """
+    def __init__(self, entries, field, ignore=()):
+        if field not in TIME_FIELDS:
+            raise ValueError("Not a time field: %s" % field)
+        self.field = field
+        indexed = [(getattr(entry, field), entry) for entry in entries]
+        indexed = [pair for pair in indexed
+                   if pair[0] is not None and pair[0] not in ignore]
+        indexed.sort(key=lambda pair: pair[0])
+        self.times = [pair[0] for pair in indexed]
+        self.entries = [pair[1] for pair in indexed]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def between(self, start=None, end=None):
+        """Return the entries from ``start`` up to, but not including,
+        ``end``, earliest first.
+
+        Either bound can be None to leave that side of the range open.
+
+        """
+        return self.entries[self._start(start):self._end(end)]
+
+    def first(self, count, start=None):
+        """Return the ``count`` earliest entries from ``start`` on."""
+        i = self._start(start)
+        return self.entries[i:i + count]
+
+    def last(self, count, end=None):
+        """Return the ``count`` latest entries before ``end``, latest
+        first."""
+        i = self._end(end)
+        return self.entries[max(i - count, 0):i][::-1]
+
+    def _start(self, start):
+        if start is None:
+            return 0
+        return bisect.bisect_left(self.times, start)
+
+    def _end(self, end):
+        if end is None:
+            return len(self.times)
+        return bisect.bisect_left(self.times, end)
@@ -0,0 +1,112 @@
+"""Find entries by the domain of a URL.
+
+Entry URLs are normalized to their host name, without the scheme,
+port, path or a leading ``www.``, and stored in a trie keyed by the
+labels of the host in reverse order, so ``login.example.com`` is
+stored under ``com``, ``example``, ``login``.  Looking up a URL walks
+the labels of its host once, collecting the entries stored for the
+host and each of its parent domains along the way, so the cost of a
+lookup depends on the number of labels and not on the number of
+entries::
+
+    index = DomainIndex(db.entries)
+    index.find('https://login.corp.example.com/x?y=1')
+
+"""
+import re
+
+
+# Schemes whose URLs don't name a host.  KeePass uses cmd:// for
+# commands and kdbx:// to refer to other databases.
+NON_HOST_SCHEMES = frozenset(['cmd', 'file', 'kdbx'])
+_AUTHORITY_END = re.compile(r'[/?#\\]')
+_IPV4 = re.compile(r'^\d+(\.\d+){3}$')
+# The key entries are stored under in a trie node, labels are never
+# empty.
+_ENTRIES = ''
+
+
+def normalize_host(url):
+    """Return the lower cased host of ``url`` without a leading ``www.``.
+
+    Returns None if ``url`` doesn't have a host, for example if it's
+    a KeePass placeholder or a ``cmd://`` URL.
+
+    """
+    if not url:
+        return None
+    url = url.strip()
+    scheme, sep, rest = url.partition('://')
+    if sep:
+        if scheme.lower() in NON_HOST_SCHEMES:
+            return None
+        url = rest
+    authority = _AUTHORITY_END.split(url, 1)[0]
+    if any(c in authority for c in ' {}%'):
+        # Placeholders and other text that isn't a URL.
+        return None
+    host = authority.rpartition('@')[2]
+    if host.startswith('['):
+        # An IPv6 address, which has colons of its own.
+        host = host[:host.find(']') + 1]
+    else:
+        host = host.partition(':')[0]
+    host = host.strip('.').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return host or None
+
+
+def host_labels(host):
+    """Return the labels of ``host`` from the top level domain down.
+
+    IP addresses are a single label, so they only match themselves.
+
+    """
+    if host.startswith('[') or _IPV4.match(host):
+        return [host]
+    return [label for label in reversed(host.split('.')) if label]
+
+
+class DomainIndex(object):
+    """A suffix trie of the hosts of entry URLs."""
+
+    def __init__(self, entries=()):
+        self._root = {}
+        self.size = 0
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        """Add an entry, returns False if its URL doesn't have a host."""
+        host = normalize_host(entry.url)
+        if host is None:
+            return False
+        node = self._root
+        for label in host_labels(host):
+            node = node.setdefault(label, {})
+        node.setdefault(_ENTRIES, []).append(entry)
+        self.size += 1
+        return True
+
+    def find(self, url):
+        """Return the entries for the host of ``url`` and its parents.
+
+        The entries for the most specific domain come first, so
+        entries for ``login.example.com`` come before the entries for
+        ``example.com``.  Entries for the same domain are in the order
+        they were added.
+
+        """
+        host = normalize_host(url)
+        if host is None:
+            return []
+        node = self._root
+        found = []
+        for label in host_labels(host):
+            node = node.get(label)
+            if node is None:
+                break
+            if _ENTRIES in node:
+                found.append(node[_ENTRIES])
+        return [entry for entries in reversed(found) for entry in entries]
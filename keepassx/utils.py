@@ -0,0 +1,177 @@
+"""Helpers shared by the modules that store files next to a database."""
+import os
+import hmac
+import stat
+import struct
+import hashlib
+import tempfile
+
+from Crypto.Cipher import AES
+
+
+# The salt and IV in front of a sealed ciphertext, and the MAC after it.
+_SALT_SIZE = 16
+_MAC_SIZE = 32
+
+
+def read_file(filename):
+    """Return the contents of a file, or None if it can't be read."""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def write_private_file(filename, data):
+    """Atomically write a file that is only readable by the current user."""
+    _write_atomically(filename, data, 0o600)
+
+
+def replace_file(filename, data):
+    """Atomically write a file, keeping the mode of the file it replaces.
+
+    A new file is only readable by the current user.
+
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        mode = 0o600
+    _write_atomically(filename, data, mode)
+
+
+# os.rename can't replace an existing file on Windows.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _write_atomically(filename, data, mode):
+    tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+    fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode != 0o600:
+            os.chmod(tmp_filename, mode)
+        _replace(tmp_filename, filename)
+    except Exception:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def runtime_path():
+    """Return the path of the directory for per user runtime files.
+
+    This is ``$XDG_RUNTIME_DIR/keepassx``, or a per user directory in
+    the system temp dir.  Pass it to ``private_directory`` to use it.
+
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'keepassx')
+    return os.path.join(tempfile.gettempdir(),
+                        'keepassx-%s' % current_uid())
+
+
+def current_uid():
+    if hasattr(os, 'getuid'):
+        return os.getuid()
+    return os.environ.get('USERNAME', 'user')
+
+
+def private_directory(path, create=True):
+    """Return ``path``, a directory only the current user can access.
+
+    The directory is created if it doesn't exist and ``create`` is
+    true, otherwise None is returned.
+
+    :raise: ValueError if the directory is accessible by other users.
+
+    """
+    if not os.path.isdir(path):
+        if not create:
+            return None
+        os.makedirs(path, 0o700)
+    stat = os.stat(path)
+    if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or
+                                  stat.st_mode & 0o077):
+        raise ValueError("Directory %s must only be accessible by the "
+                         "current user." % path)
+    return path
+
+
+def remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def compare_digest(a, b):
+    """Compare two digests in constant time."""
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    # Python < 2.7.7.
+    result = len(a) ^ len(b)
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+def seal(key, plaintext, header=b'', associated_data=b''):
+    """Encrypt and authenticate ``plaintext`` with ``key``.
+
+    Returns ``header``, a random salt and IV, the plaintext encrypted
+    with AES-CBC, and an HMAC-SHA256 of all of those along with
+    ``associated_data``, which isn't stored.  The header is left in
+    the clear so it can be read without the key.
+
+    The encryption and MAC keys are derived from ``key`` and the salt
+    with HMAC rather than a slow KDF, so ``key`` has to be random, or
+    already the output of a slow KDF, and never a password.
+
+    """
+    salt = os.urandom(_SALT_SIZE)
+    iv = os.urandom(AES.block_size)
+    encryption_key, mac_key = _seal_keys(key, salt)
+    padding = AES.block_size - len(plaintext) % AES.block_size
+    ciphertext = AES.new(encryption_key, AES.MODE_CBC, iv).encrypt(
+        plaintext + struct.pack('B', padding) * padding)
+    data = header + salt + iv + ciphertext
+    return data + _seal_mac(mac_key, data, associated_data)
+
+
+def unseal(key, data, header_size, associated_data=b''):
+    """Return the plaintext that ``seal`` stored in ``data``.
+
+    ``header_size`` is the length of the header it was given.
+    Returns None if ``data`` can't be authenticated with ``key`` and
+    ``associated_data``.
+
+    """
+    start = header_size + _SALT_SIZE + AES.block_size
+    ciphertext_size = len(data) - start - _MAC_SIZE
+    if ciphertext_size <= 0 or ciphertext_size % AES.block_size:
+        return None
+    encryption_key, mac_key = _seal_keys(
+        key, data[header_size:header_size + _SALT_SIZE])
+    expected = _seal_mac(mac_key, data[:-_MAC_SIZE], associated_data)
+    if not compare_digest(expected, data[-_MAC_SIZE:]):
+        return None
+    plaintext = AES.new(encryption_key, AES.MODE_CBC,
+                        data[start - AES.block_size:start]).decrypt(
+                            data[start:-_MAC_SIZE])
+    return plaintext[:-bytearray(plaintext[-1:])[0]]
+
+
+def _seal_keys(key, salt):
+    return (hmac.new(key, b'encryption' + salt, hashlib.sha256).digest(),
+            hmac.new(key, b'authentication' + salt, hashlib.sha256).digest())
+
+
+def _seal_mac(mac_key, data, associated_data):
+    # The associated data is length prefixed so it can't be confused
+    # with the start of the data.
+    return hmac.new(mac_key, struct.pack('<I', len(associated_data)) +
+                    associated_data + data, hashlib.sha256).digest()
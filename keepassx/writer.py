@@ -0,0 +1,215 @@
+"""Create KDB files.
+
+Groups and entries are encoded using the same field tables that
+``keepassx.db.Database`` uses to parse them, so anything written here
+can be read back by ``Database``::
+
+    writer = DatabaseWriter(password=b'password')
+    writer.add_group(group)
+    writer.add_entry(entry)
+    with open('new.kdb', 'wb') as f:
+        f.write(writer.serialize())
+
+"""
+import os
+import copy
+import struct
+import hashlib
+import binascii
+import datetime
+
+from Crypto.Cipher import AES
+
+from keepassx.db import Database, Header, IGNORED_FIELD, DateType
+from keepassx.db import NEVER_EXPIRES
+from keepassx.db import calculate_key, derive_final_key
+
+
+DEFAULT_KEY_ENCRYPTION_ROUNDS = 50000
+# Flags for SHA2 + Rijndael, the only combination keepassx writes.
+DEFAULT_FLAGS = 3
+# The group dates are ignored when parsing, so they're not
+# attributes on Group objects.  These are the field types
+# for the creation, last modification, last access and
+# expiration times respectively.
+_GROUP_DATE_FIELDS = (0x3, 0x4, 0x5, 0x6)
+_ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+
+class DatabaseWriter(object):
+    """Serialize groups and entries into a KDB file.
+
+    Each group and entry is encoded as soon as it's added, so only the
+    encoded payload is kept in memory and the objects that were added
+    can be discarded.
+
+    :param password: The master password, already encoded (see
+        ``keepassx.db.encode_password``).
+    :param key_file_contents: The contents of a key file, if any.
+    :param key_encryption_rounds: The number of key transformation
+        rounds.
+    :param master_seed2: The transform seed of an existing database,
+        which is reused along with its ``transformed_key`` instead of
+        transforming the password again.  The rounds must be the
+        existing database's too.
+    :param transformed_key: The transformed key of that database, see
+        ``keepassx.db.derive_key``.
+
+    """
+    def __init__(self, password=b'', key_file_contents=None,
+                 key_encryption_rounds=DEFAULT_KEY_ENCRYPTION_ROUNDS,
+                 master_seed2=None, transformed_key=None):
+        if (master_seed2 is None) != (transformed_key is None):
+            raise ValueError("master_seed2 and transformed_key must be "
+                             "given together.")
+        self._password = password
+        self._key_file_contents = key_file_contents
+        self._master_seed2 = master_seed2
+        self._transformed_key = transformed_key
+        self.key_encryption_rounds = key_encryption_rounds
+        self.num_groups = 0
+        self.num_entries = 0
+        self._groups = bytearray()
+        self._entries = bytearray()
+        self._now = datetime.datetime.now().replace(microsecond=0)
+
+    def add_group(self, group):
+        if group.groupid is None:
+            raise ValueError("Group must have a groupid: %r" % group)
+        buf = self._groups
+        for field_type, (name, field) in sorted(Database.GROUP_TYPES.items()):
+            if name is None or name == 'ignored':
+                continue
+            elif name is IGNORED_FIELD:
+                value = self._now
+                if field_type == _GROUP_DATE_FIELDS[-1]:
+                    value = NEVER_EXPIRES
+                _add_field(buf, field_type, DateType.encode(value))
+            else:
+                value = getattr(group, name)
+                if value is None:
+                    value = 0
+                _add_field(buf, field_type, field.encode(value))
+        _add_field(buf, 0xFFFF, b'')
+        self.num_groups += 1
+
+    def add_group_record(self, record):
+        """Add a group record that is already encoded.
+
+        Groups are stored depth first, so a group's record must be
+        added right after the records of its parent's subtree.
+
+        """
+        self._groups.extend(record)
+        self.num_groups += 1
+
+    def add_entry_records(self, records, count):
+        """Add ``count`` entry records that are already encoded."""
+        self._entries.extend(records)
+        self.num_entries += count
+
+    def add_entry(self, entry):
+        """Encode ``entry``, which is left unchanged.
+
+        An entry without a uuid is given a random one.  Returns the
+        entry that was written, a copy of ``entry`` with its groupid
+        and uuid filled in.
+
+        """
+        entry = copy.copy(entry)
+        if entry.groupid is None and entry.group is not None:
+            entry.groupid = entry.group.groupid
+        if entry.groupid is None:
+            raise ValueError("Entry must belong to a group: %r" % entry)
+        if entry.uuid is None:
+            entry.uuid = binascii.b2a_hex(os.urandom(16)).decode('ascii')
+        buf = self._entries
+        for field_type, (name, field) in sorted(Database.ENTRY_TYPES.items()):
+            if name is None or name == 'ignored':
+                continue
+            elif name == 'attachment':
+                self._add_attachment(buf, field_type, entry.attachment)
+            else:
+                _add_field(buf, field_type,
+                           field.encode(self._entry_value(entry, name)))
+        _add_field(buf, 0xFFFF, b'')
+        self.num_entries += 1
+        return entry
+
+    def _entry_value(self, entry, name):
+        value = getattr(entry, name)
+        if value is not None:
+            return value
+        elif name == 'expiration_time':
+            return NEVER_EXPIRES
+        elif name.endswith('_time'):
+            return self._now
+        elif name == 'imageid':
+            return 0
+        return u''
+
+    def _add_attachment(self, buf, field_type, attachment):
+        if attachment is None:
+            _add_field(buf, field_type, b'')
+            return
+        buf.extend(struct.pack('<HI', field_type, len(attachment)))
+        reader = attachment.open()
+        try:
+            while True:
+                chunk = reader.read(_ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buf.extend(chunk)
+        finally:
+            reader.close()
+
+    def payload(self):
+        """Return the unencrypted group and entry records."""
+        return self._groups + self._entries
+
+    def serialize(self):
+        """Return the contents of the KDB file as bytes."""
+        payload = self.payload()
+        master_seed = os.urandom(16)
+        encryption_iv = os.urandom(16)
+        master_seed2 = self._master_seed2 or os.urandom(32)
+        header = pack_header(
+            flags=DEFAULT_FLAGS,
+            master_seed=master_seed,
+            encryption_iv=encryption_iv,
+            num_groups=self.num_groups,
+            num_entries=self.num_entries,
+            contents_hash=hashlib.sha256(payload).digest(),
+            master_seed2=master_seed2,
+            key_encryption_rounds=self.key_encryption_rounds)
+        if self._transformed_key is not None:
+            # The master seed and IV are still new, so the final key
+            # is too.
+            key = derive_final_key(master_seed, self._transformed_key)
+        else:
+            key = calculate_key(self._password, self._key_file_contents,
+                                master_seed, master_seed2,
+                                self.key_encryption_rounds)
+        padding = 16 - len(payload) % 16
+        payload.extend(struct.pack('B', padding) * padding)
+        encryptor = AES.new(key, AES.MODE_CBC, encryption_iv)
+        return header + encryptor.encrypt(bytes(payload))
+
+
+def pack_header(**values):
+    """Pack the KDB header fields in ``values`` into bytes.
+
+    The signatures and version default to the values that
+    keepassx writes.
+
+    """
+    values.setdefault('signature1', Header.SIGNATURE1)
+    values.setdefault('signature2', Header.SIGNATURE2)
+    values.setdefault('version', Header.VERSION)
+    return b''.join(struct.pack('<' + spec, values[name])
+                    for name, _, spec in Header.STRUCTURE)
+
+
+def _add_field(buf, field_type, data):
+    buf.extend(struct.pack('<HI', field_type, len(data)))
+    buf.extend(data)
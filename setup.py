@@ -15,11 +15,17 @@ setup(
     url="https://github.com/jamesls/python-keepassx",
     scripts=['bin/kp'],
     install_requires=[
-        'pycrypto>=2.6.1,<3.0.0',
+        # pycryptodome rather than PyCrypto for Salsa20 and ChaCha20,
+        # which KDBX databases use.
+        'pycryptodome>=3.7.0,<5.0.0',
         'PyYAML>=3.10,<4.0.0',
         'prettytable==0.7.2',
         'six>=1.3.0,<2.0.0',
     ],
+    extras_require={
+        # Needed to open KDBX 4 databases that use Argon2.
+        'argon2': ['argon2-cffi'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'License :: OSI Approved :: '
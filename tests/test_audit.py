@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from keepassx import audit
+from keepassx.db import Entry
+
+
+def sha1_hex(password):
+    return hashlib.sha1(password.encode('utf-8')).hexdigest().upper()
+
+
+def create_entry(title, password):
+    entry = Entry()
+    entry.title = title
+    entry.password = password
+    return entry
+
+
+class TestHashList(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.breached = ['password', 'hunter2', 'letmein', u'p\u00e4ss']
+        hashes = set(sha1_hex(p) for p in self.breached)
+        # Enough filler that the searches cover several prefixes and
+        # lines of different lengths.
+        for i in range(2000):
+            hashes.add(sha1_hex('filler-%d' % i))
+        self.lines = sorted(hashes)
+        self.filename = self.write_list(
+            '%s:%d' % (h, i + 1) for i, h in enumerate(self.lines))
+
+    def write_list(self, lines, name='hashes.txt'):
+        filename = os.path.join(self.tempdir, name)
+        with open(filename, 'wb') as f:
+            for line in lines:
+                f.write(line.encode('ascii') + b'\r\n')
+        return filename
+
+    def open_list(self, filename=None, **kwargs):
+        hashes = audit.HashList(filename or self.filename, **kwargs)
+        self.addCleanup(hashes.close)
+        return hashes
+
+    def test_every_line_is_found(self):
+        hashes = self.open_list()
+        for i, line in enumerate(self.lines):
+            self.assertEqual(hashes.count(line), i + 1)
+
+    def test_missing_hashes(self):
+        hashes = self.open_list()
+        self.assertNotIn(sha1_hex('not breached'), hashes)
+        self.assertNotIn('0' * 40, hashes)
+        self.assertNotIn('F' * 40, hashes)
+
+    def test_lowercase_hashes(self):
+        hashes = self.open_list()
+        self.assertIn(sha1_hex('hunter2').lower(), hashes)
+
+    def test_lookup_many(self):
+        hashes = self.open_list()
+        wanted = [sha1_hex('hunter2'), sha1_hex('not breached'),
+                  sha1_hex('password')]
+        found = hashes.lookup_many(wanted)
+        self.assertEqual(sorted(found), sorted([
+            sha1_hex('hunter2').encode('ascii'),
+            sha1_hex('password').encode('ascii')]))
+
+    def test_lines_without_counts(self):
+        filename = self.write_list(self.lines, name='nocounts.txt')
+        hashes = self.open_list(filename)
+        self.assertEqual(hashes.count(sha1_hex('letmein')), 1)
+
+    def test_empty_list(self):
+        filename = self.write_list([], name='empty.txt')
+        hashes = self.open_list(filename)
+        self.assertNotIn(sha1_hex('password'), hashes)
+
+    def test_prefix_index(self):
+        hashes = self.open_list()
+        offsets = hashes.build_prefix_index()
+        self.assertEqual(len(offsets), (1 << audit.PREFIX_BITS) + 1)
+        self.assertEqual(offsets, sorted(offsets))
+        for i, line in enumerate(self.lines):
+            self.assertEqual(hashes.count(line), i + 1)
+        self.assertNotIn(sha1_hex('not breached'), hashes)
+
+    def test_save_and_load_prefix_index(self):
+        hashes = self.open_list()
+        self.assertFalse(hashes.load_prefix_index())
+        offsets = hashes.build_prefix_index()
+        hashes.save_prefix_index()
+        loaded = self.open_list()
+        self.assertTrue(loaded.load_prefix_index())
+        self.assertEqual(list(loaded._prefix_index), offsets)
+        self.assertIn(sha1_hex('hunter2'), loaded)
+
+    def test_stale_prefix_index_not_loaded(self):
+        hashes = self.open_list()
+        hashes.save_prefix_index()
+        hashes.close()
+        with open(self.filename, 'ab') as f:
+            f.write(b'F' * 40 + b':1\r\n')
+        self.assertFalse(self.open_list().load_prefix_index())
+
+    def test_find_breached(self):
+        entries = [create_entry('a', u'hunter2'),
+                   create_entry('b', u'correct horse battery staple'),
+                   create_entry('c', u''),
+                   create_entry('d', u'p\u00e4ss'),
+                   create_entry('e', u'hunter2')]
+        breached = audit.find_breached(entries, self.open_list())
+        self.assertEqual([(e.title, count > 0) for e, count in breached],
+                         [('a', True), ('d', True), ('e', True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
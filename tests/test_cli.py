@@ -6,15 +6,24 @@ command.
 
 """
 import os
+import json
+import datetime
 import sys
 import time
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
 import unittest
 import mock
 from contextlib import contextmanager
 from six import StringIO
 
+from keepassx import kdbx
 from keepassx.main import main
-from keepassx.main import CONFIG_FILENAME
+from keepassx.main import CONFIG_FILENAME, ProgressBar
+from keepassx.db import Database, Group, Entry, PayloadParser
+from keepassx.writer import DatabaseWriter
 
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -53,6 +62,21 @@ def capture_stderr():
         sys.stderr = sys.__stderr__
 
 
+def create_utf8_database(password):
+    writer = DatabaseWriter(password=password.encode('utf-8'),
+                            key_encryption_rounds=10)
+    group = Group()
+    group.groupid = 1
+    group.group_name = u'Internet'
+    writer.add_group(group)
+    entry = Entry()
+    entry.group = group
+    entry.title = u'mytitle'
+    entry.password = u'mypassword'
+    writer.add_entry(entry)
+    return writer.serialize()
+
+
 class TestCLI(unittest.TestCase):
     # All tests are from the ./misc directory,
     # so that you can conveniently specify
@@ -65,10 +89,17 @@ class TestCLI(unittest.TestCase):
         self._newenv = os.environ.copy()
         self._env = os.environ
         os.environ = self._newenv
+        # Keep unlocked sessions from leaking between tests.
+        self._runtime_dir = tempfile.mkdtemp()
+        self._newenv['XDG_RUNTIME_DIR'] = self._runtime_dir
+        self._cache_dir = tempfile.mkdtemp()
+        self._newenv['XDG_CACHE_HOME'] = self._cache_dir
 
     def tearDown(self):
         os.chdir(self._original_dir)
         os.environ = self._env
+        shutil.rmtree(self._runtime_dir)
+        shutil.rmtree(self._cache_dir)
 
     def kp_run(self, command, provide_password=True):
         if provide_password:
@@ -111,9 +142,580 @@ class TestCLI(unittest.TestCase):
         stderr = captured.getvalue()
         self.assertIn('kp: error: too few arguments', stderr)
 
+    def test_get_by_url(self):
+        output = self.kp_run(
+            'kp -d ./demo.kdb get -n --url https://api.github.com/x')
+        self.assertIn('title:     Github', output)
+
+    def test_get_by_url_not_found(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./demo.kdb get -n --url https://gitlab.com/')
+        self.assertIn('Could not find an entry for: https://gitlab.com/',
+                      captured.getvalue())
+
     def test_can_read_password_from_stdin(self):
         stdin = StringIO('password')
         with mock.patch('sys.stdin', stdin):
             output = self.kp_run('kp -s -d ./password.kdb list',
                                  provide_password=False)
             self.assertIn('Internet', output)
+
+    def test_save_attachment_to_file(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        filename = os.path.join(tempdir, 'out.bin')
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./attachment.kdb attachment withattachment '
+                        '-o %s' % filename)
+        self.assertIn('hello.bin', captured.getvalue())
+        with open(filename, 'rb') as f:
+            contents = f.read()
+        self.assertEqual(len(contents), 100000)
+        self.assertEqual(contents[:4], b'\x00\x07\x0e\x15')
+
+    def test_attachment_for_entry_without_one(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./attachment.kdb attachment noattachment')
+        self.assertIn('Entry has no attachment', captured.getvalue())
+
+    def test_list_json_format(self):
+        output = self.kp_run('kp -d ./passwordmultientry.kdb list -f json')
+        entries = json.loads(output)
+        # The entry in the Backup group is not listed.
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['title'], 'mytitle')
+        self.assertEqual(entries[0]['group'], 'Internet')
+
+    def test_list_streams_rows(self):
+        # Each row is written before the next entry is decoded.
+        events = []
+        stdout = mock.Mock()
+        stdout.write.side_effect = lambda data: events.append('write')
+        parse_entry = PayloadParser.parse_entry
+
+        def _parse_entry(parser, i):
+            events.append('parse')
+            return parse_entry(parser, i)
+        self._newenv['KP_INSECURE_PASSWORD'] = 'password'
+        with without_config_file():
+            with mock.patch('sys.stdout', stdout):
+                with mock.patch.object(PayloadParser, 'parse_entry',
+                                       _parse_entry):
+                    main(['-d', './demo.kdb', 'list', '-f', 'jsonl'])
+        self.assertLess(events.index('write'),
+                        len(events) - events[::-1].index('parse') - 1)
+        self.assertEqual(stdout.flush.call_count, 3)
+
+    def test_list_limit_stops_decoding(self):
+        with mock.patch.object(PayloadParser, 'parse_entry',
+                               autospec=True,
+                               side_effect=PayloadParser.parse_entry) as p:
+            output = self.kp_run('kp -d ./demo.kdb list -f jsonl --limit 1')
+        self.assertEqual(len(output.splitlines()), 1)
+        self.assertEqual(p.call_count, 1)
+
+    def test_list_csv_format_sorted(self):
+        output = self.kp_run('kp -d ./demo.kdb list -f csv --sort')
+        lines = output.splitlines()
+        self.assertEqual(lines[0], 'title,uuid,group')
+        titles = [line.split(',')[0] for line in lines[1:]]
+        self.assertEqual(titles, sorted(titles, key=lambda x: x.lower()))
+
+    def test_profile_breakdown_written_to_stderr(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp --profile -d ./password.kdb get -n mytitle')
+        stderr = captured.getvalue()
+        for stage in ['read', 'calculate_key', 'decrypt', 'search']:
+            self.assertIn(stage, stderr)
+        self.assertIn('entries_scanned', stderr)
+
+    def test_profile_search_excludes_parsing(self):
+        # A fuzzy match decodes the entries inside the search stage,
+        # which is reported separately rather than counted twice.
+        parse = Database._parse_entries_payload
+
+        def slow_parse(db, *args):
+            time.sleep(0.2)
+            return parse(db, *args)
+
+        with mock.patch('keepassx.db.Database._parse_entries_payload',
+                        slow_parse):
+            with capture_stderr() as captured:
+                self.kp_run('kp --profile -d ./password.kdb get -n MYTIT')
+        timings = dict(line.split()[:2] for line in
+                       captured.getvalue().splitlines()
+                       if line.startswith(('search', 'parse_entries')))
+        self.assertGreaterEqual(float(timings['parse_entries']), 200)
+        self.assertLess(float(timings['search']), 200)
+
+    def test_wrong_file_type(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./passwordkey.key list')
+        self.assertIn('Could not open password database', captured.getvalue())
+
+    def test_get_with_index(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        db_file = os.path.join(tempdir, 'password.kdb')
+        shutil.copy('./password.kdb', db_file)
+        # The first lookup builds the index, without decrypting the
+        # database a second time.
+        with mock.patch('keepassx.index.decrypt_range') as decrypt_range:
+            output = self.kp_run('kp --index -d %s get -n mytitle password'
+                                 % db_file)
+        self.assertFalse(decrypt_range.called)
+        self.assertIn('mypassword', output)
+        self.assertTrue(os.path.isfile(db_file + '.kpidx'))
+        with capture_stderr() as captured:
+            output = self.kp_run(
+                'kp --profile --index -d %s get -n mytitle password'
+                % db_file)
+        self.assertIn('mypassword', output)
+        self.assertIn('index_lookup', captured.getvalue())
+        self.assertNotIn('parse_entries', captured.getvalue())
+        # Fuzzy matches still work.
+        output = self.kp_run('kp --index -d %s get -n MYTITLE password'
+                             % db_file)
+        self.assertIn('mypassword', output)
+
+    def test_unlock_and_lock(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./password.kdb unlock --for 5m')
+        self.assertIn('Unlocked', captured.getvalue())
+        del self._newenv['KP_INSECURE_PASSWORD']
+        with mock.patch('getpass.getpass') as getpass:
+            output = self.kp_run('kp -d ./password.kdb get -n mytitle '
+                                 'password', provide_password=False)
+            self.assertFalse(getpass.called)
+        self.assertIn('mypassword', output)
+        with capture_stderr():
+            self.kp_run('kp lock', provide_password=False)
+        with mock.patch('getpass.getpass') as getpass:
+            getpass.return_value = 'password'
+            output = self.kp_run('kp -d ./password.kdb get -n mytitle '
+                                 'password', provide_password=False)
+            self.assertTrue(getpass.called)
+        self.assertIn('mypassword', output)
+
+    def test_unlock_with_wrong_password(self):
+        self._newenv['KP_INSECURE_PASSWORD'] = 'wrong'
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./password.kdb unlock',
+                        provide_password=False)
+        self.assertIn('Invalid password', captured.getvalue())
+        self.assertEqual(os.listdir(self._runtime_dir), [])
+
+    def test_open_with_utf8_encoded_password(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        db_file = os.path.join(tempdir, 'utf8.kdb')
+        with open(db_file, 'wb') as f:
+            f.write(create_utf8_database(u'p\u00e4ssword'))
+        self._newenv['KP_INSECURE_PASSWORD'] = u'p\u00e4ssword'
+        output = self.kp_run('kp -d %s get -n mytitle password' % db_file,
+                             provide_password=False)
+        self.assertIn('mypassword', output)
+
+    def test_list_group(self):
+        output = self.kp_run('kp -d ./demo.kdb list -f jsonl -g eMail')
+        entries = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([e['title'] for e in entries], ['Gmail'])
+
+    def test_list_backup_group(self):
+        output = self.kp_run(
+            'kp -d ./passwordmultientry.kdb list -f jsonl --group Backup')
+        entries = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['group'], 'Backup')
+
+    def test_list_unknown_group(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./demo.kdb list -g Missing')
+        self.assertIn('Group not found: Missing', captured.getvalue())
+
+    def test_audit_breached(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        hash_list = os.path.join(tempdir, 'hashes.txt')
+        with open(hash_list, 'wb') as f:
+            # The sha1 of "mypassword".
+            f.write(b'91DFD9DDB4198AFFC5C194CD8CE6D338FDE470E2:42\r\n')
+        output = self.kp_run('kp -d ./password.kdb audit -f jsonl '
+                             '--prefix-index --breached %s' % hash_list)
+        entries = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(entries, [{
+            'title': 'mytitle', 'uuid': entries[0]['uuid'],
+            'group': 'Internet', 'count': 42}])
+        self.assertTrue(os.path.isfile(hash_list + '.prefix'))
+
+    def test_diff(self):
+        output = self.kp_run('kp diff -f jsonl ./demo.kdb ./password.kdb')
+        diffs = [json.loads(line) for line in output.splitlines()]
+        # password.kdb is a copy of demo.kdb without two of its entries.
+        self.assertEqual(
+            sorted((d['status'], d['title']) for d in diffs),
+            [('only in ./demo.kdb', 'Github'),
+             ('only in ./demo.kdb', 'Gmail')])
+
+    def test_diff_same_database(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp diff ./demo.kdb ./demo.kdb')
+        self.assertIn('No differences', captured.getvalue())
+
+    def test_unsupported_kdbx_cipher(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        db_file = os.path.join(tempdir, 'twofish.kdbx')
+        with open('./kdbx3.kdbx', 'rb') as f:
+            contents = f.read().replace(kdbx.AES_CIPHER,
+                                        kdbx.TWOFISH_CIPHER, 1)
+        with open(db_file, 'wb') as f:
+            f.write(contents)
+        with capture_stderr() as captured:
+            self.kp_run('kp -d %s list' % db_file)
+        self.assertIn('Could not open password database: Unsupported '
+                      'encryption type: Twofish', captured.getvalue())
+
+    def test_diff_kdb_with_kdbx(self):
+        with capture_stderr() as captured:
+            output = self.kp_run('kp diff ./password.kdb ./kdbx3.kdbx')
+        self.assertEqual(output, '')
+        self.assertIn("Can't compare a KDB database with a KDBX",
+                      captured.getvalue())
+
+    def test_open_kdbx(self):
+        output = self.kp_run('kp -d ./kdbx4-argon2.kdbx list -f jsonl')
+        entries = sorted((e['title'], e['group']) for e in
+                         (json.loads(line) for line in output.splitlines()))
+        self.assertEqual(entries, [('Gmail', 'Root/Internet/Email'),
+                                   ('mytitle', 'Root/Internet')])
+
+    def test_get_password_from_kdbx(self):
+        output = self.kp_run('kp -d ./kdbx3.kdbx get -n mytitle password')
+        self.assertIn('mypassword', output)
+
+    def test_get_from_kdbx_ignores_index(self):
+        output = self.kp_run(
+            'kp -d ./kdbx4-chacha20.kdbx --index get -n mytitle password')
+        self.assertIn('mynewpassword', output)
+        self.assertFalse(os.path.exists('./kdbx4-chacha20.kdbx.kpidx'))
+
+    def test_unlock_kdbx_not_supported(self):
+        with capture_stderr() as captured:
+            self.kp_run('kp -d ./kdbx3.kdbx unlock')
+        self.assertIn('not supported for KDBX', captured.getvalue())
+        self.assertEqual(os.listdir(self._runtime_dir), [])
+
+    def test_import_into_new_database(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        csv_file = os.path.join(tempdir, 'export.csv')
+        with open(csv_file, 'wb') as f:
+            f.write(b'Group,Title,Username,Password\r\n'
+                    b'Internet/Email,Gmail,me,pw\r\n'
+                    b',Bank,you,1234\r\n')
+        db_file = os.path.join(tempdir, 'new.kdb')
+        with capture_stderr() as captured:
+            self.kp_run('kp -d %s import --rounds 10 %s' % (db_file, csv_file))
+        self.assertIn('Imported 2 entries', captured.getvalue())
+        self.assertEqual(os.stat(db_file).st_mode & 0o777, 0o600)
+        output = self.kp_run('kp -d %s list -f jsonl' % db_file)
+        entries = sorted((e['title'], e['group']) for e in
+                         (json.loads(line) for line in output.splitlines()))
+        self.assertEqual(entries, [('Bank', 'Imported'),
+                                   ('Gmail', 'Internet/Email')])
+        output = self.kp_run('kp -d %s get -n Gmail password' % db_file)
+        self.assertIn('pw', output)
+
+    def test_import_into_existing_database(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        db_file = os.path.join(tempdir, 'demo.kdb')
+        shutil.copy('./demo.kdb', db_file)
+        os.chmod(db_file, 0o640)
+        jsonl_file = os.path.join(tempdir, 'export.jsonl')
+        with open(jsonl_file, 'wb') as f:
+            f.write(b'{"title": "new", "password": "newpw"}\n')
+        self.kp_run('kp -d %s import -g Imported/Today %s' % (
+            db_file, jsonl_file))
+        # The existing file's mode is kept.
+        self.assertEqual(os.stat(db_file).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(tempdir)),
+                         ['demo.kdb', 'export.jsonl'])
+        output = self.kp_run('kp -d %s list -f jsonl' % db_file)
+        titles = sorted(json.loads(line)['title']
+                        for line in output.splitlines())
+        self.assertEqual(titles, ['Github', 'Gmail', 'mytitle', 'new'])
+        output = self.kp_run('kp -d %s get -n new password' % db_file)
+        self.assertIn('newpw', output)
+
+    def test_import_invalid_record(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        jsonl_file = os.path.join(tempdir, 'export.jsonl')
+        with open(jsonl_file, 'wb') as f:
+            f.write(b'{"title": "a"}\n[1]\n')
+        db_file = os.path.join(tempdir, 'new.kdb')
+        with capture_stderr() as captured:
+            self.kp_run('kp -d %s import %s' % (db_file, jsonl_file))
+        self.assertIn('Line 2', captured.getvalue())
+        self.assertFalse(os.path.exists(db_file))
+
+    def test_import_invalid_text(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        csv_file = os.path.join(tempdir, 'export.csv')
+        with open(csv_file, 'wb') as f:
+            f.write(b'title\r\n\xff\r\n')
+        db_file = os.path.join(tempdir, 'new.kdb')
+        with capture_stderr() as captured:
+            self.kp_run('kp -d %s import %s' % (db_file, csv_file))
+        self.assertIn('Could not import', captured.getvalue())
+        self.assertFalse(os.path.exists(db_file))
+
+    def create_expiring_database(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        writer = DatabaseWriter(password=b'password',
+                                key_encryption_rounds=10)
+        group = Group()
+        group.groupid = 1
+        group.group_name = u'Internet'
+        writer.add_group(group)
+        now = datetime.datetime.now()
+        for title, modified_days, expires_days in [
+                (u'expired', -40, -1), (u'soon', -20, 5),
+                (u'later', -2, 60), (u'never', -1, None)]:
+            entry = Entry()
+            entry.group = group
+            entry.title = title
+            entry.last_mod_time = now + datetime.timedelta(modified_days)
+            if expires_days is not None:
+                entry.expiration_time = (
+                    now + datetime.timedelta(expires_days))
+            writer.add_entry(entry)
+        db_file = os.path.join(tempdir, 'expiring.kdb')
+        with open(db_file, 'wb') as f:
+            f.write(writer.serialize())
+        return db_file
+
+    def test_list_excludes_nested_backup_groups(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        writer = DatabaseWriter(password=b'password',
+                                key_encryption_rounds=10)
+        groups = {}
+        for groupid, name, level in [(1, u'Internet', 0), (2, u'Backup', 1),
+                                     (3, u'Old', 2)]:
+            group = Group()
+            group.groupid = groupid
+            group.group_name = name
+            group.level = level
+            writer.add_group(group)
+            groups[name] = group
+        for title, name in [(u'github', u'Internet'), (u'backup', u'Backup'),
+                            (u'old', u'Old')]:
+            entry = Entry()
+            entry.group = groups[name]
+            entry.title = title
+            writer.add_entry(entry)
+        db_file = os.path.join(tempdir, 'nested.kdb')
+        with open(db_file, 'wb') as f:
+            f.write(writer.serialize())
+        self.assertEqual(self.list_titles('kp -d %s list' % db_file),
+                         ['github'])
+        self.assertEqual(
+            self.list_titles('kp -d %s list -g Internet/Backup' % db_file),
+            ['backup', 'old'])
+
+    def list_titles(self, command):
+        output = self.kp_run(command + ' -f jsonl')
+        return [json.loads(line)['title'] for line in output.splitlines()]
+
+    def test_list_expires_before(self):
+        db_file = self.create_expiring_database()
+        self.assertEqual(
+            self.list_titles('kp -d %s list --expires-before 30d' % db_file),
+            ['expired', 'soon'])
+        self.assertEqual(
+            self.list_titles('kp -d %s list --expires-before 2999-01-01 '
+                             '--limit 2' % db_file),
+            ['expired', 'soon'])
+
+    def test_list_modified_since(self):
+        db_file = self.create_expiring_database()
+        self.assertEqual(
+            self.list_titles('kp -d %s list --modified-since 30d' % db_file),
+            ['never', 'later', 'soon'])
+        self.assertEqual(
+            self.list_titles('kp -d %s list --modified-since 30d '
+                             '--expires-before 90d' % db_file),
+            ['soon', 'later'])
+        self.assertEqual(
+            self.list_titles('kp -d %s list --modified-since 30d '
+                             '--sort' % db_file),
+            ['later', 'never', 'soon'])
+
+    def test_list_term_and_time(self):
+        db_file = self.create_expiring_database()
+        self.assertEqual(
+            self.list_titles('kp -d %s list soon --expires-before 1d'
+                             % db_file), [])
+        self.assertEqual(
+            self.list_titles('kp -d %s list soon --expires-before 10d'
+                             % db_file), ['soon'])
+
+    def test_list_invalid_time(self):
+        with capture_stderr() as captured:
+            with self.assertRaises(SystemExit):
+                self.kp_run('kp -d ./demo.kdb list --modified-since soon')
+        self.assertIn('expected a date', captured.getvalue())
+
+    def test_shell(self):
+        with mock.patch('keepassx.shell.Shell') as shell:
+            self.kp_run('kp -d ./passwordmultientry.kdb shell -c 5')
+        entries = shell.call_args[0][0]
+        # The Backup group is left out, like it is for "kp list".
+        self.assertEqual([e.group.path for e in entries],
+                         ['Internet', 'Internet'])
+        self.assertEqual(shell.call_args[1], {'clear_after': 5})
+        shell.return_value.cmdloop.assert_called_with()
+
+    def test_deadline(self):
+        with capture_stderr() as captured:
+            output = self.kp_run('kp -d ./password.kdb --deadline 0 list')
+        self.assertEqual(output, '')
+        self.assertIn("didn't finish before the deadline", captured.getvalue())
+        output = self.kp_run('kp -d ./password.kdb --deadline 1m list')
+        self.assertIn('mytitle', output)
+
+    def test_invalid_deadline(self):
+        with capture_stderr() as captured:
+            with self.assertRaises(SystemExit):
+                self.kp_run('kp -d ./password.kdb --deadline soon list')
+        self.assertIn('expected a duration', captured.getvalue())
+
+    def test_progress_bar(self):
+        stream = StringIO()
+        progress = ProgressBar('Deriving key', stream, delay=0)
+        progress.update(50, 200)
+        progress.update(51, 200)
+        progress.update(200, 200)
+        self.assertEqual(stream.getvalue().split('\r')[1:], [
+            'Deriving key [#######                       ]  25%',
+            'Deriving key [##############################] 100%',
+        ])
+        progress.clear()
+        self.assertTrue(stream.getvalue().endswith(' ' * 50 + '\r'))
+
+    def test_progress_bar_delay(self):
+        stream = StringIO()
+        progress = ProgressBar('Deriving key', stream, delay=60)
+        progress.update(50, 200)
+        progress.clear()
+        self.assertEqual(stream.getvalue(), '')
+
+    def test_complete_needs_session_or_cache(self):
+        output = self.kp_run('kp -d ./demo.kdb complete my',
+                             provide_password=False)
+        self.assertEqual(output, '')
+        self.kp_run('kp -d ./demo.kdb unlock')
+        output = self.kp_run('kp -d ./demo.kdb complete g',
+                             provide_password=False)
+        self.assertEqual(output.splitlines(), ['Github', 'Gmail'])
+        # The titles are kept with the session, so the database isn't
+        # decrypted again.
+        with mock.patch('keepassx.main.Database') as database:
+            output = self.kp_run('kp -d ./demo.kdb complete g',
+                                 provide_password=False)
+        self.assertFalse(database.called)
+        self.assertEqual(output.splitlines(), ['Github', 'Gmail'])
+        # Without --completion-cache nothing is written to the cache
+        # directory, and locking removes the titles.
+        self.assertEqual(os.listdir(self._cache_dir), [])
+        with capture_stderr():
+            self.kp_run('kp lock', provide_password=False)
+        self.assertEqual(os.listdir(os.path.join(self._runtime_dir,
+                                                 'keepassx')), [])
+
+    def test_complete_from_cache(self):
+        self.kp_run('kp -d ./demo.kdb --completion-cache list')
+        self.assertEqual(os.listdir(self._cache_dir), ['keepassx'])
+        output = self.kp_run(
+            'kp -d ./demo.kdb --completion-cache complete MY',
+            provide_password=False)
+        self.assertEqual(output.splitlines(), ['mytitle'])
+        # The cache is only used when it's enabled.
+        output = self.kp_run('kp -d ./demo.kdb complete my',
+                             provide_password=False)
+        self.assertEqual(output, '')
+
+    def test_complete_with_unwritable_cache(self):
+        self.kp_run('kp -d ./demo.kdb unlock')
+        with mock.patch('keepassx.completion.write_cache',
+                        side_effect=OSError('read only')):
+            with capture_stderr() as captured:
+                output = self.kp_run(
+                    'kp -d ./demo.kdb --completion-cache complete g',
+                    provide_password=False)
+        self.assertEqual(output.splitlines(), ['Github', 'Gmail'])
+        self.assertIn('Could not update the completion cache',
+                      captured.getvalue())
+
+    def test_completion_script(self):
+        output = self.kp_run('kp completion bash', provide_password=False)
+        self.assertIn('complete -F _kp_complete kp', output)
+        commands = output.split('compgen -W "')[1].split('"')[0].split()
+        self.assertIn('get', commands)
+        self.assertIn('completion', commands)
+        # "kp complete" is only meant to be run by the script.
+        self.assertNotIn('complete', commands)
+
+
+# Runs bin/kp as the main script with the spawn start method and two
+# cores, so key derivations use a pool whose workers import bin/kp.
+SPAWN_SCRIPT = """
+import sys, runpy, multiprocessing
+multiprocessing.set_start_method('spawn')
+multiprocessing.cpu_count = lambda: 2
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+@unittest.skipIf(not hasattr(multiprocessing, 'set_start_method'),
+                 "The start method can't be chosen.")
+class TestSpawnedWorkers(unittest.TestCase):
+    def kp_spawn(self, args, password):
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        env = dict(os.environ, HOME=home, XDG_RUNTIME_DIR=home,
+                   XDG_CACHE_HOME=home, KP_INSECURE_PASSWORD=password,
+                   PYTHONPATH=PROJECT_DIR)
+        process = subprocess.Popen(
+            [sys.executable, '-c', SPAWN_SCRIPT,
+             os.path.join(PROJECT_DIR, 'bin', 'kp')] + args,
+            cwd=os.path.join(PROJECT_DIR, 'misc'), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = process.communicate(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            self.fail("kp %s didn't finish." % ' '.join(args))
+        self.assertEqual(process.returncode, 0, stderr)
+        return stdout.decode('utf-8')
+
+    def test_parallel_key_derivation(self):
+        # The password has more than one encoding, so each one is
+        # tried in a worker.
+        output = self.kp_spawn(['-d', 'password-unicode.kdb', 'list'],
+                               u'password\u2713')
+        self.assertIn('mytitle', output)
+
+    def test_diff(self):
+        # Each database is a key derivation job, even with an ASCII
+        # password.
+        output = self.kp_spawn(
+            ['diff', '-f', 'jsonl', 'demo.kdb', 'password.kdb'], 'password')
+        self.assertEqual(len(output.splitlines()), 2)
@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from io import BytesIO
 
 import mock
 
+try:
+    from six.moves import tkinter
+except ImportError:
+    tkinter = None
+
 from keepassx import clipboard
 
 
@@ -30,11 +40,41 @@ class TestClipboard(unittest.TestCase):
         with self.assertRaises(ValueError):
             clipboard.get_clipboard()
 
-    def test_copy_function(self):
+    def test_native_clipboard_falls_back_to_processes(self):
+        self.platform.return_value = 'Linux'
+        with mock.patch.dict(os.environ, {'DISPLAY': ''}):
+            self.assertIsInstance(clipboard.get_native_clipboard(),
+                                  clipboard.LinuxClipboard)
+        with mock.patch.dict(os.environ, {'DISPLAY': ':99'}):
+            with mock.patch('keepassx.clipboard.TkClipboard',
+                            side_effect=RuntimeError):
+                self.assertIsInstance(clipboard.get_native_clipboard(),
+                                      clipboard.LinuxClipboard)
+
+    @unittest.skipIf(tkinter is None, "tkinter isn't installed")
+    def test_tk_clipboard_needs_display(self):
+        with mock.patch.dict(os.environ, {'DISPLAY': ''}):
+            with self.assertRaises(RuntimeError):
+                clipboard.TkClipboard()
+
+    def test_native_clipboard(self):
+        self.platform.return_value = 'Linux'
+        with mock.patch.dict(os.environ, {'DISPLAY': ':99'}):
+            with mock.patch('keepassx.clipboard.TkClipboard') as tk:
+                self.assertIs(clipboard.get_native_clipboard(),
+                              tk.return_value)
+        self.platform.return_value = 'Darwin'
+        with mock.patch('keepassx.clipboard.AppKitClipboard') as appkit:
+            self.assertIs(clipboard.get_native_clipboard(),
+                          appkit.return_value)
+
+    def test_copy_without_unix_sockets(self):
         with mock.patch('keepassx.clipboard.OSXClipBoard.copy') as mock_copy:
-            self.platform.return_value = 'Darwin'
-            clipboard.copy('foo')
-            mock_copy.assert_called_with('foo')
+            with mock.patch('keepassx.clipboard.socket') as mock_socket:
+                del mock_socket.AF_UNIX
+                self.platform.return_value = 'Darwin'
+                clipboard.copy('foo')
+                mock_copy.assert_called_with('foo')
 
     def test_binary_written_to_stdin(self):
         unicode_password = u'\u2713'
@@ -44,3 +84,198 @@ class TestClipboard(unittest.TestCase):
             copier.copy(unicode_password)
             popen.return_value.communicate.assert_called_with(
                 unicode_password.encode('utf-8'))
+
+
+class FakeClipboard(object):
+    OWNS_SELECTION = False
+    EVENT_INTERVAL = None
+
+    def __init__(self, contents=u'previous'):
+        self.contents = contents
+        self.copies = []
+
+    def copy(self, text):
+        self.copies.append(text)
+        self.contents = text
+
+    def paste(self):
+        return self.contents
+
+    def process_events(self):
+        pass
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestClipboardServer(unittest.TestCase):
+    def setUp(self):
+        self.clipboard = FakeClipboard()
+        self.clock = FakeClock()
+        self.server = clipboard.ClipboardServer(self.clipboard, self.clock)
+
+    def test_copy_without_clear(self):
+        self.server.handle({'command': 'copy', 'text': 'foo'})
+        self.assertFalse(self.server.pending)
+        self.assertIsNone(self.server.run_pending())
+        self.assertEqual(self.clipboard.contents, 'foo')
+
+    def test_previous_contents_restored(self):
+        self.server.handle({'command': 'copy', 'text': 'secret',
+                            'clear_after': 10})
+        self.assertEqual(self.server.run_pending(), 10)
+        self.clock.now = 9
+        self.assertEqual(self.server.run_pending(), 1)
+        self.assertEqual(self.clipboard.contents, 'secret')
+        self.clock.now = 10
+        self.assertIsNone(self.server.run_pending())
+        self.assertFalse(self.server.pending)
+        self.assertEqual(self.clipboard.contents, 'previous')
+
+    def test_contents_from_before_first_copy_restored(self):
+        self.server.handle({'command': 'copy', 'text': 'user',
+                            'clear_after': 10})
+        self.clock.now = 5
+        self.server.handle({'command': 'copy', 'text': 'secret',
+                            'clear_after': 10})
+        # The second copy pushed the restore back.
+        self.clock.now = 10
+        self.server.run_pending()
+        self.assertEqual(self.clipboard.contents, 'secret')
+        self.clock.now = 15
+        self.server.run_pending()
+        self.assertEqual(self.clipboard.contents, 'previous')
+
+    def test_new_clipboard_contents_not_overwritten(self):
+        self.server.handle({'command': 'copy', 'text': 'secret',
+                            'clear_after': 1})
+        self.clipboard.contents = 'copied by someone else'
+        self.clock.now = 1
+        self.server.run_pending()
+        self.assertEqual(self.clipboard.contents, 'copied by someone else')
+
+    def test_unknown_command(self):
+        with self.assertRaises(ValueError):
+            self.server.handle({'command': 'paste'})
+
+    def test_owns_clipboard(self):
+        self.server.handle({'command': 'copy', 'text': 'foo'})
+        self.assertFalse(self.server.owns_clipboard())
+        self.clipboard.OWNS_SELECTION = True
+        self.assertTrue(self.server.owns_clipboard())
+        self.clipboard.contents = 'copied by someone else'
+        self.assertFalse(self.server.owns_clipboard())
+
+    def test_serve_stream_reads_json_lines(self):
+        stream = BytesIO(b'{"command": "copy", "text": "a"}\n'
+                         b'{"command": "copy", "text": "b"}\n')
+        server = clipboard.ClipboardServer(self.clipboard)
+        server.serve_stream(stream)
+        self.assertEqual(self.clipboard.copies, ['a', 'b'])
+
+    def test_serve_stream_waits_for_restore(self):
+        stream = BytesIO(b'{"command": "copy", "text": "a", '
+                         b'"clear_after": 0.01}\n')
+        server = clipboard.ClipboardServer(self.clipboard)
+        server.serve_stream(stream)
+        self.assertEqual(self.clipboard.copies, ['a', 'previous'])
+
+
+class TestClipboardHelper(unittest.TestCase):
+    def setUp(self):
+        # Kept short, unix socket paths are limited to about 100 bytes.
+        self.directory = tempfile.mkdtemp(prefix='kp')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clipboard = FakeClipboard()
+
+    def start_helper(self):
+        thread = threading.Thread(
+            target=clipboard.run_helper,
+            args=(self.directory, self.clipboard, 0.2))
+        thread.start()
+        self.addCleanup(thread.join)
+        return thread
+
+    def test_copies_shared_between_clients(self):
+        self.start_helper()
+        path = os.path.join(self.directory, clipboard.SOCKET_FILENAME)
+        clipboard._wait_for_helper(path).close()
+        with mock.patch('keepassx.clipboard._start_helper') as start:
+            clipboard.ClipboardHelper(self.directory).copy(u'user')
+            clipboard.ClipboardHelper(self.directory).copy(
+                u'\u2713', clear_after=0.05)
+        self.assertFalse(start.called)
+        self.assertEqual(self.clipboard.copies[:2], [u'user', u'\u2713'])
+
+    def test_helper_exits_when_idle(self):
+        thread = self.start_helper()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, clipboard.SOCKET_FILENAME)))
+
+    def test_restore_happens_before_exit(self):
+        thread = self.start_helper()
+        path = os.path.join(self.directory, clipboard.SOCKET_FILENAME)
+        clipboard._wait_for_helper(path).close()
+        clipboard.ClipboardHelper(self.directory).copy(
+            u'secret', clear_after=0.5)
+        thread.join(5)
+        self.assertEqual(self.clipboard.copies, [u'secret', u'previous'])
+
+    def test_only_one_helper_runs(self):
+        self.start_helper()
+        path = os.path.join(self.directory, clipboard.SOCKET_FILENAME)
+        clipboard._wait_for_helper(path).close()
+        other = FakeClipboard()
+        # Returns straight away, as the first helper is answering.
+        clipboard.run_helper(self.directory, other)
+        clipboard.ClipboardHelper(self.directory).copy(u'foo')
+        self.assertEqual(other.copies, [])
+        self.assertEqual(self.clipboard.copies, [u'foo'])
+
+    def test_helper_started_on_first_copy(self):
+        with mock.patch('subprocess.Popen') as popen:
+            popen.side_effect = lambda *args, **kwargs: self.start_helper()
+            clipboard.ClipboardHelper(self.directory).copy(u'foo')
+            clipboard.ClipboardHelper(self.directory).copy(u'bar')
+        self.assertEqual(popen.call_count, 1)
+        args, kwargs = popen.call_args
+        self.assertEqual(args[0][-2:], ['keepassx.clipboard', self.directory])
+        for name, value in clipboard._new_session_args().items():
+            self.assertEqual(kwargs[name], value)
+        self.assertEqual(self.clipboard.copies, [u'foo', u'bar'])
+
+    def test_copy_error_reported(self):
+        self.clipboard.copy = mock.Mock(side_effect=Exception('no xclip'))
+        self.start_helper()
+        path = os.path.join(self.directory, clipboard.SOCKET_FILENAME)
+        clipboard._wait_for_helper(path).close()
+        with self.assertRaises(Exception) as e:
+            clipboard.ClipboardHelper(self.directory).copy(u'foo')
+        self.assertIn('no xclip', str(e.exception))
+
+    def test_new_session_args(self):
+        with mock.patch('six.PY2', False):
+            self.assertEqual(clipboard._new_session_args(),
+                             {'start_new_session': True})
+        with mock.patch('six.PY2', True):
+            with mock.patch('keepassx.clipboard.os') as os_module:
+                self.assertEqual(clipboard._new_session_args(),
+                                 {'preexec_fn': os_module.setsid})
+                del os_module.setsid
+                self.assertEqual(clipboard._new_session_args(), {})
+
+    def test_every_copy_uses_helper(self):
+        with mock.patch('keepassx.clipboard.get_helper') as get_helper:
+            clipboard.copy('foo')
+            get_helper.return_value.copy.assert_called_with(
+                'foo', clear_after=None)
+            clipboard.copy('foo', clear_after=5)
+            get_helper.return_value.copy.assert_called_with(
+                'foo', clear_after=5)
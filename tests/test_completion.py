@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from keepassx import completion
+from keepassx import session
+from keepassx.db import Database, Header
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+NAMES = [
+    (u'c4d301502050cd695e353b16094be4a7', u'mytitle'),
+    (u'bd9a0e1a2d2d4e2ea4e8b9d5c0a1c2b3', u'Github'),
+    (u'0aa1b2c3d4e5f60718293a4b5c6d7e8f', u'Gmail'),
+    (u'1bb1b2c3d4e5f60718293a4b5c6d7e8f', u'gmail'),
+    (u'2cc1b2c3d4e5f60718293a4b5c6d7e8f', u'Github'),
+    (u'3dd1b2c3d4e5f60718293a4b5c6d7e8f', u''),
+]
+CANDIDATES = completion.candidates(NAMES)
+
+
+class TestCompletionCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_home)
+        patcher = mock.patch.dict(os.environ,
+                                  {'XDG_CACHE_HOME': self.cache_home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.contents = open_data_file('demo.kdb').read()
+        self.header = Header(self.contents)
+        self.db_filename = os.path.join(self.cache_home, 'demo.kdb')
+
+    def cache_file(self):
+        return completion.cache_filename(completion.cache_dir(),
+                                         self.db_filename)
+
+    def test_read_cache(self):
+        completion.write_cache(self.db_filename, self.header, CANDIDATES)
+        self.assertEqual(completion.read_cache(self.db_filename),
+                         (self.header.contents_hash, CANDIDATES))
+        self.assertEqual(completion.cached_contents_hash(self.db_filename),
+                         self.header.contents_hash)
+
+    def test_cache_is_private(self):
+        completion.write_cache(self.db_filename, self.header, CANDIDATES)
+        directory = completion.cache_dir()
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        for name in os.listdir(directory):
+            mode = os.stat(os.path.join(directory, name)).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0o600)
+        with open(self.cache_file(), 'rb') as f:
+            self.assertNotIn(b'mytitle', f.read())
+
+    def test_no_cache(self):
+        self.assertIsNone(completion.read_cache(self.db_filename))
+        self.assertIsNone(completion.cached_contents_hash(self.db_filename))
+        # Reading doesn't create the cache directory.
+        self.assertEqual(os.listdir(self.cache_home), [])
+
+    def test_tampered_cache_rejected(self):
+        completion.write_cache(self.db_filename, self.header, CANDIDATES)
+        with open(self.cache_file(), 'rb') as f:
+            data = bytearray(f.read())
+        data[-1] ^= 1
+        with open(self.cache_file(), 'wb') as f:
+            f.write(bytes(data))
+        self.assertIsNone(completion.read_cache(self.db_filename))
+
+    def test_cache_tied_to_database_path(self):
+        completion.write_cache(self.db_filename, self.header, CANDIDATES)
+        other = os.path.join(self.cache_home, 'other.kdb')
+        os.rename(self.cache_file(), completion.cache_filename(
+            completion.cache_dir(), other))
+        self.assertIsNone(completion.read_cache(other))
+
+    def test_shared_cache_dir_rejected(self):
+        completion.write_cache(self.db_filename, self.header, CANDIDATES)
+        os.chmod(completion.cache_dir(), 0o755)
+        self.assertIsNone(completion.read_cache(self.db_filename))
+        with self.assertRaises(ValueError):
+            completion.write_cache(self.db_filename, self.header, CANDIDATES)
+
+    def test_refresh_cache(self):
+        db = Database(self.contents, b'password')
+        self.assertTrue(completion.refresh_cache(self.db_filename,
+                                                 self.header, db))
+        self.assertFalse(completion.refresh_cache(self.db_filename,
+                                                  self.header, db))
+        self.header.contents_hash = b'\x00' * 32
+        self.assertTrue(completion.refresh_cache(self.db_filename,
+                                                 self.header, db))
+
+
+class TestSessionCache(unittest.TestCase):
+    def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.runtime_dir)
+        patcher = mock.patch.dict(os.environ,
+                                  {'XDG_RUNTIME_DIR': self.runtime_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.header = Header(open_data_file('demo.kdb').read())
+        self.db_filename = os.path.join(self.runtime_dir, 'demo.kdb')
+        self.transformed_key = b'k' * 32
+
+    def test_read_session_cache(self):
+        # Without a session directory nothing is written.
+        completion.write_session_cache(self.db_filename, self.header,
+                                       self.transformed_key, CANDIDATES)
+        self.assertIsNone(completion.read_session_cache(
+            self.db_filename, self.header, self.transformed_key))
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        completion.write_session_cache(self.db_filename, self.header,
+                                       self.transformed_key, CANDIDATES)
+        self.assertEqual(completion.read_session_cache(
+            self.db_filename, self.header, self.transformed_key),
+            CANDIDATES)
+        # It's sealed with the session's key.
+        self.assertIsNone(completion.read_session_cache(
+            self.db_filename, self.header, b'x' * 32))
+        # And only used for the same version of the database.
+        self.header.contents_hash = b'\x00' * 32
+        self.assertIsNone(completion.read_session_cache(
+            self.db_filename, self.header, self.transformed_key))
+
+
+class TestCompletion(unittest.TestCase):
+    def test_entry_names(self):
+        db = Database(open_data_file('demo.kdb').read(), b'password')
+        names = completion.entry_names(db)
+        # The titles are read without decoding the entries.
+        self.assertIsNone(db._entries)
+        self.assertEqual(names, [(entry.uuid, entry.title)
+                                 for entry in db.entries])
+        self.assertEqual(completion.entry_names(db), names)
+
+    def test_candidates(self):
+        titles, uuids = CANDIDATES
+        # Duplicate and empty titles are left out.
+        self.assertEqual(titles, [u'Github', u'Gmail', u'gmail', u'mytitle'])
+        self.assertEqual(uuids, sorted(uuid for uuid, _ in NAMES))
+
+    def test_complete(self):
+        self.assertEqual(completion.complete(CANDIDATES, u'g'),
+                         [u'Github', u'Gmail', u'gmail'])
+        self.assertEqual(completion.complete(CANDIDATES, u'GM'),
+                         [u'Gmail', u'gmail'])
+        self.assertEqual(completion.complete(CANDIDATES, u'MY'),
+                         [u'mytitle'])
+        self.assertEqual(completion.complete(CANDIDATES, u'c4d'),
+                         [u'c4d301502050cd695e353b16094be4a7'])
+        self.assertEqual(completion.complete(CANDIDATES, u'1'),
+                         [u'1bb1b2c3d4e5f60718293a4b5c6d7e8f'])
+        self.assertEqual(completion.complete(CANDIDATES, u'zzz'), [])
+        self.assertEqual(len(completion.complete(CANDIDATES, u'')), 10)
+
+    def test_complete_many(self):
+        titles = [u'entry-%s' % i for i in range(1000)] + [u'Entry']
+        names = completion.candidates(
+            [(u'%032x' % i, title) for i, title in enumerate(titles)])
+        self.assertEqual(completion.complete(names, u'ENTRY-99'),
+                         [u'entry-99', u'entry-990', u'entry-991',
+                          u'entry-992', u'entry-993', u'entry-994',
+                          u'entry-995', u'entry-996', u'entry-997',
+                          u'entry-998', u'entry-999'])
+        self.assertEqual(len(completion.complete(names, u'e')), 1001)
+        self.assertEqual(completion.complete(names, u'0' * 29 + u'3e'),
+                         [u'0' * 29 + u'3e%s' % c
+                          for c in u'012345678'])
+
+    def test_completion_script(self):
+        script = completion.completion_script('bash', ['get', 'list'])
+        self.assertIn('compgen -W "get list"', script)
+        self.assertIn('complete -F _kp_complete kp', script)
+        script = completion.completion_script('zsh', ['get', 'list'])
+        self.assertIn('compadd -- get list', script)
+
+
+if __name__ == '__main__':
+    unittest.main()
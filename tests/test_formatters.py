@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+
+import mock
+
+from six import StringIO
+
+from keepassx import formatters
+
+
+class TestFormatters(unittest.TestCase):
+    def setUp(self):
+        self.stream = StringIO()
+
+    def format_rows(self, name, rows):
+        formatter = formatters.get_formatter(
+            name, self.stream, fields=['title', 'uuid'],
+            headers=['Title', 'Uuid'])
+        for row in rows:
+            formatter.write_row(row)
+        formatter.close()
+        return self.stream.getvalue()
+
+    def test_streaming_formats_flush_each_row(self):
+        for name in formatters.FORMATS:
+            if name == 'table':
+                continue
+            stream = mock.Mock()
+            formatter = formatters.get_formatter(name, stream, ['title'])
+            formatter.write_row(['foo'])
+            self.assertTrue(stream.flush.called, name)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            formatters.get_formatter('xml', self.stream, ['title'])
+
+    def test_table_uses_headers(self):
+        output = self.format_rows('table', [['foo', 'abc']])
+        self.assertIn('Title', output)
+        self.assertIn('foo', output)
+
+    def test_json(self):
+        output = self.format_rows('json', [['foo', 'abc'], ['bar', 'def']])
+        self.assertEqual(json.loads(output),
+                         [{'title': 'foo', 'uuid': 'abc'},
+                          {'title': 'bar', 'uuid': 'def'}])
+
+    def test_json_no_rows(self):
+        self.assertEqual(json.loads(self.format_rows('json', [])), [])
+
+    def test_jsonl(self):
+        output = self.format_rows('jsonl', [['foo', 'abc'], ['bar', 'def']])
+        lines = output.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[1]), {'title': 'bar', 'uuid': 'def'})
+
+    def test_rows_are_written_as_they_are_added(self):
+        formatter = formatters.get_formatter('jsonl', self.stream,
+                                             fields=['title'])
+        formatter.write_row(['foo'])
+        self.assertEqual(self.stream.getvalue(), '{"title": "foo"}\n')
+
+    def test_csv(self):
+        output = self.format_rows('csv', [['foo, bar', 'abc']])
+        self.assertEqual(output, 'title,uuid\n"foo, bar",abc\n')
+
+    def test_tsv(self):
+        output = self.format_rows('tsv', [['foo bar', 'abc']])
+        self.assertEqual(output, 'title\tuuid\nfoo bar\tabc\n')
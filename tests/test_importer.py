@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+import io
+import csv
+import os
+import unittest
+from datetime import datetime
+
+import six
+
+from keepassx import importer
+from keepassx.db import Database, Group, Entry, SYSTEM_USER_UUID
+from keepassx.importer import import_records, read_csv, read_jsonl
+from keepassx.importer import InvalidRecordError
+from keepassx.writer import DatabaseWriter
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+def text_stream(text):
+    return io.StringIO(text, newline='')
+
+
+class TestReaders(unittest.TestCase):
+    def test_read_csv(self):
+        records = list(read_csv(text_stream(
+            u'Title,User Name,Password\r\n'
+            u'Github,me,"pass, word"\r\n'
+            u'\r\n'
+            u'Gm\u00e4il,you,"multi\nline"\r\n')))
+        self.assertEqual(records, [
+            {u'Title': u'Github', u'User Name': u'me',
+             u'Password': u'pass, word'},
+            {u'Title': u'Gm\u00e4il', u'User Name': u'you',
+             u'Password': u'multi\nline'}])
+
+    def test_read_empty_csv(self):
+        self.assertEqual(list(read_csv(text_stream(u''))), [])
+
+    def test_read_jsonl(self):
+        records = list(read_jsonl(text_stream(
+            u'{"title": "Github"}\n\n{"title": "Gmail"}\n')))
+        self.assertEqual(records, [{u'title': u'Github'},
+                                   {u'title': u'Gmail'}])
+
+    def test_read_invalid_jsonl(self):
+        with six.assertRaisesRegex(self, InvalidRecordError, 'Line 2'):
+            list(read_jsonl(text_stream(u'{"title": "a"}\n{"title"\n')))
+        with six.assertRaisesRegex(self, InvalidRecordError, 'expected an'):
+            list(read_jsonl(text_stream(u'["a"]\n')))
+
+    def test_read_invalid_csv(self):
+        # Fields longer than csv.field_size_limit are an error.
+        huge = u'a' * (csv.field_size_limit() + 1)
+        with six.assertRaisesRegex(self, InvalidRecordError, 'Line 2'):
+            list(read_csv(text_stream(u'title\r\n%s\r\n' % huge)))
+
+    def test_read_invalid_text(self):
+        stream = io.TextIOWrapper(io.BytesIO(b'title\n\xff\n'),
+                                  encoding='utf-8', newline='')
+        with six.assertRaisesRegex(self, InvalidRecordError, 'Invalid text'):
+            list(read_csv(stream))
+        stream = io.TextIOWrapper(io.BytesIO(b'{"title": "\xff"}\n'),
+                                  encoding='utf-8')
+        with six.assertRaisesRegex(self, InvalidRecordError, 'Invalid text'):
+            list(read_jsonl(stream))
+
+    def test_guess_format(self):
+        self.assertEqual(importer.guess_format('export.JSONL'), 'jsonl')
+        self.assertEqual(importer.guess_format('export.csv'), 'csv')
+
+
+class TestImportRecords(unittest.TestCase):
+    def setUp(self):
+        self.writer = DatabaseWriter(password=b'password',
+                                     key_encryption_rounds=10)
+
+    def import_and_open(self, records, **kwargs):
+        count = import_records(self.writer, records, **kwargs)
+        self.assertEqual(count, len(records))
+        return Database(self.writer.serialize(), b'password')
+
+    def test_import_into_new_database(self):
+        db = self.import_and_open([
+            {'title': u'Github', 'username': u'me', 'password': u'pw',
+             'url': u'github.com', 'group': u'Internet'},
+            {'Name': u'Gmail', 'Login': u'you', 'Group': u'Internet/eMail',
+             'Expires': u'2030-01-02', 'Unknown': u'ignored'},
+            {'title': u'Bank', 'Password': 1234},
+        ])
+        self.assertEqual([(g.path, g.level) for g in db.groups],
+                         [('Internet', 0), ('Internet/eMail', 1),
+                          ('Imported', 0)])
+        github = db.find_by_title('Github')
+        self.assertEqual((github.username, github.password, github.url),
+                         ('me', 'pw', 'github.com'))
+        gmail = db.find_by_title('Gmail')
+        self.assertEqual(gmail.username, 'you')
+        self.assertEqual(gmail.group.path, 'Internet/eMail')
+        self.assertEqual(gmail.expiration_time, datetime(2030, 1, 2))
+        bank = db.find_by_title('Bank')
+        self.assertEqual(bank.password, '1234')
+        self.assertEqual(bank.group.path, 'Imported')
+
+    def test_subgroup_added_after_other_groups(self):
+        db = self.import_and_open([
+            {'title': u'a', 'group': u'Internet'},
+            {'title': u'b', 'group': u'Banking'},
+            {'title': u'c', 'group': u'Internet/eMail'},
+        ])
+        self.assertEqual([g.path for g in db.groups],
+                         ['Internet', 'Internet/eMail', 'Banking'])
+        self.assertEqual(db.find_by_title('c').group.path, 'Internet/eMail')
+
+    def test_uuid_is_kept(self):
+        db = self.import_and_open([{'uuid': u'a' * 32, 'title': u'a'}])
+        self.assertEqual(db.entries[0].uuid, u'a' * 32)
+
+    def test_invalid_values(self):
+        with six.assertRaisesRegex(self, InvalidRecordError, 'Record 2.*uuid'):
+            import_records(self.writer, [{'title': u'a'},
+                                         {'uuid': u'not a uuid'}])
+        with six.assertRaisesRegex(self, InvalidRecordError,
+                                   'Record 1.*expires'):
+            import_records(self.writer, [{'expires': u'tomorrow'}])
+
+    def test_duplicate_uuids_rejected(self):
+        with six.assertRaisesRegex(self, InvalidRecordError,
+                                   'Record 2.*duplicate uuid'):
+            import_records(self.writer, [{'uuid': u'a' * 32},
+                                         {'uuid': u'A' * 32}])
+
+    def test_uuids_of_existing_entries_rejected(self):
+        uuid = u'c4d301502050cd695e353b16094be4a7'
+        for decoded in [False, True]:
+            existing = Database(open_data_file('demo.kdb').read(),
+                                b'password')
+            if decoded:
+                existing.entries
+            writer = DatabaseWriter(password=b'password',
+                                    key_encryption_rounds=10)
+            with six.assertRaisesRegex(self, InvalidRecordError,
+                                       'duplicate uuid'):
+                import_records(writer, [{'uuid': uuid}], db=existing)
+
+    def test_import_into_existing_database(self):
+        existing = Database(open_data_file('demo.kdb').read(), b'password')
+        before = Database(open_data_file('demo.kdb').read(), b'password')
+        db = self.import_and_open([
+            {'title': u'new', 'group': u'Internet/Shopping'},
+            {'title': u'other', 'group': u'Other'},
+        ], db=existing)
+        self.assertEqual(
+            [g.path for g in db.groups],
+            ['Internet', 'Internet/Shopping', 'eMail', 'Other'])
+        self.assertEqual(db.find_by_title('new').group.path,
+                         'Internet/Shopping')
+        for entry in before.entries:
+            copied = db.find_by_uuid(entry.uuid)
+            self.assertEqual(copied.password, entry.password)
+            self.assertEqual(copied.group.path, entry.group.path)
+        self.assertEqual(len(db.entries), len(before.entries) + 2)
+
+    def test_meta_streams_are_copied(self):
+        writer = DatabaseWriter(password=b'password',
+                                key_encryption_rounds=10)
+        group = Group()
+        group.groupid = 7
+        group.group_name = u'Internet'
+        writer.add_group(group)
+        meta_stream = Entry()
+        meta_stream.uuid = SYSTEM_USER_UUID
+        meta_stream.groupid = 7
+        meta_stream.title = u'Meta-Info'
+        meta_stream.binary_desc = u'bin-stream'
+        meta_stream.binary_data = b'\x01\x02'
+        writer.add_entry(meta_stream)
+        existing = Database(writer.serialize(), b'password')
+        db = self.import_and_open([{'title': u'new'}], db=existing)
+        self.assertEqual([g.groupid for g in db.groups], [7, 8])
+        # Meta streams aren't in db.entries, but they're still stored.
+        self.assertEqual(db.metadata.num_entries, 2)
+        self.assertEqual([e.title for e in db.entries], ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
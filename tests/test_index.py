@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+
+import mock
+
+from keepassx import index
+from keepassx.db import Database, Header, calculate_key
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+def final_key_for(contents, password=b'password'):
+    header = Header(contents)
+    return calculate_key(password, None, header.master_seed,
+                         header.master_seed2, header.key_encryption_rounds)
+
+
+class TestEntryIndex(unittest.TestCase):
+    def setUp(self):
+        self.contents = open_data_file('attachment.kdb').read()
+        self.final_key = final_key_for(self.contents)
+        self.index_data = index.EntryIndex.build(
+            self.contents, self.final_key).serialize(self.final_key)
+
+    def find(self, term, index_data=None):
+        if index_data is None:
+            index_data = self.index_data
+        return index.find_entries(self.contents, self.final_key,
+                                  index_data, term)
+
+    def test_find_by_title(self):
+        entries = self.find('noattachment')
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].title, 'noattachment')
+        self.assertEqual(entries[0].username, 'myusername')
+        self.assertEqual(entries[0].group.group_name, 'Internet')
+
+    def test_find_by_uuid(self):
+        entries = self.find('9f8a7c3e5d2b4a1c0e9f8a7c3e5d2b4a')
+        self.assertEqual(entries[0].title, 'withattachment')
+
+    def test_attachment_read_from_partial_decrypt(self):
+        entry = self.find('withattachment')[0]
+        self.assertEqual(entry.binary_data[:4], b'\x00\x07\x0e\x15')
+        self.assertEqual(len(entry.binary_data), 100000)
+
+    def test_from_database(self):
+        db = Database(self.contents, b'password')
+        with mock.patch('keepassx.index.decrypt_range') as decrypt_range:
+            index_data = index.EntryIndex.from_database(db).serialize(
+                self.final_key)
+        # The payload the database already decrypted is reused.
+        self.assertFalse(decrypt_range.called)
+        self.assertEqual(self.find('noattachment', index_data)[0].title,
+                         'noattachment')
+        db.entries
+        with self.assertRaises(ValueError):
+            index.EntryIndex.from_database(db)
+
+    def test_no_match(self):
+        self.assertEqual(self.find('withattach'), [])
+
+    def test_stale_index(self):
+        other = open_data_file('password.kdb').read()
+        other_key = final_key_for(other)
+        stale = index.EntryIndex.build(other, other_key).serialize(other_key)
+        with self.assertRaises(index.InvalidIndexError):
+            self.find('noattachment', stale)
+
+    def test_wrong_key(self):
+        with self.assertRaises(index.InvalidIndexError):
+            index.find_entries(self.contents, b'k' * 32, self.index_data,
+                               'noattachment')
+
+    def test_tampered_index(self):
+        data = bytearray(self.index_data)
+        data[-40] ^= 1
+        with self.assertRaises(index.InvalidIndexError):
+            self.find('noattachment', bytes(data))
+
+    def test_missing_index(self):
+        with self.assertRaises(index.InvalidIndexError):
+            index.find_entries(self.contents, self.final_key, None,
+                               'noattachment')
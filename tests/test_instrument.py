@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+
+import mock
+
+from keepassx import instrument
+from keepassx.db import Database
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        self.profile = instrument.Profile()
+        instrument.add_hook(self.profile)
+        self.addCleanup(instrument.remove_hook, self.profile)
+
+    def test_disabled_without_hooks(self):
+        instrument.remove_hook(self.profile)
+        self.addCleanup(instrument.add_hook, self.profile)
+        self.assertFalse(instrument.enabled())
+        with instrument.timed('foo'):
+            pass
+        instrument.count('bar')
+        self.assertEqual(self.profile.timings, {})
+        self.assertEqual(self.profile.counters, {})
+
+    def test_timings_and_counters_accumulate(self):
+        with instrument.timed('foo'):
+            pass
+        with instrument.timed('foo'):
+            pass
+        instrument.count('bar', 2)
+        instrument.count('bar', 3)
+        self.assertEqual(list(self.profile.timings), ['foo'])
+        self.assertEqual(self.profile.counters['bar'], 5)
+
+    def test_database_load_stages(self):
+        db = Database(open_data_file('password.kdb').read(), b'password')
+        db.find_by_title('mytitle')
+        # Exact lookups don't need to decode every entry.
+        self.assertEqual(list(self.profile.timings),
+                         ['calculate_key', 'decrypt', 'verify',
+                          'parse_groups'])
+        db.entries
+        self.assertEqual(list(self.profile.timings)[-1], 'parse_entries')
+        self.assertEqual(self.profile.counters['bytes_decrypted'] % 16, 0)
+        self.assertGreater(self.profile.counters['fields_decoded'], 0)
+        self.assertEqual(self.profile.counters['entries_scanned'], 1)
+
+    def test_nested_stages_are_exclusive(self):
+        with mock.patch('keepassx.instrument._clock') as clock:
+            # outer starts at 0, inner runs from 1 to 4 and outer
+            # ends at 10.
+            clock.side_effect = [0.0, 1.0, 4.0, 10.0]
+            with instrument.timed('outer'):
+                with instrument.timed('inner'):
+                    pass
+        self.assertEqual(self.profile.timings,
+                         {'outer': 7.0, 'inner': 3.0})
+        report = self.profile.report()
+        self.assertIn('10000.000', report.splitlines()[3])
+        self.assertIn('70.0%', report)
+        self.assertIn('30.0%', report)
+
+    def test_nested_stage_with_the_same_name(self):
+        with mock.patch('keepassx.instrument._clock') as clock:
+            clock.side_effect = [0.0, 2.0, 3.0, 5.0]
+            with instrument.timed('parse'):
+                with instrument.timed('parse'):
+                    pass
+        self.assertEqual(self.profile.timings, {'parse': 5.0})
+
+    def test_report(self):
+        with instrument.timed('foo'):
+            pass
+        instrument.count('bar', 10)
+        report = self.profile.report()
+        self.assertIn('foo', report)
+        self.assertIn('total', report)
+        self.assertIn('bar', report)
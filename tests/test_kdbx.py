@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import struct
+import unittest
+from datetime import datetime
+
+import mock
+import six
+
+from keepassx import kdbx
+from keepassx.db import Database, Header
+from keepassx.db import InvalidPasswordError, InvalidDatabaseError
+from keepassx.db import UnsupportedDatabaseError
+from keepassx.kdbx import KdbxDatabase, KdbxHeader, is_kdbx
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+def without_header_field(contents, field_id):
+    # Drop a field from a KDBX 3 header.
+    i = 12
+    while True:
+        current, size = struct.unpack_from('<BH', contents, i)
+        if current == field_id:
+            return contents[:i] + contents[i + 3 + size:]
+        i += 3 + size
+
+
+def variant(value_type, key, value):
+    key = key.encode('utf-8')
+    return (struct.pack('<Bi', value_type, len(key)) + key +
+            struct.pack('<i', len(value)) + value)
+
+
+class TestKdbxHeader(unittest.TestCase):
+    def test_kdbx3_header(self):
+        header = KdbxHeader(open_data_file('kdbx3.kdbx').read())
+        self.assertEqual(header.version, (3, 1))
+        self.assertEqual(header.encryption_type, 'Rijndael')
+        self.assertTrue(header.compressed)
+        self.assertEqual(header.kdf_parameters['$UUID'], kdbx.AES_KDF)
+        self.assertEqual(header.kdf_parameters['R'], 1000)
+        self.assertEqual(header.inner_random_stream_id, kdbx.SALSA20_STREAM)
+        self.assertEqual(len(header.stream_start_bytes), 32)
+
+    def test_kdbx4_header(self):
+        header = KdbxHeader(open_data_file('kdbx4-chacha20.kdbx').read())
+        self.assertEqual(header.version[0], 4)
+        self.assertEqual(header.encryption_type, 'ChaCha20')
+        self.assertEqual(header.kdf_parameters['$UUID'], kdbx.ARGON2ID_KDF)
+        self.assertEqual(header.kdf_parameters['P'], 2)
+
+    def test_is_kdbx(self):
+        self.assertTrue(is_kdbx(open_data_file('kdbx3.kdbx').read()))
+        self.assertFalse(is_kdbx(open_data_file('password.kdb').read()))
+        self.assertFalse(is_kdbx(b''))
+
+    def test_kdb_file_is_not_kdbx(self):
+        with self.assertRaises(InvalidDatabaseError):
+            KdbxHeader(open_data_file('password.kdb').read())
+
+    def test_truncated_header(self):
+        contents = open_data_file('kdbx3.kdbx').read()
+        with self.assertRaises(InvalidDatabaseError):
+            KdbxHeader(contents[:40])
+
+    def test_unsupported_version(self):
+        contents = open_data_file('kdbx3.kdbx').read()
+        with self.assertRaises(InvalidDatabaseError):
+            KdbxHeader(contents[:8] + struct.pack('<HH', 0, 2) +
+                       contents[12:])
+
+    def test_missing_stream_start_bytes(self):
+        contents = without_header_field(open_data_file('kdbx3.kdbx').read(),
+                                        KdbxHeader.STREAM_START_BYTES)
+        with six.assertRaisesRegex(self, InvalidDatabaseError,
+                                   'missing required fields'):
+            KdbxHeader(contents)
+
+    def test_unsupported_cipher(self):
+        contents = open_data_file('kdbx3.kdbx').read().replace(
+            kdbx.AES_CIPHER, kdbx.TWOFISH_CIPHER, 1)
+        with self.assertRaises(UnsupportedDatabaseError):
+            KdbxDatabase(contents, password=b'password')
+
+    def test_argon2_not_installed(self):
+        header = KdbxHeader(open_data_file('kdbx4-argon2.kdbx').read())
+        with mock.patch.dict(sys.modules, {'argon2': None,
+                                           'argon2.low_level': None}):
+            with self.assertRaises(UnsupportedDatabaseError):
+                kdbx.transform_kdbx_key(b'k' * 32, header.kdf_parameters)
+
+    def test_stream_cipher_not_installed(self):
+        # PyCrypto doesn't have Salsa20.
+        contents = open_data_file('kdbx3.kdbx').read()
+        with mock.patch.dict(sys.modules, {'Crypto.Cipher.Salsa20': None}):
+            with six.assertRaisesRegex(self, UnsupportedDatabaseError,
+                                       'pycryptodome'):
+                KdbxDatabase(contents, password=b'password')
+
+    def test_kdbx_file_is_not_kdb(self):
+        with self.assertRaises(InvalidDatabaseError):
+            Header(open_data_file('kdbx3.kdbx').read())
+
+
+class TestVariantDictionary(unittest.TestCase):
+    def test_parse_values(self):
+        data = (b'\x00\x01' +
+                variant(0x42, '$UUID', b'\x01' * 16) +
+                variant(0x05, 'I', struct.pack('<Q', 2)) +
+                variant(0x04, 'P', struct.pack('<I', 4)) +
+                variant(0x08, 'B', b'\x01') +
+                variant(0x18, 'S', u'café'.encode('utf-8')) +
+                variant(0x99, 'Unknown', b'x') + b'\x00')
+        self.assertEqual(kdbx.parse_variant_dictionary(data), {
+            '$UUID': b'\x01' * 16, 'I': 2, 'P': 4, 'B': True,
+            'S': u'café'})
+
+
+class KdbxDatabaseTests(object):
+    filename = None
+
+    def setUp(self):
+        self.contents = open_data_file(self.filename).read()
+        self.db = KdbxDatabase(self.contents, password=b'password')
+
+    def test_wrong_password(self):
+        with self.assertRaises(InvalidPasswordError):
+            KdbxDatabase(self.contents, password=b'wrong')
+
+    def test_password_candidates(self):
+        db = KdbxDatabase(self.contents, password=[b'wrong', u'password'])
+        self.assertEqual(db.find_by_title('Gmail').username, 'gmailuser')
+
+    def test_find_by_title(self):
+        entry = self.db.find_by_title('mytitle')
+        self.assertEqual(entry.uuid, 'c4d301502050cd695e353b16094be4a7')
+        self.assertEqual(entry.username, 'myusername')
+        self.assertEqual(entry.url, 'myurl')
+        self.assertEqual(entry.notes, 'mynotes')
+        self.assertEqual(entry.group.path, 'Root/Internet')
+
+    def test_protected_value_with_non_ascii_password(self):
+        entry = self.db.find_by_title('Gmail')
+        self.assertEqual(entry.password, u'pässwörd')
+
+    def test_history_is_not_read(self):
+        self.assertEqual(len(self.db.entries), 2)
+        self.assertEqual(self.db.find_by_title('mytitle').password,
+                         self.current_password)
+
+    def test_attachment(self):
+        entry = self.db.find_by_title('mytitle')
+        self.assertEqual(entry.binary_desc, 'hello.txt')
+        self.assertEqual(entry.attachment.read(), b'hello world' * 100)
+
+    def test_groups(self):
+        self.assertEqual(len(self.db.root_groups), 1)
+        self.assertEqual(self.db.root_groups[0].group_name, 'Root')
+        self.assertEqual(self.db.groups[0].level, 0)
+        self.assertIn('Root/eMail', [g.path for g in self.db.groups])
+        entries = self.db.group_entries('Root/Internet')
+        self.assertIn('mytitle', [e.title for e in entries])
+
+    def test_diff(self):
+        self.assertEqual(
+            self.db.diff(KdbxDatabase(self.contents, password=b'password')),
+            [])
+        # KDB and KDBX files store their fields differently.
+        kdb = Database(open_data_file('password.kdb').read(), b'password')
+        with self.assertRaises(ValueError):
+            self.db.diff(kdb)
+        with self.assertRaises(ValueError):
+            kdb.diff(self.db)
+
+    def test_truncated(self):
+        with self.assertRaises((InvalidDatabaseError, InvalidPasswordError)):
+            KdbxDatabase(self.contents[:-100], password=b'password')
+
+
+class TestKdbx3(KdbxDatabaseTests, unittest.TestCase):
+    # AES-KDF, AES and a Salsa20 inner stream.
+    filename = 'kdbx3.kdbx'
+    current_password = 'mypassword'
+
+    def test_times(self):
+        entry = self.db.find_by_title('mytitle')
+        self.assertEqual(entry.last_mod_time, datetime(2015, 2, 3, 4, 5, 6))
+        self.assertEqual(entry.expiration_time, datetime(2016, 1, 1))
+        gmail = self.db.find_by_title('Gmail')
+        self.assertEqual(gmail.expiration_time.year, 2999)
+
+    def test_corrupt_block(self):
+        contents = bytearray(self.contents)
+        contents[-20] ^= 0xff
+        with self.assertRaises((InvalidDatabaseError, InvalidPasswordError)):
+            KdbxDatabase(bytes(contents), password=b'password')
+
+
+@unittest.skipIf(argon2 is None, "argon2-cffi is not installed")
+class TestKdbx4Argon2d(KdbxDatabaseTests, unittest.TestCase):
+    # Argon2d and AES.
+    filename = 'kdbx4-argon2.kdbx'
+    current_password = 'mynewpassword'
+
+    def test_corrupt_block(self):
+        contents = bytearray(self.contents)
+        contents[-20] ^= 0xff
+        with self.assertRaises(InvalidDatabaseError):
+            KdbxDatabase(bytes(contents), password=b'password')
+
+
+@unittest.skipIf(argon2 is None, "argon2-cffi is not installed")
+class TestKdbx4ChaCha20(KdbxDatabaseTests, unittest.TestCase):
+    # Argon2id and ChaCha20.
+    filename = 'kdbx4-chacha20.kdbx'
+    current_password = 'mynewpassword'
+
+
+@unittest.skipIf(argon2 is None, "argon2-cffi is not installed")
+class TestKeePassXCDatabase(unittest.TestCase):
+    # An empty database saved by KeePassXC, rather than by kdbgen like
+    # the other KDBX fixtures.
+    def test_open(self):
+        contents = open_data_file('keepassxc-empty.kdbx').read()
+        header = KdbxHeader(contents)
+        self.assertEqual(header.version, (4, 0))
+        self.assertEqual(header.kdf_parameters['$UUID'], kdbx.ARGON2D_KDF)
+        db = KdbxDatabase(contents, password=b'password')
+        self.assertEqual([group.path for group in db.groups], ['Root'])
+        self.assertEqual(db.entries, [])
+        with self.assertRaises(InvalidPasswordError):
+            KdbxDatabase(contents, password=b'wrong')
+
+
+if __name__ == '__main__':
+    unittest.main()
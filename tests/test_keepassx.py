@@ -1,11 +1,35 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import hashlib
+import time
+import struct
 import unittest
+import threading
 from datetime import datetime
 
+import mock
+from Crypto.Cipher import AES
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from keepassx import instrument
 from keepassx.db import Database, Header, EntryNotFoundError
-from keepassx.db import encode_password
+from keepassx.db import InvalidPasswordError, InvalidDatabaseError
+from keepassx.db import encode_password, decrypt_cbc, decrypt_range
+from keepassx.db import password_candidates, transform_keys, composite_key
+from keepassx.db import transform_key, derive_key, check_final_key
+from keepassx.db import calculate_key
+from keepassx.db import Group, Entry, GroupNotFoundError
+from keepassx.db import StringPool, StringType, EntryDiff, open_databases
+from keepassx.db import record_offsets, parse_entries_parallel
+from keepassx.db import KeyTransform, KeyDerivationCancelledError
+from keepassx.db import KeyDerivationTimeoutError, KEY_TRANSFORM_CHUNK
+from keepassx.writer import DatabaseWriter
 
 
 def open_data_file(name):
@@ -13,6 +37,26 @@ def open_data_file(name):
                              'misc', name), 'rb')
 
 
+def without_terminators(contents):
+    # Some clients don't null terminate the string fields.
+    original = Database(contents, b'password')
+    records, count = original.encoded_entry_records()
+    payload = original.payload
+    writer = DatabaseWriter(password=b'password', key_encryption_rounds=10)
+    writer.add_group_record(payload[:len(payload) - len(records)])
+    unterminated = bytearray()
+    i = 0
+    while i < len(records):
+        field_type, size = struct.unpack_from('<HI', records, i)
+        data = bytes(records[i + 6:i + 6 + size])
+        if Database.ENTRY_TYPES[field_type][1] is StringType:
+            data = data.rstrip(b'\0')
+        unterminated += struct.pack('<HI', field_type, len(data)) + data
+        i += 6 + size
+    writer.add_entry_records(unterminated, count)
+    return writer.serialize()
+
+
 class TestKeepassX(unittest.TestCase):
     def setUp(self):
         self.kdb_contents = open_data_file('password.kdb').read()
@@ -185,6 +229,41 @@ class TestKeepassX(unittest.TestCase):
         self.assertNotEqual(matches[1].group.group_name,
                             'Backup')
 
+    def test_find_by_url(self):
+        db = Database(open_data_file('demo.kdb').read(), self.password)
+        matches = db.find_by_url('https://www.github.com/login')
+        self.assertEqual([e.title for e in matches], ['Github'])
+        self.assertEqual(db.find_by_url('https://gitlab.com/'), [])
+        # The index is rebuilt when the entries are replaced.
+        db.entries = [e for e in db.entries if e.title != 'Github']
+        self.assertEqual(db.find_by_url('https://github.com/'), [])
+
+    def test_time_queries(self):
+        db = Database(open_data_file('demo.kdb').read(), self.password)
+        self.assertEqual(
+            [e.title for e in db.modified_since(datetime(2013, 1, 1))],
+            ['Gmail', 'Github'])
+        self.assertEqual(
+            [e.title for e in db.time_index('creation_time').last(1)],
+            ['Github'])
+        # None of the entries expire.
+        self.assertEqual(db.expires_before(datetime(3000, 1, 1)), [])
+        self.assertEqual(db.next_to_expire(5), [])
+
+    def test_next_to_expire(self):
+        db = Database(open_data_file('demo.kdb').read(), self.password)
+        self.assertEqual(db.next_to_expire(1), [])
+        entries = db.entries
+        entries[0].expiration_time = datetime(2015, 1, 1)
+        entries[1].expiration_time = datetime(2016, 1, 1)
+        entries[2].expiration_time = datetime(2017, 1, 1)
+        # The indexes are rebuilt when the entries are replaced.
+        db.entries = list(entries)
+        self.assertEqual(
+            db.next_to_expire(1, now=datetime(2015, 6, 1)), [entries[1]])
+        self.assertEqual(db.expires_before(datetime(2016, 6, 1)),
+                         entries[:2])
+
     def test_master_password_latin1(self):
         password = u"\u00f6\u00e4\u00fc\u00df"
         kdb_contents = open_data_file('password-latin1.kdb').read()
@@ -198,6 +277,309 @@ class TestKeepassX(unittest.TestCase):
         self.assertEqual(len(db.groups), 2)
 
 
+class TestExactLookupWithoutFullParse(unittest.TestCase):
+    def setUp(self):
+        kdb_contents = open_data_file('passwordmultientry.kdb').read()
+        self.db = Database(kdb_contents, b'password')
+
+    def test_find_by_title_does_not_decode_all_entries(self):
+        with mock.patch('keepassx.db.Database._parse_entries_payload') as p:
+            entry = self.db.find_by_title('mytitle')
+            self.assertFalse(p.called)
+        self.assertEqual(entry.title, 'mytitle')
+        self.assertEqual(entry.group.group_name, 'Internet')
+        self.assertEqual(entry.username, 'myusername1')
+
+    def test_find_by_uuid_does_not_decode_all_entries(self):
+        uuid = self.db.entries[2].uuid
+        db = Database(open_data_file('passwordmultientry.kdb').read(),
+                      b'password')
+        with mock.patch('keepassx.db.Database._parse_entries_payload') as p:
+            entry = db.find_by_uuid(uuid)
+            self.assertFalse(p.called)
+        self.assertEqual(entry.uuid, uuid)
+        self.assertEqual(entry.group.group_name, 'Backup')
+
+    def test_scan_matches_full_parse(self):
+        expected = self.db.entries[0]
+        db = Database(open_data_file('passwordmultientry.kdb').read(),
+                      b'password')
+        entry = db.find_by_uuid(expected.uuid)
+        self.assertEqual(vars(entry).keys(), vars(expected).keys())
+        for name in ['uuid', 'title', 'password', 'notes', 'creation_time',
+                     'record_span']:
+            self.assertEqual(getattr(entry, name), getattr(expected, name))
+
+    def test_scan_fields(self):
+        fields = ['uuid', 'title', 'creation_time', 'binary_desc']
+        with mock.patch('keepassx.db.Database._parse_entries_payload') as p:
+            scanned = list(self.db.scan_fields(fields))
+            self.assertFalse(p.called)
+        expected = [tuple(getattr(entry, name) for name in fields)
+                    for entry in self.db.entries]
+        self.assertEqual(scanned, expected)
+        # Meta streams are left out, like they are from entries.
+        self.assertNotIn(u'Meta-Info', [values[1] for values in scanned])
+        # Once the entries are decoded they're used instead.
+        self.assertEqual(list(self.db.scan_fields(fields)), expected)
+
+    def test_encoded_entry_records(self):
+        records, count = self.db.encoded_entry_records()
+        self.assertEqual(count, self.db.metadata.num_entries)
+        writer = DatabaseWriter(password=b'password',
+                                key_encryption_rounds=10)
+        for group in self.db.groups:
+            writer.add_group(group)
+        writer.add_entry_records(records, count)
+        copy = Database(writer.serialize(), b'password')
+        self.assertEqual([(e.uuid, e.password) for e in copy.entries],
+                         [(e.uuid, e.password) for e in self.db.entries])
+        # Decoding the entries drops the payload they came from.
+        self.assertIsNone(self.db.encoded_entry_records())
+
+    def test_scan_unknown_field(self):
+        for name in ['attachment', 'group', 'nope']:
+            with self.assertRaises(ValueError):
+                list(self.db.scan_fields([name]))
+
+    def test_find_by_title_without_terminator(self):
+        db = Database(without_terminators(
+            open_data_file('passwordmultientry.kdb').read()), b'password')
+        entry = db.find_by_title('mytitle')
+        self.assertEqual(entry.username, 'myusername1')
+        self.assertIsNone(db._entries)
+        with self.assertRaises(EntryNotFoundError):
+            db.find_by_title('mytitl')
+
+    def test_scanned_entry_is_not_kept(self):
+        first = self.db.find_by_title('mytitle')
+        self.assertIsNot(self.db.find_by_title('mytitle'), first)
+        self.assertNotIn(first, self.db.entries)
+        # Once the entries are decoded they're what's returned.
+        self.assertIs(self.db.find_by_title('mytitle'),
+                      self.db.find_by_uuid(first.uuid))
+
+    def test_invalid_uuid_not_found(self):
+        with self.assertRaises(EntryNotFoundError):
+            self.db.find_by_uuid('nothex')
+
+    def test_system_entries_not_returned(self):
+        with self.assertRaises(EntryNotFoundError):
+            self.db.find_by_title('Meta-Info')
+
+    def test_title_not_found(self):
+        with self.assertRaises(EntryNotFoundError):
+            self.db.find_by_title('mytitl')
+
+
+class TestFailFast(unittest.TestCase):
+    def setUp(self):
+        self.kdb_contents = open_data_file('password.kdb').read()
+
+    def test_not_a_kdb_file_rejected_before_key_derivation(self):
+        with mock.patch('keepassx.db.calculate_key') as calculate_key:
+            with self.assertRaises(InvalidDatabaseError):
+                Database(b'\x00' * 1024, b'password')
+            self.assertFalse(calculate_key.called)
+
+    def test_file_too_small(self):
+        with self.assertRaises(InvalidDatabaseError):
+            Database(self.kdb_contents[:50], b'password')
+
+    def test_unsupported_version(self):
+        contents = (self.kdb_contents[:12] + struct.pack('<I', 0x20001) +
+                    self.kdb_contents[16:])
+        with self.assertRaises(InvalidDatabaseError):
+            Header(contents)
+
+    def test_truncated_payload(self):
+        with self.assertRaises(InvalidDatabaseError):
+            Database(self.kdb_contents[:-5], b'password')
+
+    def test_wrong_password_rejected_before_full_decrypt(self):
+        profile = instrument.Profile()
+        instrument.add_hook(profile)
+        self.addCleanup(instrument.remove_hook, profile)
+        with self.assertRaises(InvalidPasswordError):
+            Database(self.kdb_contents, b'wrongpassword')
+        self.assertIn('calculate_key', profile.timings)
+        self.assertNotIn('decrypt', profile.timings)
+
+
+class TestParallelDecrypt(unittest.TestCase):
+    def setUp(self):
+        self.key = b'k' * 32
+        self.iv = b'i' * 16
+        self.ciphertext = bytes(bytearray(i % 251 for i in range(16 * 1001)))
+
+    def test_matches_serial_decryption(self):
+        expected = AES.new(self.key, AES.MODE_CBC, self.iv).decrypt(
+            self.ciphertext)
+        for workers in [1, 2, 3, 8, 2000]:
+            self.assertEqual(
+                bytes(decrypt_cbc(self.key, self.iv, self.ciphertext,
+                                  workers)),
+                expected)
+
+    def test_decrypt_range(self):
+        expected = AES.new(self.key, AES.MODE_CBC, self.iv).decrypt(
+            self.ciphertext)
+        for start, end in [(0, 5), (3, 40), (16, 32), (100, 16016),
+                           (16000, 16016)]:
+            self.assertEqual(
+                decrypt_range(self.key, self.iv, self.ciphertext, start, end),
+                expected[start:end])
+
+    def test_empty_ciphertext(self):
+        self.assertEqual(decrypt_cbc(self.key, self.iv, b''), bytearray())
+
+    def test_database_uses_parallel_decrypt_above_threshold(self):
+        kdb_contents = open_data_file('attachment.kdb').read()
+        with mock.patch('keepassx.db.Database.PARALLEL_DECRYPT_THRESHOLD', 0):
+            with mock.patch('keepassx.db.decrypt_cbc',
+                            wraps=decrypt_cbc) as parallel:
+                db = Database(kdb_contents, b'password')
+        self.assertTrue(parallel.called)
+        # The padding is stripped in place rather than copying the
+        # plaintext into a new bytes object.
+        self.assertIsInstance(db._payload, bytearray)
+        self.assertEqual(db.diff(Database(kdb_contents, b'password')), [])
+        entry = db.find_by_title('withattachment')
+        self.assertEqual(len(entry.binary_data), 100000)
+        self.assertIsInstance(entry.binary_data, bytes)
+
+
+class TestParallelParse(unittest.TestCase):
+    def setUp(self):
+        writer = DatabaseWriter(password=b'password', key_encryption_rounds=10)
+        group = Group()
+        group.groupid = 1
+        group.group_name = u'Internet'
+        writer.add_group(group)
+        for i in range(10):
+            entry = Entry()
+            entry.group = group
+            entry.title = u'entry-%d' % i
+            entry.username = u'user'
+            entry.password = u'p\u00e4ss-%d' % i
+            entry.creation_time = datetime(2015, 1, 1, 0, 0, i)
+            if i % 3 == 0:
+                entry.binary_desc = u'file-%d' % i
+                entry.binary_data = b'data' * i
+            writer.add_entry(entry)
+        self.contents = writer.serialize()
+
+    def load(self, threshold, processes):
+        db = Database(self.contents, b'password')
+        db.PARALLEL_PARSE_THRESHOLD = threshold
+        db.PARSE_PROCESSES = processes
+        return db.entries
+
+    def entry_values(self, entries):
+        values = []
+        for entry in entries:
+            value = dict(vars(entry))
+            value['group'] = entry.group.groupid
+            if entry.attachment is not None:
+                value['attachment'] = entry.attachment.read()
+            values.append(value)
+        return values
+
+    def test_matches_serial_parse(self):
+        expected = self.entry_values(self.load(10 ** 9, 1))
+        for processes in [2, 3, 20]:
+            self.assertEqual(
+                self.entry_values(self.load(0, processes)), expected)
+
+    def test_without_shared_memory(self):
+        expected = self.entry_values(self.load(10 ** 9, 1))
+        with mock.patch('keepassx.db.shared_memory', None):
+            self.assertEqual(self.entry_values(self.load(0, 2)), expected)
+
+    def test_serial_with_one_process(self):
+        with mock.patch('keepassx.db.parse_entries_parallel') as parallel:
+            self.load(0, 1)
+        self.assertFalse(parallel.called)
+
+    def test_strings_pooled_across_chunks(self):
+        serial = Database(self.contents, b'password')
+        serial.PARALLEL_PARSE_THRESHOLD = 10 ** 9
+        serial.entries
+        db = Database(self.contents, b'password')
+        db.PARALLEL_PARSE_THRESHOLD = 0
+        db.PARSE_PROCESSES = 3
+        entries = db.entries
+        self.assertTrue(all(entry.username is entries[0].username
+                            for entry in entries))
+        self.assertEqual((db.string_pool.hits, db.string_pool.misses),
+                         (serial.string_pool.hits, serial.string_pool.misses))
+
+    def test_attachments_refer_to_payload(self):
+        entries = self.load(0, 2)
+        self.assertEqual(entries[3].attachment.read(), b'data' * 3)
+        self.assertEqual(entries[0].attachment.read(), b'')
+
+    def test_record_offsets(self):
+        db = Database(self.contents, b'password')
+        payload = db._payload
+        offsets = record_offsets(payload, 0, 1 + db.metadata.num_entries)
+        self.assertEqual(offsets[-1], len(payload))
+        self.assertEqual(offsets[1], db._parse_groups_payload(payload)[1])
+
+    def test_parse_entries_parallel_directly(self):
+        db = Database(self.contents, b'password')
+        payload = db._payload
+        start = db._parse_groups_payload(payload)[1]
+        entries, fields_decoded = parse_entries_parallel(
+            payload, start, db.metadata.num_entries, processes=2)
+        self.assertEqual([e.title for e in entries],
+                         [u'entry-%d' % i for i in range(10)])
+        self.assertGreater(fields_decoded, 0)
+
+
+class TestAttachments(unittest.TestCase):
+    def setUp(self):
+        kdb_contents = open_data_file('attachment.kdb').read()
+        self.db = Database(kdb_contents, b'password')
+        self.expected = bytes(bytearray((i * 7) & 0xff
+                                        for i in range(100000)))
+
+    def test_attachment_metadata(self):
+        entry = self.db.find_by_title('withattachment')
+        self.assertEqual(entry.binary_desc, 'hello.bin')
+        self.assertEqual(len(entry.attachment), 100000)
+
+    def test_binary_data_reads_attachment(self):
+        entry = self.db.find_by_title('withattachment')
+        self.assertEqual(entry.binary_data, self.expected)
+
+    def test_stream_attachment_in_chunks(self):
+        entry = self.db.find_by_title('withattachment')
+        reader = entry.attachment.open()
+        chunks = []
+        while True:
+            chunk = reader.read(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), self.expected)
+        self.assertEqual(len(chunks[0]), 4096)
+
+    def test_attachment_reader_seek(self):
+        entry = self.db.find_by_title('withattachment')
+        reader = entry.attachment.open()
+        reader.seek(-10, 2)
+        self.assertEqual(reader.read(), self.expected[-10:])
+        reader.seek(5)
+        self.assertEqual(reader.read(3), self.expected[5:8])
+
+    def test_entry_with_empty_attachment(self):
+        entry = self.db.find_by_title('noattachment')
+        self.assertEqual(len(entry.attachment), 0)
+        self.assertEqual(entry.binary_data, b'')
+        self.assertEqual(entry.attachment.open().read(), b'')
+
+
 class TestEncodePassword(unittest.TestCase):
     def test_encode_ascii(self):
         self.assertEqual(encode_password('foo'), b'foo')
@@ -213,3 +595,472 @@ class TestEncodePassword(unittest.TestCase):
         # Or in other words:
         self.assertEqual(encode_password(u"\u2714"),
                          encode_password(u"\u2713"))
+
+
+def create_nested_database():
+    # Internet
+    #   Email
+    #     Work
+    #   Shopping
+    # Backup
+    #   Old
+    writer = DatabaseWriter(password=b'password', key_encryption_rounds=10)
+    groups = {}
+    for groupid, name, level in [(1, u'Internet', 0), (2, u'Email', 1),
+                                 (3, u'Work', 2), (4, u'Shopping', 1),
+                                 (5, u'Backup', 0), (6, u'Old', 1)]:
+        group = Group()
+        group.groupid = groupid
+        group.group_name = name
+        group.level = level
+        writer.add_group(group)
+        groups[name] = group
+    for title, group in [(u'gmail', u'Email'), (u'outlook', u'Work'),
+                         (u'amazon', u'Shopping'), (u'forum', u'Internet'),
+                         (u'oldgmail', u'Old'), (u'old', u'Backup')]:
+        entry = Entry()
+        entry.group = groups[group]
+        entry.title = title
+        writer.add_entry(entry)
+    return writer.serialize()
+
+
+class TestGroupTree(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(create_nested_database(), b'password')
+
+    def titles(self, entries):
+        return sorted(entry.title for entry in entries)
+
+    def test_group_paths(self):
+        self.assertEqual([g.path for g in self.db.groups],
+                         ['Internet', 'Internet/Email',
+                          'Internet/Email/Work', 'Internet/Shopping',
+                          'Backup', 'Backup/Old'])
+
+    def test_parent_and_children(self):
+        internet, email, work, shopping, backup, old = self.db.groups
+        self.assertEqual(self.db.root_groups, [internet, backup])
+        self.assertIsNone(internet.parent)
+        self.assertEqual(internet.children, [email, shopping])
+        self.assertIs(work.parent, email)
+        self.assertIs(old.parent, backup)
+
+    def test_group_entries_lists(self):
+        self.db.entries
+        email = self.db.find_groups('Internet/Email')[0]
+        self.assertEqual(self.titles(email.entries), ['gmail'])
+
+    def test_subtree_entries(self):
+        self.assertEqual(self.titles(self.db.group_entries('Internet')),
+                         ['amazon', 'forum', 'gmail', 'outlook'])
+        self.assertEqual(
+            self.titles(self.db.group_entries('Internet/Email')),
+            ['gmail', 'outlook'])
+        self.assertEqual(
+            self.titles(self.db.group_entries('/Internet/Shopping/')),
+            ['amazon'])
+
+    def test_exclude_groups(self):
+        self.assertEqual(self.titles(self.db.exclude_groups(['Backup'])),
+                         ['amazon', 'forum', 'gmail', 'outlook'])
+        self.assertEqual(
+            self.titles(self.db.exclude_groups(['Internet/Email',
+                                                'Backup/Old'])),
+            ['amazon', 'forum', 'old'])
+        self.assertEqual(len(self.db.exclude_groups(['Unknown'])), 6)
+
+    def test_exclude_groups_by_name(self):
+        self.assertEqual(
+            self.titles(self.db.exclude_groups(names=['Email', 'Backup'])),
+            ['amazon', 'forum'])
+        self.assertEqual(
+            [g.path for g in self.db.included_groups(names=['Email'])],
+            ['Internet', 'Internet/Shopping', 'Backup', 'Backup/Old'])
+        # Unlike paths, names match at any depth.
+        self.assertEqual(len(self.db.exclude_groups(['Email'])), 6)
+
+    def test_unknown_group(self):
+        with self.assertRaises(GroupNotFoundError):
+            self.db.group_entries('Internet/Unknown')
+
+    def test_iter_entries(self):
+        titles = [entry.title for entry in self.db.iter_entries()]
+        self.assertEqual(titles, ['gmail', 'outlook', 'amazon', 'forum',
+                                  'oldgmail', 'old'])
+        # The entries are decoded as they're yielded and not kept.
+        self.assertIsNone(self.db._entries)
+        groups = set(self.db.subtree_groups('Internet/Email'))
+        entries = list(self.db.iter_entries(groups))
+        self.assertEqual([e.title for e in entries], ['gmail', 'outlook'])
+        self.assertEqual(entries[1].group.path, 'Internet/Email/Work')
+        # Once the entries are decoded, the decoded entries are used.
+        self.db.entries
+        self.assertIs(next(self.db.iter_entries()), self.db.entries[0])
+
+    def test_existing_databases_are_flat(self):
+        db = Database(open_data_file('passwordmultientry.kdb').read(),
+                      b'password')
+        self.assertEqual([g.path for g in db.root_groups],
+                         ['Internet', 'eMail', 'Backup'])
+        self.assertEqual(self.titles(db.exclude_groups(['Backup'])),
+                         ['mytitle', 'mytitle'])
+
+
+class TestStringPool(unittest.TestCase):
+    def test_strips_null_terminator(self):
+        pool = StringPool()
+        payload = b'xxfoo\0yy'
+        self.assertEqual(pool.decode(payload, 2, 4), u'foo')
+
+    def test_repeated_values_share_a_string(self):
+        pool = StringPool()
+        payload = StringType.encode(u'user\u2713') * 2
+        first = pool.decode(payload, 0, len(payload) // 2)
+        second = pool.decode(payload, len(payload) // 2, len(payload) // 2)
+        self.assertEqual(first, u'user\u2713')
+        self.assertIs(first, second)
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+        self.assertEqual(pool.hit_rate, 0.5)
+        self.assertEqual(len(pool), 1)
+
+    @unittest.skipIf(tracemalloc is None, "tracemalloc isn't available")
+    def test_unique_values_are_not_copied(self):
+        # A pool of values that never repeat should cost less than the
+        # strings themselves, it mustn't keep a second copy of each.
+        fields = [StringType.encode(u'https://example.com/%s/%s' %
+                                    (i, u'x' * 70)) for i in range(2000)]
+        payload = b''.join(fields)
+
+        def decode_all(decode):
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                values = []
+                offset = 0
+                for field in fields:
+                    values.append(decode(payload, offset, len(field)))
+                    offset += len(field)
+                return tracemalloc.get_traced_memory()[0] - before, values
+            finally:
+                tracemalloc.stop()
+
+        unpooled, values = decode_all(
+            lambda payload, offset, size:
+            StringType.decode(payload[offset:offset + size]))
+        pooled = decode_all(StringPool().decode)[0]
+        strings_size = sum(sys.getsizeof(value) for value in values)
+        self.assertLess(pooled - unpooled, strings_size // 2)
+
+    def test_string_type_decode(self):
+        self.assertEqual(StringType.decode(b'foo\0'), u'foo')
+        self.assertEqual(StringType.decode(b'foo'), u'foo')
+        self.assertEqual(StringType.decode(b'f\0oo\0'), u'foo')
+
+    def test_database_fields_are_pooled(self):
+        db = Database(open_data_file('passwordmultientry.kdb').read(),
+                      b'password')
+        first, second = db.entries[:2]
+        self.assertEqual(first.url, second.url)
+        self.assertIs(first.url, second.url)
+        self.assertGreater(db.string_pool.hits, 0)
+
+    def test_passwords_are_not_pooled(self):
+        pool = StringPool()
+        db = Database(open_data_file('passwordmultientry.kdb').read(),
+                      b'password', string_pool=pool)
+        passwords = set(entry.password for entry in db.entries)
+        self.assertFalse(passwords & set(pool._strings.values()))
+
+    def test_pool_shared_between_databases(self):
+        pool = StringPool()
+        contents = open_data_file('passwordmultientry.kdb').read()
+        first = Database(contents, b'password', string_pool=pool)
+        second = Database(contents, b'password', string_pool=pool)
+        self.assertIs(first.entries[0].url, second.entries[0].url)
+        self.assertIs(first.groups[0].group_name,
+                      second.groups[0].group_name)
+
+    def test_hit_rate_counted(self):
+        profile = instrument.Profile()
+        instrument.add_hook(profile)
+        self.addCleanup(instrument.remove_hook, profile)
+        Database(open_data_file('passwordmultientry.kdb').read(),
+                 b'password').entries
+        self.assertGreater(profile.counters['string_pool_hits'], 0)
+        self.assertGreater(profile.counters['string_pool_misses'], 0)
+
+
+def create_diff_database(entries):
+    writer = DatabaseWriter(password=b'password', key_encryption_rounds=10)
+    group = Group()
+    group.groupid = 1
+    group.group_name = u'Internet'
+    writer.add_group(group)
+    for uuid, title, password, modified in entries:
+        entry = Entry()
+        entry.group = group
+        entry.uuid = uuid
+        entry.title = title
+        entry.password = password
+        entry.creation_time = datetime(2015, 1, 1)
+        entry.last_mod_time = modified
+        entry.last_acc_time = modified
+        writer.add_entry(entry)
+    return writer.serialize()
+
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.ours_contents = create_diff_database([
+            (u'1' * 32, u'same', u'pw', datetime(2015, 1, 1)),
+            (u'2' * 32, u'changed', u'old', datetime(2015, 1, 1)),
+            (u'3' * 32, u'removed', u'pw', datetime(2015, 1, 1)),
+            (u'5' * 32, u'accessed', u'pw', datetime(2015, 1, 1)),
+        ])
+        self.theirs_contents = create_diff_database([
+            (u'4' * 32, u'added', u'pw', datetime(2015, 1, 1)),
+            (u'2' * 32, u'changed', u'new', datetime(2016, 1, 1)),
+            (u'1' * 32, u'same', u'pw', datetime(2015, 1, 1)),
+            (u'5' * 32, u'accessed', u'pw', datetime(2015, 1, 1)),
+        ])
+
+    def open(self, contents):
+        return Database(contents, b'password')
+
+    def assert_diffs(self, diffs):
+        self.assertEqual(
+            [(d.status, d.entry.title, d.fields, d.newer) for d in diffs],
+            [(EntryDiff.CHANGED, 'changed', ['last_mod_time', 'password'],
+              'theirs'),
+             (EntryDiff.REMOVED, 'removed', [], None),
+             (EntryDiff.ADDED, 'added', [], None)])
+
+    def test_diff(self):
+        ours = self.open(self.ours_contents)
+        diffs = ours.diff(self.open(self.theirs_contents))
+        self.assert_diffs(diffs)
+        changed = diffs[0]
+        self.assertEqual(changed.ours.password, 'old')
+        self.assertEqual(changed.theirs.password, 'new')
+        self.assertEqual(changed.ours.group.group_name, 'Internet')
+
+    def test_diff_decoded_entries(self):
+        ours = self.open(self.ours_contents)
+        theirs = self.open(self.theirs_contents)
+        ours.entries
+        self.assert_diffs(ours.diff(theirs))
+        theirs.entries
+        self.assert_diffs(ours.diff(theirs))
+
+    def test_no_differences(self):
+        db = self.open(self.ours_contents)
+        self.assertEqual(db.diff(self.open(self.ours_contents)), [])
+
+    def test_strings_compared_without_terminators(self):
+        unterminated = self.open(without_terminators(self.ours_contents))
+        ours = self.open(self.ours_contents)
+        self.assertEqual(ours.diff(unterminated), [])
+        ours.entries
+        self.assertEqual(ours.diff(unterminated), [])
+
+    def test_open_databases(self):
+        ours, theirs = open_databases(
+            [self.ours_contents, self.theirs_contents],
+            password_candidates(u'password'), processes=2)
+        self.assert_diffs(ours.diff(theirs))
+
+    def test_open_databases_wrong_password(self):
+        with self.assertRaises(InvalidPasswordError):
+            open_databases([self.ours_contents,
+                            open_data_file('passwordkey.kdb').read()],
+                           [b'password'])
+
+
+def create_utf8_database(password):
+    writer = DatabaseWriter(password=password.encode('utf-8'),
+                            key_encryption_rounds=10)
+    group = Group()
+    group.groupid = 1
+    group.group_name = u'Internet'
+    writer.add_group(group)
+    entry = Entry()
+    entry.group = group
+    entry.title = u'mytitle'
+    entry.password = u'mypassword'
+    writer.add_entry(entry)
+    return writer.serialize()
+
+
+class TestPasswordCandidates(unittest.TestCase):
+    def test_ascii_password_has_one_candidate(self):
+        self.assertEqual(password_candidates(u'password'), [b'password'])
+
+    def test_candidates_are_distinct(self):
+        self.assertEqual(password_candidates(u'\u00f6'),
+                         [b'\xf6', b'\xc3\xb6'])
+        self.assertEqual(password_candidates(u'\u20ac'),
+                         [b'\x80', b'?', b'\xe2\x82\xac'])
+
+    def test_first_candidate_is_encode_password(self):
+        self.assertEqual(password_candidates(u'password\u2713')[0],
+                         encode_password(u'password\u2713'))
+
+    def test_open_utf8_database(self):
+        password = u'p\u00e4ssword\u2713'
+        contents = create_utf8_database(password)
+        with self.assertRaises(InvalidPasswordError):
+            Database(contents, encode_password(password))
+        db = Database(contents, password_candidates(password))
+        self.assertEqual(db.find_by_title('mytitle').password, 'mypassword')
+
+    def test_open_cp1252_database(self):
+        password = u'\u00f6\u00e4\u00fc\u00df'
+        kdb_contents = open_data_file('password-latin1.kdb').read()
+        db = Database(kdb_contents, password_candidates(password))
+        self.assertEqual(len(db.groups), 2)
+
+    def test_no_candidate_matches(self):
+        kdb_contents = open_data_file('password.kdb').read()
+        with self.assertRaises(InvalidPasswordError):
+            Database(kdb_contents, password_candidates(u'wr\u00f6ng'))
+
+    def test_derive_key_returns_matching_key(self):
+        password = u'p\u00e4ssword'
+        contents = create_utf8_database(password)
+        header = Header(contents)
+        transformed_key, final_key = derive_key(
+            header, contents[Header.HEADER_SIZE:],
+            password_candidates(password), processes=2)
+        self.assertEqual(transformed_key, transform_key(
+            composite_key(password.encode('utf-8'), None),
+            header.master_seed2, header.key_encryption_rounds))
+        check_final_key(header, contents[Header.HEADER_SIZE:], final_key)
+
+    def test_transform_keys_in_processes(self):
+        keys = [composite_key(b'a', None), composite_key(b'b', None)]
+        seed2 = b'\x01' * 32
+        results = dict(transform_keys(keys, seed2, 100, processes=2))
+        self.assertEqual(results, {
+            0: transform_key(keys[0], seed2, 100),
+            1: transform_key(keys[1], seed2, 100),
+        })
+
+    def test_transform_key_matches_ecb_rounds(self):
+        key = composite_key(b'password', None)
+        seed2 = b'\x02' * 32
+        cipher = AES.new(seed2, AES.MODE_ECB)
+        expected = key
+        for _ in range(1000):
+            expected = cipher.encrypt(expected)
+        self.assertEqual(transform_key(key, seed2, 1000),
+                         hashlib.sha256(expected).digest())
+
+    def test_key_transform_in_slices(self):
+        key = composite_key(b'password', None)
+        seed2 = b'\x03' * 32
+        transform = KeyTransform(key, seed2, 1000)
+        with self.assertRaises(ValueError):
+            transform.result()
+        steps = 0
+        while not transform.step(300):
+            steps += 1
+        self.assertEqual(steps, 3)
+        self.assertEqual(transform.rounds_done, 1000)
+        self.assertEqual(transform.result(), transform_key(key, seed2, 1000))
+
+    def test_transform_key_progress(self):
+        key = composite_key(b'password', None)
+        calls = []
+        num_rounds = 2 * KEY_TRANSFORM_CHUNK + 10
+        transform_key(key, b'\x04' * 32, num_rounds,
+                      progress=lambda done, total: calls.append(done))
+        self.assertEqual(calls, [KEY_TRANSFORM_CHUNK,
+                                 2 * KEY_TRANSFORM_CHUNK, num_rounds])
+
+    def test_key_transform_deadline_can_resume(self):
+        key = composite_key(b'password', None)
+        seed2 = b'\x05' * 32
+        transform = KeyTransform(key, seed2, 1000)
+        transform.step(100)
+        with self.assertRaises(KeyDerivationTimeoutError):
+            transform.run(deadline=time.time() - 1)
+        self.assertEqual(transform.rounds_done, 100)
+        self.assertEqual(transform.run(), transform_key(key, seed2, 1000))
+
+    def test_key_transform_cancel(self):
+        cancel = threading.Event()
+        transform = KeyTransform(composite_key(b'password', None),
+                                 b'\x06' * 32, 10 ** 9)
+
+        def progress(done, total):
+            cancel.set()
+        with self.assertRaises(KeyDerivationCancelledError):
+            transform.run(progress=progress, cancel=cancel)
+        self.assertLess(transform.rounds_done, 10 ** 9)
+
+    def test_transform_keys_in_order_progress(self):
+        keys = [composite_key(b'a', None), composite_key(b'b', None)]
+        calls = []
+        num_rounds = KEY_TRANSFORM_CHUNK + 10
+        list(transform_keys(
+            keys, b'\x09' * 32, num_rounds, processes=1,
+            progress=lambda done, total: calls.append((done, total))))
+        # The second key's rounds follow on from the first key's.
+        total = 2 * num_rounds
+        self.assertEqual(calls, [(KEY_TRANSFORM_CHUNK, total),
+                                 (num_rounds, total),
+                                 (num_rounds + KEY_TRANSFORM_CHUNK, total),
+                                 (total, total)])
+
+    def test_transform_keys_in_processes_progress(self):
+        keys = [composite_key(b'a', None), composite_key(b'b', None)]
+        seed2 = b'\x07' * 32
+        calls = []
+        with mock.patch('keepassx.db._PROGRESS_INTERVAL', 0.001):
+            results = dict(transform_keys(
+                keys, seed2, 2 * 10 ** 6, processes=2,
+                progress=lambda done, total: calls.append((done, total))))
+        self.assertEqual(results[1], transform_key(keys[1], seed2,
+                                                   2 * 10 ** 6))
+        self.assertTrue(calls)
+        done = [call[0] for call in calls]
+        self.assertEqual(done, sorted(done))
+        self.assertTrue(all(total == 4 * 10 ** 6 for _, total in calls))
+
+    def test_transform_keys_in_processes_deadline(self):
+        keys = [composite_key(b'a', None), composite_key(b'b', None)]
+        transformed = transform_keys(keys, b'\x08' * 32, 10 ** 9,
+                                     processes=2, deadline=time.time())
+        with self.assertRaises(KeyDerivationTimeoutError):
+            list(transformed)
+
+    def test_derive_key_deadline(self):
+        contents = open_data_file('password.kdb').read()
+        header = Header(contents)
+        with self.assertRaises(KeyDerivationTimeoutError):
+            derive_key(header, contents[Header.HEADER_SIZE:], [b'password'],
+                       deadline=time.time() - 1)
+
+    def test_check_final_key_rejects_wrong_key(self):
+        kdb_contents = open_data_file('password.kdb').read()
+        header = Header(kdb_contents)
+        with self.assertRaises(InvalidPasswordError):
+            check_final_key(header, kdb_contents[Header.HEADER_SIZE:],
+                            b'\x00' * 32)
+
+    def test_first_group_starting_with_ignored_field(self):
+        # The first group of groupcomment.kdb starts with a 0x0 field
+        # rather than its groupid.
+        kdb_contents = open_data_file('groupcomment.kdb').read()
+        header = Header(kdb_contents)
+        final_key = calculate_key(b'password', None, header.master_seed,
+                                  header.master_seed2,
+                                  header.key_encryption_rounds)
+        check_final_key(header, kdb_contents[Header.HEADER_SIZE:], final_key)
+        with self.assertRaises(InvalidPasswordError):
+            check_final_key(header, kdb_contents[Header.HEADER_SIZE:],
+                            b'\x00' * 32)
+        db = Database(kdb_contents, b'password')
+        self.assertEqual(db.groups[0].group_name, 'Internet')
+        self.assertEqual(db.find_by_title('mytitle').password, 'mypassword')
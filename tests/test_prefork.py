@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import gc
+import os
+import unittest
+
+import mock
+
+from keepassx import prefork
+from keepassx.db import Database, EntryNotFoundError
+from keepassx.kdbx import KdbxDatabase
+from keepassx.prefork import FrozenDatabase
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+class TestFrozenDatabase(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(open_data_file('demo.kdb').read(), b'password')
+        self.frozen = FrozenDatabase.freeze(
+            Database(open_data_file('demo.kdb').read(), b'password'))
+
+    def test_find_by_uuid(self):
+        for expected in self.db.entries:
+            entry = self.frozen.find_by_uuid(expected.uuid)
+            self.assertEqual(entry.title, expected.title)
+            self.assertEqual(entry.password, expected.password)
+            self.assertEqual(entry.group.path, expected.group.path)
+
+    def test_find_by_title(self):
+        entry = self.frozen.find_by_title('Github')
+        self.assertEqual(entry.uuid, self.db.find_by_title('Github').uuid)
+
+    def test_find_by_title_returns_first_match(self):
+        db = Database(open_data_file('passwordmultientry.kdb').read(),
+                      b'password')
+        frozen = FrozenDatabase.freeze(db)
+        self.assertEqual(frozen.find_by_title('mytitle').uuid,
+                         db.entries[0].uuid)
+
+    def test_not_found(self):
+        with self.assertRaises(EntryNotFoundError):
+            self.frozen.find_by_title('missing')
+        with self.assertRaises(EntryNotFoundError):
+            self.frozen.find_by_uuid('0' * 32)
+        with self.assertRaises(EntryNotFoundError):
+            self.frozen.find_by_uuid('not a uuid')
+
+    def test_lookups_decode_only_the_match(self):
+        self.frozen.find_by_title('Github')
+        self.assertIsNone(self.frozen._entries)
+
+    def test_everything_else_still_works(self):
+        self.assertEqual(
+            sorted(e.title for e in self.frozen.group_entries('Internet')),
+            ['Github', 'mytitle'])
+        self.assertEqual(len(self.frozen.entries), len(self.db.entries))
+        self.assertEqual(self.frozen.fuzzy_search_by_title('gith')[0].title,
+                         'Github')
+        # Lookups keep working after every entry has been decoded.
+        self.assertEqual(self.frozen.find_by_title('Gmail').title, 'Gmail')
+
+    def test_shared_state_is_bytes(self):
+        self.assertTrue(all(isinstance(value, bytes) for value in [
+            self.frozen._records, self.frozen._offsets,
+            self.frozen._uuid_table, self.frozen._title_table]))
+        self.assertGreater(self.frozen.nbytes, 0)
+
+    def test_freeze_kdbx(self):
+        frozen = FrozenDatabase.freeze(KdbxDatabase(
+            open_data_file('kdbx3.kdbx').read(), b'password'))
+        entry = frozen.find_by_title('mytitle')
+        self.assertEqual(entry.password, 'mypassword')
+        self.assertEqual(entry.group.path, 'Root/Internet')
+        self.assertEqual(entry.attachment.read(), b'hello world' * 100)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "os.fork is not available")
+    def test_lookup_in_forked_child(self):
+        read_fd, write_fd = os.pipe()
+        prefork.before_fork()
+        if hasattr(gc, 'unfreeze'):
+            self.addCleanup(gc.unfreeze)
+        self.addCleanup(gc.enable)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                prefork.after_fork()
+                password = self.frozen.find_by_title('Github').password
+                os.write(write_fd, password.encode('utf-8'))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd, 'rb') as f:
+            self.assertEqual(f.read().decode('utf-8'),
+                             self.db.find_by_title('Github').password)
+
+
+class TestForkHooks(unittest.TestCase):
+    def test_before_fork_freezes(self):
+        with mock.patch('keepassx.prefork.gc') as gc:
+            prefork.before_fork()
+        gc.collect.assert_called_with()
+        gc.freeze.assert_called_with()
+
+    def test_before_fork_without_freeze_disables(self):
+        with mock.patch('keepassx.prefork.gc') as gc:
+            del gc.freeze
+            gc.isenabled.return_value = True
+            prefork.before_fork()
+            gc.disable.assert_called_with()
+            prefork.after_fork()
+            gc.enable.assert_called_with()
+
+    def test_gc_enabled_again_in_parent(self):
+        with mock.patch('keepassx.prefork.gc') as gc:
+            del gc.freeze
+            gc.isenabled.return_value = True
+            prefork.before_fork()
+            prefork.after_fork_in_parent()
+            gc.enable.assert_called_once_with()
+            # Only if before_fork disabled it.
+            gc.isenabled.return_value = False
+            prefork.before_fork()
+            prefork.after_fork_in_parent()
+            gc.enable.assert_called_once_with()
+
+    def test_install_fork_hooks(self):
+        with mock.patch('keepassx.prefork.os') as os_module:
+            with mock.patch.dict(prefork._state, {'registered': False}):
+                self.assertTrue(prefork.install_fork_hooks())
+                self.assertTrue(prefork.install_fork_hooks())
+                prefork.uninstall_fork_hooks()
+        # The hooks are registered once and turned off rather than
+        # unregistered, which os.register_at_fork doesn't support.
+        self.assertEqual(os_module.register_at_fork.call_count, 1)
+        hooks = os_module.register_at_fork.call_args[1]
+        with mock.patch('keepassx.prefork.gc') as gc:
+            hooks['before']()
+            hooks['after_in_child']()
+            hooks['after_in_parent']()
+        self.assertFalse(gc.collect.called)
+        self.assertFalse(gc.enable.called)
+
+    def test_fork_hooks_only_run_inside_block(self):
+        with mock.patch('keepassx.prefork.os') as os_module:
+            with mock.patch.dict(prefork._state, {'registered': False}):
+                with prefork.fork_hooks() as installed:
+                    self.assertTrue(installed)
+                    hooks = os_module.register_at_fork.call_args[1]
+                    with mock.patch('keepassx.prefork.gc') as gc:
+                        hooks['before']()
+                        hooks['after_in_child']()
+                    gc.collect.assert_called_with()
+                    gc.enable.assert_called_with()
+                with mock.patch('keepassx.prefork.gc') as gc:
+                    hooks['before']()
+                self.assertFalse(gc.collect.called)
+
+    def test_fork_hooks_without_register_at_fork(self):
+        with mock.patch('keepassx.prefork.os') as os_module:
+            del os_module.register_at_fork
+            with prefork.fork_hooks() as installed:
+                self.assertFalse(installed)
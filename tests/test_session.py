@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from keepassx import session
+from keepassx.db import Header
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.runtime_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.runtime_dir)
+        patcher = mock.patch.dict(os.environ,
+                                  {'XDG_RUNTIME_DIR': self.runtime_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.header = Header(open_data_file('password.kdb').read())
+        self.db_filename = os.path.join(self.runtime_dir, 'password.kdb')
+        self.transformed_key = b'k' * 32
+
+    def test_load_session(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        self.assertEqual(session.load_session(self.db_filename, self.header),
+                         self.transformed_key)
+
+    def test_no_session(self):
+        self.assertIsNone(session.load_session(self.db_filename, self.header))
+        # Looking for a session doesn't create the session directory.
+        self.assertEqual(os.listdir(self.runtime_dir), [])
+
+    def test_session_files_are_private(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        directory = session.session_dir()
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        for name in os.listdir(directory):
+            mode = os.stat(os.path.join(directory, name)).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0o600)
+
+    def test_session_does_not_contain_key(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        directory = session.session_dir()
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                self.assertNotIn(self.transformed_key, f.read())
+
+    def test_expired_session_is_removed(self):
+        with mock.patch('time.time') as now:
+            now.return_value = 1000
+            session.create_session(self.db_filename, self.header,
+                                   self.transformed_key, 60)
+            now.return_value = 1061
+            self.assertIsNone(
+                session.load_session(self.db_filename, self.header))
+        self.assertEqual(os.listdir(session.session_dir()), [])
+
+    def test_session_bound_to_db_filename(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        self.assertIsNone(session.load_session(
+            self.db_filename + '.copy', self.header))
+
+    def test_session_bound_to_seeds(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        self.header.master_seed2 = b'\x00' * 32
+        self.assertIsNone(session.load_session(self.db_filename, self.header))
+
+    def test_tampered_session_rejected(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        filename = session._session_filename(session.session_dir(),
+                                             self.db_filename)
+        with open(filename, 'rb') as f:
+            token = bytearray(f.read())
+        token[-1] ^= 1
+        with open(filename, 'wb') as f:
+            f.write(bytes(token))
+        self.assertIsNone(session.load_session(self.db_filename, self.header))
+
+    def test_secret_per_session(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        other = self.db_filename + '.copy'
+        session.create_session(other, self.header, self.transformed_key, 60)
+        filenames = [session._session_filename(session.session_dir(), name)
+                     for name in (self.db_filename, other)]
+        secrets = []
+        for filename in filenames:
+            with open(session._secret_filename(filename), 'rb') as f:
+                secrets.append(f.read())
+        self.assertNotEqual(secrets[0], secrets[1])
+        # A session can't be opened without its own secret.
+        os.rename(session._secret_filename(filenames[1]),
+                  session._secret_filename(filenames[0]))
+        self.assertIsNone(session.load_session(self.db_filename, self.header))
+
+    def test_new_session_replaces_secret(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        self.assertEqual(len(os.listdir(session.session_dir())), 2)
+        self.assertEqual(session.load_session(self.db_filename, self.header),
+                         self.transformed_key)
+
+    def test_end_sessions(self):
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        self.assertEqual(session.end_sessions(), 1)
+        self.assertIsNone(session.load_session(self.db_filename, self.header))
+        self.assertEqual(os.listdir(session.session_dir()), [])
+
+    def test_session_cache_removed_with_session(self):
+        self.assertIsNone(session.session_cache_filename(self.db_filename))
+        session.create_session(self.db_filename, self.header,
+                               self.transformed_key, 60)
+        cache_file = session.session_cache_filename(self.db_filename)
+        with open(cache_file, 'wb') as f:
+            f.write(b'cached')
+        self.assertEqual(session.end_sessions(), 1)
+        self.assertEqual(os.listdir(session.session_dir()), [])
+
+    def test_shared_session_dir_rejected(self):
+        directory = session.session_dir()
+        os.chmod(directory, 0o755)
+        with self.assertRaises(session.SessionError):
+            session.session_dir()
+
+    def test_parse_duration(self):
+        self.assertEqual(session.parse_duration('90'), 90)
+        self.assertEqual(session.parse_duration('90s'), 90)
+        self.assertEqual(session.parse_duration('15m'), 15 * 60)
+        self.assertEqual(session.parse_duration('2h'), 2 * 60 * 60)
+        self.assertEqual(session.parse_duration('1d'), 24 * 60 * 60)
+        with self.assertRaises(ValueError):
+            session.parse_duration('soon')
+
+
+if __name__ == '__main__':
+    unittest.main()
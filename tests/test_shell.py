@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+
+import mock
+from six import StringIO
+
+from keepassx import instrument
+from keepassx.db import Database, Entry
+from keepassx.shell import IncrementalSearch, Shell
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+def create_entry(title):
+    entry = Entry()
+    entry.title = title
+    return entry
+
+
+class CountingHook(instrument.Hook):
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class TestIncrementalSearch(unittest.TestCase):
+    def setUp(self):
+        self.entries = [create_entry(title) for title in [
+            'Github', 'GitLab', 'gmail', 'Gmail', 'Bank', 'Google']]
+        self.search = IncrementalSearch(self.entries)
+
+    def titles(self, query):
+        return [entry.title for entry in self.search.search(query)]
+
+    def test_same_tiers_as_fuzzy_search(self):
+        self.assertEqual(self.titles('Gmail'), ['Gmail'])
+        self.assertEqual(self.titles('GMAIL'), ['gmail', 'Gmail'])
+        self.assertEqual(self.titles('gt'), ['Github', 'GitLab'])
+        self.assertEqual(self.titles('Gogle'), ['Google'])
+        self.assertEqual(self.titles('zzz'), [])
+
+    def test_matches_database_fuzzy_search(self):
+        db = Database(open_data_file('demo.kdb').read(), b'password')
+        search = IncrementalSearch(db.entries)
+        for query in ['g', 'gi', 'git', 'github', 'GITHUB', 'mt', 'Gmial',
+                      'm', 'mytitle']:
+            self.assertEqual(search.search(query),
+                             db.fuzzy_search_by_title(query), query)
+
+    def test_extending_query_narrows_candidates(self):
+        hook = CountingHook()
+        instrument.add_hook(hook)
+        self.addCleanup(instrument.remove_hook, hook)
+        self.titles('g')
+        self.assertEqual(hook.counts['entries_scanned'], 6)
+        hook.counts.clear()
+        # Only the 5 candidates of "g" are checked.
+        self.titles('gi')
+        self.assertEqual(hook.counts['entries_scanned'], 5)
+        hook.counts.clear()
+        # Deleting a character goes back to the earlier candidates.
+        self.assertEqual(self.titles('g'),
+                         ['Github', 'GitLab', 'gmail', 'Gmail', 'Google'])
+        self.assertEqual(hook.counts, {})
+        self.assertEqual(self.titles('ba'), ['Bank'])
+
+
+class TestShell(unittest.TestCase):
+    def run_shell(self, commands, clear_after=None):
+        db = Database(open_data_file('demo.kdb').read(), b'password')
+        output = StringIO()
+        shell = Shell(db.entries, clear_after=clear_after,
+                      stdin=StringIO('\n'.join(commands) + '\n'),
+                      stdout=output)
+        shell.cmdloop(intro='')
+        return output.getvalue()
+
+    def test_search_and_get(self):
+        output = self.run_shell(['search git', 'get username password'])
+        self.assertIn('* 1  Github', output)
+        self.assertIn('username:  githubuser', output)
+        self.assertIn('password:  mypassword', output)
+
+    def test_bare_query_searches(self):
+        output = self.run_shell(['gmail', 'get title'])
+        self.assertIn('title:     Gmail', output)
+
+    def test_select(self):
+        output = self.run_shell(['search t', 'select 2', 'get title'])
+        self.assertIn('Selected Github', output)
+        self.assertIn('title:     Github', output)
+        output = self.run_shell(['search t', 'select 9'])
+        self.assertIn('Select a result between 1 and 2.', output)
+
+    def test_nothing_selected(self):
+        output = self.run_shell(['get', 'search missing', 'copy'])
+        self.assertIn('No entry selected', output)
+        self.assertIn('No entries found for: missing', output)
+
+    def test_copy(self):
+        with mock.patch('keepassx.shell.clipboard') as clipboard:
+            output = self.run_shell(['github', 'copy', 'copy username'],
+                                    clear_after=10)
+        clipboard.copy.assert_any_call('mypassword', clear_after=10)
+        clipboard.copy.assert_any_call('githubuser', clear_after=10)
+        self.assertIn('Copied the password of Github', output)
+
+    def test_complete_search(self):
+        db = Database(open_data_file('demo.kdb').read(), b'password')
+        shell = Shell(db.entries, stdin=StringIO(), stdout=StringIO())
+        self.assertEqual(shell.complete_search('git', 'search git', 7, 10),
+                         ['Github'])
+        # Fuzzy matches are offered for a single word.
+        self.assertEqual(shell.complete_search('gt', 'search gt', 7, 9),
+                         ['Github'])
+        self.assertEqual(
+            shell.complete_search('ti', 'search my ti', 10, 12), [])
+        self.assertEqual(
+            shell.complete_search('myti', 'search myti', 7, 11), ['mytitle'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import unittest
+
+from keepassx.db import Database, Entry, EntryNotFoundError
+from keepassx.threadsafe import SharedDatabase, Snapshot
+
+
+def open_data_file(name):
+    return open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'misc', name), 'rb')
+
+
+class TestSharedDatabase(unittest.TestCase):
+    def setUp(self):
+        self.contents = open_data_file('demo.kdb').read()
+        self.shared = SharedDatabase(Database(self.contents, b'password'))
+
+    def titles(self, entries):
+        return sorted(entry.title for entry in entries)
+
+    def test_lookups(self):
+        entry = self.shared.find_by_title('mytitle')
+        self.assertIs(self.shared.find_by_uuid(entry.uuid), entry)
+        self.assertEqual(entry.group.path, 'Internet')
+        self.assertIn(entry, self.shared.group_entries('Internet'))
+        self.assertEqual(self.shared.fuzzy_search_by_title('MYTITLE'),
+                         [entry])
+
+    def test_find_by_url(self):
+        self.assertEqual(
+            [e.title for e in self.shared.find_by_url('https://github.com')],
+            ['Github'])
+
+        def move(entries):
+            for entry in entries:
+                if entry.title == 'Github':
+                    entry.url = u'https://gitlab.com'
+
+        self.shared.update(move)
+        self.assertEqual(self.shared.find_by_url('https://github.com'), [])
+        self.assertEqual(
+            [e.title for e in self.shared.find_by_url('gitlab.com')],
+            ['Github'])
+
+    def test_group_queries(self):
+        shared = SharedDatabase(Database(
+            open_data_file('passwordmultientry.kdb').read(), b'password'))
+        groups = shared.included_groups(names=['Backup'])
+        self.assertEqual([g.path for g in groups], ['Internet', 'eMail'])
+        self.assertEqual(
+            self.titles(shared.exclude_groups(names=['Backup'])),
+            self.titles(shared.iter_entries(groups)))
+        self.assertEqual(
+            self.titles(shared.exclude_groups(['eMail'], ['Backup'])),
+            self.titles(shared.group_entries('Internet')))
+        self.assertEqual([g.path for g in shared.subtree_groups('Internet')],
+                         ['Internet'])
+
+    def test_not_found(self):
+        with self.assertRaises(EntryNotFoundError):
+            self.shared.find_by_title('missing')
+        with self.assertRaises(EntryNotFoundError):
+            self.shared.find_by_uuid('0' * 32)
+
+    def test_snapshot_is_fully_decoded(self):
+        snapshot = self.shared.snapshot
+        self.assertIsInstance(snapshot.entries, tuple)
+        self.assertIsNone(snapshot._payload)
+
+    def test_update_publishes_new_snapshot(self):
+        before = self.shared.snapshot
+
+        def rename(entries):
+            for entry in entries:
+                if entry.title == 'mytitle':
+                    entry.title = u'renamed'
+
+        after = self.shared.update(rename)
+        self.assertIs(self.shared.snapshot, after)
+        self.assertEqual(self.shared.find_by_title('renamed').title,
+                         'renamed')
+        # The old snapshot and its entries are unchanged.
+        self.assertEqual(before.find_by_title('mytitle').title, 'mytitle')
+        with self.assertRaises(EntryNotFoundError):
+            before.find_by_title('renamed')
+        self.assertEqual(self.titles(before.group_entries('Internet')),
+                         self.titles(
+                             e for e in before.entries
+                             if e.group.path == 'Internet'))
+        # The groups are copied too.
+        self.assertIsNot(before.groups[0], after.groups[0])
+
+    def test_update_adds_and_removes_entries(self):
+        group = self.shared.find_by_title('mytitle').group
+        count = len(self.shared.entries)
+
+        def edit(entries):
+            entries[:] = [e for e in entries if e.title != 'mytitle']
+            entry = Entry()
+            entry.uuid = u'a' * 32
+            entry.title = u'new'
+            entry.groupid = group.groupid
+            entries.append(entry)
+
+        self.shared.update(edit)
+        self.assertEqual(len(self.shared.entries), count)
+        new = self.shared.find_by_uuid(u'a' * 32)
+        self.assertIs(new.group, self.shared.snapshot.find_groups(
+            group.path)[0])
+        self.assertIn(new, self.shared.group_entries(group.path))
+        with self.assertRaises(EntryNotFoundError):
+            self.shared.find_by_title('mytitle')
+
+    def test_failed_update_publishes_nothing(self):
+        before = self.shared.snapshot
+
+        def fail(entries):
+            del entries[:]
+            raise ValueError("Edit failed.")
+
+        with self.assertRaises(ValueError):
+            self.shared.update(fail)
+        self.assertIs(self.shared.snapshot, before)
+
+    def test_reload(self):
+        other = Database(open_data_file('password.kdb').read(), b'password')
+        snapshot = self.shared.reload(other)
+        self.assertIsInstance(snapshot, Snapshot)
+        self.assertEqual(self.titles(self.shared.entries),
+                         self.titles(snapshot.entries))
+
+    def test_concurrent_lookups_and_updates(self):
+        titles = [entry.title for entry in self.shared.entries]
+        errors = []
+
+        def read():
+            try:
+                for _ in range(200):
+                    snapshot = self.shared.snapshot
+                    for title in titles:
+                        snapshot.find_by_title(title)
+            except Exception as e:
+                errors.append(e)
+
+        def touch(entries):
+            for entry in entries:
+                entry.notes = (entry.notes or u'') + u'.'
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for thread in readers:
+            thread.start()
+        for _ in range(20):
+            self.shared.update(touch)
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(all(entry.notes.endswith(u'.' * 20)
+                            for entry in self.shared.entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import unittest
+from datetime import datetime
+
+from keepassx.db import Entry
+from keepassx.timeindex import TimeIndex
+
+
+def create_entry(title, last_mod_time):
+    entry = Entry()
+    entry.title = title
+    entry.last_mod_time = last_mod_time
+    return entry
+
+
+class TestTimeIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = TimeIndex([
+            create_entry('c', datetime(2015, 3, 1)),
+            create_entry('a', datetime(2015, 1, 1)),
+            create_entry('none', None),
+            create_entry('b1', datetime(2015, 2, 1)),
+            create_entry('b2', datetime(2015, 2, 1)),
+            create_entry('d', datetime(2015, 4, 1)),
+        ], 'last_mod_time')
+
+    def titles(self, entries):
+        return [entry.title for entry in entries]
+
+    def test_sorted_and_stable(self):
+        self.assertEqual(self.titles(self.index.entries),
+                         ['a', 'b1', 'b2', 'c', 'd'])
+        self.assertEqual(len(self.index), 5)
+
+    def test_between(self):
+        self.assertEqual(
+            self.titles(self.index.between(datetime(2015, 2, 1),
+                                           datetime(2015, 4, 1))),
+            ['b1', 'b2', 'c'])
+        self.assertEqual(
+            self.titles(self.index.between(start=datetime(2015, 2, 2))),
+            ['c', 'd'])
+        self.assertEqual(
+            self.titles(self.index.between(end=datetime(2015, 2, 1))),
+            ['a'])
+        self.assertEqual(self.index.between(datetime(2016, 1, 1)), [])
+
+    def test_first_and_last(self):
+        self.assertEqual(
+            self.titles(self.index.first(2, start=datetime(2015, 1, 15))),
+            ['b1', 'b2'])
+        self.assertEqual(self.titles(self.index.last(2)), ['d', 'c'])
+        self.assertEqual(
+            self.titles(self.index.last(5, end=datetime(2015, 2, 1))),
+            ['a'])
+
+    def test_ignore(self):
+        index = TimeIndex([create_entry('a', datetime(2015, 1, 1)),
+                           create_entry('b', datetime(2999, 12, 28))],
+                          'last_mod_time', ignore=(datetime(2999, 12, 28),))
+        self.assertEqual(self.titles(index.entries), ['a'])
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            TimeIndex([], 'title')
+
+
+if __name__ == '__main__':
+    unittest.main()
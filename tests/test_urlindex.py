@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import unittest
+
+from keepassx.db import Entry
+from keepassx.urlindex import DomainIndex, normalize_host, host_labels
+
+
+def create_entry(title, url):
+    entry = Entry()
+    entry.title = title
+    entry.url = url
+    return entry
+
+
+class TestNormalizeHost(unittest.TestCase):
+    def test_normalize(self):
+        for url, host in [
+                ('https://login.Example.com/x?y=1', 'login.example.com'),
+                ('http://www.example.com:8080', 'example.com'),
+                ('example.com/login', 'example.com'),
+                ('ftp://user:pw@files.example.com/', 'files.example.com'),
+                ('example.com.', 'example.com'),
+                ('example.com#top', 'example.com'),
+                ('https://[::1]:8443/', '[::1]'),
+                ('10.0.0.1:22', '10.0.0.1')]:
+            self.assertEqual(normalize_host(url), host, url)
+
+    def test_no_host(self):
+        for url in [None, '', 'cmd://putty.exe', 'https://',
+                    '{REF:U@I:1234}', 'file:///etc/passwd']:
+            self.assertIsNone(normalize_host(url), url)
+
+    def test_labels(self):
+        self.assertEqual(host_labels('login.example.com'),
+                         ['com', 'example', 'login'])
+        self.assertEqual(host_labels('10.0.0.1'), ['10.0.0.1'])
+
+
+class TestDomainIndex(unittest.TestCase):
+    def setUp(self):
+        self.entries = [
+            create_entry('parent', 'https://example.com'),
+            create_entry('corp', 'corp.example.com/'),
+            create_entry('login', 'https://www.login.corp.example.com/'),
+            create_entry('other', 'https://example.org'),
+            create_entry('second parent', 'http://example.com:8080/a'),
+            create_entry('command', 'cmd://putty.exe example.com'),
+            create_entry('router', 'http://10.0.0.1/'),
+        ]
+        self.index = DomainIndex(self.entries)
+
+    def titles(self, url):
+        return [entry.title for entry in self.index.find(url)]
+
+    def test_most_specific_first(self):
+        self.assertEqual(
+            self.titles('https://login.corp.example.com/x?y'),
+            ['login', 'corp', 'parent', 'second parent'])
+
+    def test_parent_domains_match(self):
+        self.assertEqual(self.titles('https://mail.example.com/'),
+                         ['parent', 'second parent'])
+        self.assertEqual(self.titles('https://dev.corp.example.com/'),
+                         ['corp', 'parent', 'second parent'])
+
+    def test_subdomain_entries_do_not_match_parent(self):
+        self.assertEqual(self.titles('example.org'), ['other'])
+        self.assertEqual(self.titles('https://www.example.com'),
+                         ['parent', 'second parent'])
+
+    def test_no_match(self):
+        self.assertEqual(self.titles('https://example.net/'), [])
+        self.assertEqual(self.titles('com'), [])
+        self.assertEqual(self.titles('cmd://putty.exe'), [])
+
+    def test_ip_addresses_match_exactly(self):
+        self.assertEqual(self.titles('10.0.0.1'), ['router'])
+        self.assertEqual(self.titles('20.10.0.0.1'), [])
+
+    def test_size(self):
+        self.assertEqual(self.index.size, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
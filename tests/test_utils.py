@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import unittest
+
+from keepassx import utils
+
+
+class TestSeal(unittest.TestCase):
+    def setUp(self):
+        self.key = b'k' * 32
+
+    def test_unseal(self):
+        for plaintext in [b'', b'secret', b'x' * 16]:
+            data = utils.seal(self.key, plaintext)
+            self.assertEqual(utils.unseal(self.key, data, 0), plaintext)
+
+    def test_header_is_in_the_clear(self):
+        data = utils.seal(self.key, b'secret', header=b'HEADER')
+        self.assertTrue(data.startswith(b'HEADER'))
+        self.assertNotIn(b'secret', data)
+        self.assertEqual(utils.unseal(self.key, data, 6), b'secret')
+
+    def test_each_seal_is_different(self):
+        self.assertNotEqual(utils.seal(self.key, b'secret'),
+                            utils.seal(self.key, b'secret'))
+
+    def test_wrong_key_rejected(self):
+        data = utils.seal(self.key, b'secret')
+        self.assertIsNone(utils.unseal(b'x' * 32, data, 0))
+
+    def test_associated_data_authenticated(self):
+        data = utils.seal(self.key, b'secret', header=b'H',
+                          associated_data=b'demo.kdb')
+        self.assertEqual(
+            utils.unseal(self.key, data, 1, associated_data=b'demo.kdb'),
+            b'secret')
+        self.assertIsNone(
+            utils.unseal(self.key, data, 1, associated_data=b'other.kdb'))
+        self.assertIsNone(utils.unseal(self.key, data, 1))
+
+    def test_tampering_rejected(self):
+        data = utils.seal(self.key, b'secret', header=b'HEADER')
+        for i in range(len(data)):
+            tampered = bytearray(data)
+            tampered[i] ^= 1
+            self.assertIsNone(utils.unseal(self.key, bytes(tampered), 6))
+        self.assertIsNone(utils.unseal(self.key, data[:-1], 6))
+        self.assertIsNone(utils.unseal(self.key, b'', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import unittest
+from datetime import datetime
+
+from keepassx.db import Database, Group, Entry, Header, DateType
+from keepassx.db import derive_key
+from keepassx.writer import DatabaseWriter, NEVER_EXPIRES
+
+
+def create_group(groupid, name, level=0):
+    group = Group()
+    group.groupid = groupid
+    group.group_name = name
+    group.level = level
+    return group
+
+
+def create_entry(group, title, **kwargs):
+    entry = Entry()
+    entry.group = group
+    entry.title = title
+    for key, value in kwargs.items():
+        setattr(entry, key, value)
+    return entry
+
+
+class TestDatabaseWriter(unittest.TestCase):
+    def setUp(self):
+        self.writer = DatabaseWriter(password=b'password',
+                                     key_encryption_rounds=10)
+
+    def test_round_trip(self):
+        group = create_group(1, u'Internet')
+        self.writer.add_group(group)
+        self.writer.add_entry(create_entry(
+            group, u'mytitle', username=u'user', password=u'\u2713pw',
+            url=u'example.com',
+            creation_time=datetime(2012, 7, 14, 13, 17, 8)))
+        db = Database(self.writer.serialize(), b'password')
+        self.assertEqual(len(db.groups), 1)
+        self.assertEqual(db.groups[0].group_name, 'Internet')
+        entry = db.entries[0]
+        self.assertEqual(entry.title, 'mytitle')
+        self.assertEqual(entry.username, 'user')
+        self.assertEqual(entry.password, u'\u2713pw')
+        self.assertEqual(entry.group.group_name, 'Internet')
+        self.assertEqual(len(entry.uuid), 32)
+        self.assertEqual(entry.creation_time, datetime(2012, 7, 14, 13, 17, 8))
+        self.assertEqual(entry.expiration_time, NEVER_EXPIRES)
+
+    def test_header_values(self):
+        self.writer.add_group(create_group(1, u'Internet'))
+        header = Header(self.writer.serialize())
+        self.assertEqual(header.signature1, Header.SIGNATURE1)
+        self.assertEqual(header.signature2, Header.SIGNATURE2)
+        self.assertEqual(header.encryption_type, 'Rijndael')
+        self.assertEqual(header.num_groups, 1)
+        self.assertEqual(header.num_entries, 0)
+        self.assertEqual(header.key_encryption_rounds, 10)
+
+    def test_attachment_round_trip(self):
+        group = create_group(1, u'Internet')
+        self.writer.add_group(group)
+        self.writer.add_entry(create_entry(
+            group, u'attached', binary_desc=u'data.bin',
+            binary_data=b'\x00\x01' * 100000))
+        db = Database(self.writer.serialize(), b'password')
+        self.assertEqual(db.entries[0].binary_data, b'\x00\x01' * 100000)
+
+    def test_reuse_transformed_key(self):
+        self.writer.add_group(create_group(1, u'Internet'))
+        contents = self.writer.serialize()
+        header = Header(contents)
+        transformed_key = derive_key(header, contents[Header.HEADER_SIZE:],
+                                     [b'password'])[0]
+        writer = DatabaseWriter(
+            key_encryption_rounds=10, master_seed2=header.master_seed2,
+            transformed_key=transformed_key)
+        writer.add_group(create_group(2, u'eMail'))
+        db = Database(writer.serialize(), b'password')
+        self.assertEqual(db.groups[0].group_name, 'eMail')
+        self.assertEqual(db.metadata.master_seed2, header.master_seed2)
+        self.assertNotEqual(db.metadata.master_seed, header.master_seed)
+
+    def test_entry_requires_group(self):
+        with self.assertRaises(ValueError):
+            self.writer.add_entry(create_entry(None, u'foo'))
+
+    def test_added_entry_is_not_modified(self):
+        entry = create_entry(create_group(1, u'Internet'), u'foo')
+        written = self.writer.add_entry(entry)
+        self.assertIsNone(entry.groupid)
+        self.assertIsNone(entry.uuid)
+        self.assertEqual(written.groupid, 1)
+        self.assertEqual(len(written.uuid), 32)
+
+
+class TestDateType(unittest.TestCase):
+    def test_encode_is_inverse_of_decode(self):
+        for value in [datetime(2012, 7, 14, 13, 17, 8), NEVER_EXPIRES,
+                      datetime(1999, 1, 1, 0, 0, 0)]:
+            self.assertEqual(DateType.decode(DateType.encode(value)), value)